@@ -147,7 +147,7 @@ def SmartRatio(model, sr_args, parser_args):
         K = int(p_arr[layer_idx] * N)
         tmp_array = np.array([0] * (N-K) + [1] * K)
         np.random.shuffle(tmp_array)
-        layer.flag.data = torch.nn.Parameter(torch.from_numpy(tmp_array).float().reshape(layer.weight.shape))
+        layer.flag = torch.from_numpy(tmp_array).float().reshape(layer.weight.shape)
         layer.scores.data = torch.nn.Parameter(torch.ones(layer.weight.shape))
         layer_idx += 1
     for layer in linear_layers:
@@ -155,7 +155,7 @@ def SmartRatio(model, sr_args, parser_args):
         K = int(p_arr[layer_idx] * N)
         tmp_array = np.array([0] * (N-K) + [1] * K)
         np.random.shuffle(tmp_array)
-        layer.flag.data = torch.nn.Parameter(torch.from_numpy(tmp_array).float().reshape(layer.weight.shape))
+        layer.flag = torch.from_numpy(tmp_array).float().reshape(layer.weight.shape)
         layer.scores.data = torch.nn.Parameter(torch.ones(layer.weight.shape))
         layer_idx += 1
 
@@ -939,6 +939,162 @@ class ArgsHelper:
             default=False,
             help="Enable this drop bottom half of weights in epoch 1 when using pretrained model"
         )
+        parser.add_argument(
+            "--lean-masked-ops",
+            action="store_true",
+            default=False,
+            help="Use the fused masked conv/linear ops that recompute weight * subnet in backward instead of saving it (less memory, hc/ep/global_ep only)"
+        )
+        parser.add_argument(
+            "--seeded-weights",
+            action="store_true",
+            default=False,
+            help="Don't store the frozen weights of the subnet layers, regenerate them from the RNG state of their init (same values as the default init; needs --lean-masked-ops and SubnetConv, the same flag must be used to load the checkpoints)"
+        )
+        parser.add_argument(
+            "--compact-model",
+            action="store_true",
+            default=False,
+            help="After finetuning, drop the dead channels of the subnet and save it as a smaller dense model (see utils/compaction.py)"
+        )
+        parser.add_argument(
+            "--sparse-export",
+            action="store_true",
+            default=False,
+            help="After finetuning, export the (rounded) subnet for CPU inference, each layer running dense or CSR/BSR sparse, whichever is faster, and save it as model_sparse.pth (see utils/sparse_inference.py)"
+        )
+        parser.add_argument(
+            "--active-set-scores",
+            action="store_true",
+            default=False,
+            help="hc / hc_iter: after each prune, only compute score gradients and optimizer updates for the live (unflagged) scores (see utils/active_set.py)"
+        )
+        parser.add_argument(
+            "--score-dtype",
+            type=str,
+            default='float32',
+            help="storage of the scores |float32|bfloat16|float16|uint8|, uint8 is for global_ep / global_ep_iter only (see utils/score_precision.py)"
+        )
+        parser.add_argument(
+            "--score-master-copy",
+            action="store_true",
+            default=False,
+            help="With --score-dtype bfloat16 / float16, train an fp32 master copy of the scores kept in the optimizer (always on for uint8)"
+        )
+        parser.add_argument(
+            "--score-param",
+            type=str,
+            default='dense',
+            help="parameterization of the scores |dense|hashed|lowrank|, hashed / lowrank compute them from a smaller parameter in the layers where that is smaller (see utils/score_params.py)"
+        )
+        parser.add_argument(
+            "--score-hash-buckets",
+            type=int,
+            default=65536,
+            help="Number of score buckets per layer for --score-param hashed"
+        )
+        parser.add_argument(
+            "--score-rank",
+            type=int,
+            default=8,
+            help="Rank of the scores for --score-param lowrank"
+        )
+        parser.add_argument(
+            "--eval-cache",
+            action="store_true",
+            default=False,
+            help="Answer repeated validate() calls on an unchanged model and loader from a cache (see utils/eval_cache.py)"
+        )
+        parser.add_argument(
+            "--eval-store",
+            type=str,
+            default=None,
+            help="Materialize the val / test splits once as normalized tensors: memory|mmap (mmap caches them under --data, see data/eval_store.py)"
+        )
+        parser.add_argument(
+            "--eval-store-batch-size",
+            type=int,
+            default=None,
+            help="Batch size of the --eval-store loaders (default: --batch-size)"
+        )
+        parser.add_argument(
+            "--seq-eval",
+            action="store_true",
+            default=False,
+            help="Estimate validate() on a stratified random stream of batches until the top-1 interval is narrow enough, except at the last / checkpoint epochs (see utils/seq_eval.py)"
+        )
+        parser.add_argument(
+            "--seq-eval-ci",
+            type=float,
+            default=0.5,
+            help="Half width (accuracy points) of the top-1 confidence interval at which --seq-eval stops"
+        )
+        parser.add_argument(
+            "--seq-eval-confidence",
+            type=float,
+            default=0.95,
+            help="Confidence level of the --seq-eval interval"
+        )
+        parser.add_argument(
+            "--eval-worker",
+            action="store_true",
+            default=False,
+            help="Run the per-epoch rounding + validation in a background process while training goes on (see utils/eval_worker.py)"
+        )
+        parser.add_argument(
+            "--eval-worker-queue",
+            type=int,
+            default=2,
+            help="Number of score snapshots the --eval-worker can have in flight"
+        )
+        parser.add_argument(
+            "--eval-worker-gpu",
+            type=int,
+            default=None,
+            help="GPU of the --eval-worker process (default: --gpu)"
+        )
+        parser.add_argument(
+            "--eval-ckpts",
+            type=str,
+            default=None,
+            help="Glob of the checkpoints evaluated by eval_checkpoints.py"
+        )
+        parser.add_argument(
+            "--eval-ckpts-per-batch",
+            type=int,
+            default=4,
+            help="Number of checkpoints eval_checkpoints.py runs on each input batch (their tensors are kept on the GPU)"
+        )
+        parser.add_argument(
+            "--prefix-cache",
+            type=str,
+            default=None,
+            help="Cache the activations of the unchanged leading layers for validate(): memory|mmap (mmap stores them under --data, see utils/prefix_cache.py)"
+        )
+        parser.add_argument(
+            "--score-arena",
+            action="store_true",
+            default=False,
+            help="Keep the scores and flags of all subnet layers in flat buffers, so clamping, prune thresholds and the L1/L2/var_red_1 regularizers work on them at once (see utils/score_arena.py)"
+        )
+        parser.add_argument(
+            "--incremental-threshold",
+            action="store_true",
+            default=False,
+            help="global_ep: find the per batch BottomK threshold by selection within a bracket around the previous one instead of a full sort (same value)"
+        )
+        parser.add_argument(
+            "--threshold-refresh",
+            type=int,
+            default=100,
+            help="Batches between full recomputes of the --incremental-threshold bracket"
+        )
+        parser.add_argument(
+            "--prune-chunk-size",
+            type=int,
+            default=None,
+            help="BottomK / LocalBottomK prune(): find the thresholds by a radix select over chunks of this many scores and update the flags in place, instead of concatenating and sorting all the scores (same thresholds)"
+        )
 
         if jupyter_mode:
             args = parser.parse_args("")
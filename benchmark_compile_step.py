@@ -0,0 +1,93 @@
+"""
+Eager vs torch.compile time of one score-training step on CPU.
+
+The subnet layers bind their forward strategy when they are built
+(utils/subnet_strategies.py), so the forward has no parser_args branches,
+no .item() calls and no host-side threshold updates, and dynamo can trace a
+full forward / backward / optimizer step. This builds the model from the
+usual flags / config and times a step (forward, loss, backward, SGD step on
+the scores) both ways.
+
+Only --algo ep / hc make sense here: global_ep recomputes its thresholds with
+prune() in the model forward, which is host-side and breaks the graph.
+
+Usage (the usual main.py flags):
+    python benchmark_compile_step.py --arch resnet20 --algo ep --batch-size 128 --prune-rate 0.5
+"""
+import time
+
+import torch
+import torch.nn as nn
+
+from args_helper import parser_args
+from main_utils import get_model
+
+
+STEPS = 20
+WARMUP = 3
+
+INPUT_SIZE = {
+    'CIFAR10': 32,
+    'TinyImageNet': 64,
+    'ImageNet': 224,
+}
+
+NUM_CLASSES = {
+    'CIFAR10': 10,
+    'TinyImageNet': 200,
+    'ImageNet': 1000,
+}
+
+
+def time_steps(step, x, y):
+    for _ in range(WARMUP):
+        step(x, y)
+    start = time.time()
+    for _ in range(STEPS):
+        step(x, y)
+    return (time.time() - start) / STEPS
+
+
+def make_step(model, forward):
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=0.1, momentum=0.9)
+    criterion = nn.CrossEntropyLoss()
+
+    def step(x, y):
+        optimizer.zero_grad()
+        loss = criterion(forward(x), y)
+        loss.backward()
+        optimizer.step()
+        return loss
+
+    return step
+
+
+def main():
+    if parser_args.algo not in ['ep', 'hc', 'hc_iter']:
+        print("benchmark_compile_step.py only supports --algo ep / hc (got {})".format(parser_args.algo))
+        return
+
+    torch.manual_seed(parser_args.seed)
+    size = INPUT_SIZE.get(parser_args.dataset, 32)
+    x = torch.randn(parser_args.batch_size, 3, size, size)
+    y = torch.randint(NUM_CLASSES.get(parser_args.dataset, 10), (parser_args.batch_size,))
+
+    model = get_model(parser_args)
+    model.train()
+    t_eager = time_steps(make_step(model, model), x, y)
+
+    model = get_model(parser_args)
+    model.train()
+    t_compiled = time_steps(make_step(model, torch.compile(model)), x, y)
+
+    print("arch: {}, algo: {}, batch size: {}, threads: {}".format(
+        parser_args.arch, parser_args.algo, parser_args.batch_size, torch.get_num_threads()))
+    print("{:<10} {:>12}".format('mode', 'ms/step'))
+    print("{:<10} {:>12.2f}".format('eager', 1000 * t_eager))
+    print("{:<10} {:>12.2f}".format('compiled', 1000 * t_compiled))
+    print("speedup: {:.2f}x".format(t_eager / t_compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Microbenchmark for the incremental global_ep threshold (--incremental-threshold,
+KthValueTracker in utils/selection.py).
+
+Simulates the per batch prune(model, update_thresholds_only=True) calls at ResNet50
+scale: the scores of all the layers take a small random step every batch, the prune rate
+is annealed from --prune-rate to --final-prune-rate in --anneal-steps equal steps (as
+the iterative global_ep schedules do between epochs), and the BottomK threshold is found
+with the full sort that prune() used, with torch.kthvalue on the whole tensor and with
+the tracker. Checks that the three give exactly the same value on every batch (exits
+with status 1 otherwise) and reports the time per batch of each.
+
+Usage:
+    python benchmark_global_threshold.py [--device cpu] [--batches 200] [--step 1e-4]
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from utils.selection import KthValueTracker
+
+
+# scores of ResNet50 (conv + fc weights)
+RESNET50_NUMEL = 25502912
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+# prune rate of the given batch: --anneal-steps constant stretches from --prune-rate to
+# --final-prune-rate
+def prune_rate_at(args, batch):
+    if args.anneal_steps < 2:
+        return args.prune_rate
+    step = batch * args.anneal_steps // args.batches
+    return args.prune_rate + (args.final_prune_rate - args.prune_rate) * step / (args.anneal_steps - 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the incremental global threshold")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--numel", type=int, default=RESNET50_NUMEL)
+    parser.add_argument("--prune-rate", type=float, default=0.5)
+    parser.add_argument("--final-prune-rate", type=float, default=0.9)
+    parser.add_argument("--anneal-steps", type=int, default=4,
+                        help="number of prune rates between --prune-rate and --final-prune-rate (1: no annealing)")
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--step", type=float, default=1e-4,
+                        help="std of the per batch change of the scores")
+    parser.add_argument("--refresh", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    scores = torch.randn(args.numel, device=device)
+    tracker = KthValueTracker(args.refresh)
+
+    times = {'sort': 0.0, 'kthvalue': 0.0, 'incremental': 0.0}
+    mismatches = 0
+    for batch in range(args.batches):
+        k = max(int(prune_rate_at(args, batch) * args.numel), 1)
+        scores.add_(torch.randn_like(scores), alpha=args.step)
+        flat = scores.abs()
+        values = {}
+        for name, fn in [('sort', lambda: torch.sort(flat).values[k - 1].item()),
+                         ('kthvalue', lambda: torch.kthvalue(flat, k).values.item()),
+                         ('incremental', lambda: tracker.kth(flat, k))]:
+            synchronize(device)
+            start = time.time()
+            values[name] = fn()
+            synchronize(device)
+            times[name] += time.time() - start
+        if not values['sort'] == values['kthvalue'] == values['incremental']:
+            mismatches += 1
+            print("Batch {}, k {}: sort {}, kthvalue {}, incremental {}".format(
+                batch, k, values['sort'], values['kthvalue'], values['incremental']))
+
+    print("{} scores, prune rate {} -> {} in {} steps, {} batches, step {}".format(
+        args.numel, args.prune_rate, args.final_prune_rate, args.anneal_steps, args.batches, args.step))
+    print("{:<12} {:>14} {:>8}".format('method', 'ms / batch', 'speedup'))
+    for name, t in times.items():
+        print("{:<12} {:>14.3f} {:>7.2f}x".format(name, 1000 * t / args.batches, times['sort'] / t))
+    print("Tracker: {} in the bracket, {} drifted out, {} full recomputes".format(
+        tracker.hits, tracker.misses, tracker.refreshes))
+    print("All thresholds match: {} ({} mismatched batches)".format(mismatches == 0, mismatches))
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
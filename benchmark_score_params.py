@@ -0,0 +1,72 @@
+"""
+Score memory and accuracy of hashed / low-rank scores (utils/score_params.py)
+against dense scores, at the same target sparsity.
+
+Trains the model from the usual flags / config for EPOCHS epochs once per score
+parameterization (same seed, same data order) and reports the number of score
+parameters, their size, the model sparsity and the test accuracy (hc: of the model
+rounded with --round). The bucket count and rank come from --score-hash-buckets and
+--score-rank. lowrank is only run for ep / global_ep configs. Needs a GPU (like main.py).
+
+Usage:
+    python benchmark_score_params.py --config configs/ep/vgg/vgg16_sc_ep.yml --score-hash-buckets 65536 --score-rank 8
+"""
+import torch.nn as nn
+
+from args_helper import parser_args
+from main_utils import get_model, get_optimizer, get_dataset, get_trainer, set_gpu
+from utils.net_utils import get_model_sparsity, prune, round_model
+from utils.score_params import FactorizedScores
+from utils.utils import set_seed
+
+
+EPOCHS = 1
+SCORE_PARAMS = ['dense', 'hashed', 'lowrank']
+
+
+def num_score_params(model):
+    return sum(m.num_score_params() for m in model.modules() if isinstance(m, FactorizedScores))
+
+
+def run(score_param, data, train, validate, criterion):
+    parser_args.score_param = score_param
+    set_seed(parser_args.seed)
+    model = get_model(parser_args)
+    num_params = num_score_params(model)
+    model = set_gpu(parser_args, model)
+    optimizer = get_optimizer(parser_args, model)
+
+    for epoch in range(EPOCHS):
+        train(data.train_loader, model, criterion, optimizer, epoch, parser_args, writer=None)
+    if parser_args.algo in ['global_ep', 'global_ep_iter']:
+        prune(model, update_thresholds_only=True)
+
+    if parser_args.algo in ['hc', 'hc_iter']:
+        model = round_model(model, parser_args.round, noise=parser_args.noise,
+                            ratio=parser_args.noise_ratio, rank=parser_args.gpu)
+    acc1, _, _ = validate(data.val_loader, model, criterion, parser_args, None, EPOCHS)
+    return num_params, get_model_sparsity(model), acc1
+
+
+def main():
+    train, validate, _ = get_trainer(parser_args)
+    data = get_dataset(parser_args)
+    criterion = nn.CrossEntropyLoss().cuda()
+
+    score_params = [p for p in SCORE_PARAMS if p != 'lowrank' or parser_args.algo in ['ep', 'global_ep', 'global_ep_iter']]
+    results = {}
+    for score_param in score_params:
+        print("=> Training with {} scores".format(score_param))
+        results[score_param] = run(score_param, data, train, validate, criterion)
+
+    print("arch: {}, algo: {}, epochs: {}, buckets: {}, rank: {}".format(
+        parser_args.arch, parser_args.algo, EPOCHS, parser_args.score_hash_buckets, parser_args.score_rank))
+    print("{:<10} {:>14} {:>12} {:>10} {:>10}".format('scores', 'score params', 'size (MB)', 'sparsity', 'acc1'))
+    for score_param in score_params:
+        num_params, sparsity, acc1 = results[score_param]
+        print("{:<10} {:>14} {:>12.2f} {:>10.2f} {:>10.2f}".format(
+            score_param, num_params, 4 * num_params / 2 ** 20, sparsity, acc1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Validation of the reduced-precision scores (utils/score_precision.py) against fp32.
+
+Trains the model from the usual flags / config for EPOCHS epochs once per score dtype,
+from the same init and with the same data order, and compares each run to the fp32
+one: the bytes per score, the fraction of rounded mask entries that agree, the model
+sparsity and the test accuracy of the rounded model (hc: --round, the others use their
+masks as they are). Runs outside the tolerances are flagged, and so are the runs whose
+forward masks (as the layer mask caches serve them) never moved from their initial
+value while the fp32 ones did, i.e. the score training didn't reach the subnet.
+
+uint8 is only run for global_ep / global_ep_iter configs. Needs a GPU (like main.py).
+
+Usage (a resnet20 / CIFAR10 config):
+    python benchmark_score_precision.py --config configs/ep/resnet20/resnet20_global_ep.yml
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from args_helper import parser_args
+from main_utils import get_model, get_optimizer, get_dataset, get_trainer, set_gpu
+from utils.net_utils import get_model_sparsity, prune, round_model
+from utils.score_precision import bytes_per_score, score_layers, set_score_precision
+from utils.utils import set_seed
+
+
+EPOCHS = 1
+DTYPES = ['float32', 'bfloat16', 'float16', 'uint8']
+
+# percentage points
+SPARSITY_TOLERANCE = 0.5
+ACCURACY_TOLERANCE = 1.0
+MIN_MASK_AGREEMENT = 0.99
+
+
+def is_hc():
+    return parser_args.algo in ['hc', 'hc_iter']
+
+
+def rounded_masks(model):
+    masks = []
+    with torch.no_grad():
+        for m in score_layers(model):
+            if is_hc():
+                masks.append(torch.gt(m.scores.float(), parser_args.quantize_threshold).float() * m.flag)
+            else:
+                masks.append(m.get_subnet()[0].detach().float())
+    return masks
+
+
+# the masks the forward uses, through the layer mask caches (rounded_masks recomputes them)
+def forward_masks(model):
+    with torch.no_grad():
+        return [m.strategy.detached_masks(m, *m.strategy.mask_inputs(m))[0].float() for m in score_layers(model)]
+
+
+def mask_agreement(masks, ref_masks):
+    num_equal = sum(torch.eq(a, b).sum().item() for a, b in zip(masks, ref_masks))
+    return num_equal / sum(a.numel() for a in ref_masks)
+
+
+def run(dtype, init_state, data, train, validate, criterion):
+    set_seed(parser_args.seed)
+    model = get_model(parser_args)
+    model.load_state_dict(init_state)
+    model = set_gpu(parser_args, model)
+    optimizer = get_optimizer(parser_args, model)
+    set_score_precision(model, dtype, optimizer, master_copy=True)
+    start_masks = forward_masks(model)
+
+    for epoch in range(EPOCHS):
+        train(data.train_loader, model, criterion, optimizer, epoch, parser_args, writer=None)
+    moved = 1 - mask_agreement(forward_masks(model), start_masks)
+    if parser_args.algo in ['global_ep', 'global_ep_iter']:
+        prune(model, update_thresholds_only=True)
+
+    if is_hc():
+        eval_model = round_model(model, parser_args.round, noise=parser_args.noise,
+                                 ratio=parser_args.noise_ratio, rank=parser_args.gpu)
+    else:
+        eval_model = model
+    acc1, _, _ = validate(data.val_loader, eval_model, criterion, parser_args, None, EPOCHS)
+    return {
+        'bytes': bytes_per_score(model),
+        'masks': rounded_masks(model),
+        'moved': moved,
+        'sparsity': get_model_sparsity(eval_model),
+        'acc1': acc1,
+    }
+
+
+def main():
+    if parser_args.lean_masked_ops or parser_args.active_set_scores:
+        print("benchmark_score_precision.py compares plain score training, drop --lean-masked-ops / --active-set-scores")
+        return
+
+    train, validate, _ = get_trainer(parser_args)
+    data = get_dataset(parser_args)
+    criterion = nn.CrossEntropyLoss().cuda()
+
+    set_seed(parser_args.seed)
+    init_state = copy.deepcopy(get_model(parser_args).state_dict())
+
+    dtypes = [d for d in DTYPES if d != 'uint8' or parser_args.algo in ['global_ep', 'global_ep_iter']]
+    results = {}
+    for dtype in dtypes:
+        print("=> Training with {} scores".format(dtype))
+        results[dtype] = run(dtype, init_state, data, train, validate, criterion)
+
+    ref = results['float32']
+    print("arch: {}, algo: {}, epochs: {}".format(parser_args.arch, parser_args.algo, EPOCHS))
+    print("{:<10} {:>10} {:>10} {:>10} {:>12} {:>10} {:>6}".format(
+        'dtype', 'bytes', 'mask agree', 'mask moved', 'sparsity', 'acc1', 'ok'))
+    for dtype in dtypes:
+        r = results[dtype]
+        agreement = mask_agreement(r['masks'], ref['masks'])
+        ok = (agreement >= MIN_MASK_AGREEMENT
+              and abs(r['sparsity'] - ref['sparsity']) <= SPARSITY_TOLERANCE
+              and abs(r['acc1'] - ref['acc1']) <= ACCURACY_TOLERANCE
+              and (r['moved'] > 0 or ref['moved'] == 0))
+        print("{:<10} {:>10.1f} {:>10.4f} {:>10.4f} {:>12.2f} {:>10.2f} {:>6}".format(
+            dtype, r['bytes'], agreement, r['moved'], r['sparsity'], r['acc1'], 'yes' if ok else 'NO'))
+
+
+if __name__ == "__main__":
+    main()
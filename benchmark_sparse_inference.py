@@ -0,0 +1,72 @@
+"""
+CPU inference time of the sparse export (utils/sparse_inference.py) against the
+dense masked path (the subnet layers running F.conv2d / F.linear on weight * subnet).
+
+For each arch and density it builds the model from the usual flags, sets an EP mask
+with that density (random scores, the top k% kept), exports it, checks the logits
+and times a batch through both.
+
+Usage (an EP config, the arch in it is overridden):
+    python benchmark_sparse_inference.py --config configs/ep/resnet20/resnet20_sc_ep.yml --batch-size 64
+"""
+import time
+
+import torch
+
+from args_helper import parser_args
+from main_utils import get_model
+from utils.net_utils import set_model_prune_rate
+from utils.sparse_inference import DispatchLayer, export_sparse
+
+
+ARCHS = ['resnet20', 'resnet32', 'vgg16', 'MobileNetV2']
+DENSITIES = [0.5, 0.1, 0.05, 0.01, 0.005]
+REPEATS = 10
+
+
+def time_forward(model, x):
+    with torch.no_grad():
+        model(x)
+        start = time.time()
+        for _ in range(REPEATS):
+            model(x)
+    return (time.time() - start) / REPEATS
+
+
+def main():
+    if parser_args.algo != 'ep':
+        print("benchmark_sparse_inference.py sets the masks EP style, use an --algo ep config (got {})".format(parser_args.algo))
+        return
+
+    torch.manual_seed(parser_args.seed)
+    x = torch.randn(parser_args.batch_size, 3, 32, 32)
+    print("batch size: {}, threads: {}".format(parser_args.batch_size, torch.get_num_threads()))
+
+    rows = []
+    for arch in ARCHS:
+        parser_args.arch = arch
+        model = get_model(parser_args).cpu().eval()
+        for density in DENSITIES:
+            # for ep, prune_rate is the fraction of the scores that is kept
+            set_model_prune_rate(model, density)
+            sparse_model = export_sparse(model)
+
+            with torch.no_grad():
+                # the first forward also probes every layer
+                error = (model(x) - sparse_model(x)).abs().max().item()
+            choices = [m.choice for m in sparse_model.modules() if isinstance(m, DispatchLayer)]
+            num_sparse = '{}/{}'.format(sum(c != 'dense' for c in choices), len(choices))
+
+            t_dense = time_forward(model, x)
+            t_sparse = time_forward(sparse_model, x)
+            rows.append((arch, density, t_dense, t_sparse, num_sparse, error))
+
+    print("{:<12} {:>8} {:>12} {:>12} {:>8} {:>14} {:>10}".format(
+        'arch', 'density', 'dense (ms)', 'sparse (ms)', 'speedup', 'sparse layers', 'max diff'))
+    for arch, density, t_dense, t_sparse, num_sparse, error in rows:
+        print("{:<12} {:>8} {:>12.2f} {:>12.2f} {:>7.2f}x {:>14} {:>10.2e}".format(
+            arch, density, 1000 * t_dense, 1000 * t_sparse, t_dense / t_sparse, num_sparse, error))
+
+
+if __name__ == "__main__":
+    main()
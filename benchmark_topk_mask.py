@@ -0,0 +1,85 @@
+"""
+Microbenchmark for the selection based EP mask (utils/selection.py).
+
+Checks that get_topk_mask gives exactly the same mask as the old sort based
+GetSubnet code (using a stable sort, so ties are broken deterministically)
+and reports the time of both on a few layer shapes from resnet20, ResNet50
+and WideResNet28.
+
+Usage:
+    python benchmark_topk_mask.py [--device cpu] [--repeats 20]
+"""
+import argparse
+import time
+
+import torch
+
+from utils.selection import get_topk_mask
+
+
+LAYER_SHAPES = {
+    'resnet20_conv': (64, 64, 3, 3),
+    'resnet50_conv3x3': (512, 512, 3, 3),
+    'resnet50_conv1x1': (2048, 512, 1, 1),
+    'wideresnet28_conv': (640, 640, 3, 3),
+    'resnet50_fc': (1000, 2048),
+}
+
+
+# this is the mask GetSubnet used to compute for ep
+def sort_topk_mask(scores, k):
+    out = scores.clone()
+    _, idx = scores.flatten().sort(stable=True)
+    j = int((1 - k) * scores.numel())
+    flat_out = out.flatten()
+    flat_out[idx[:j]] = 0
+    flat_out[idx[j:]] = 1
+    return out
+
+
+def time_fn(fn, repeats, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark selection vs sort for EP masks")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    print("{:<20} {:>10} {:>6} {:>12} {:>12} {:>8} {:>6}".format(
+        'layer', 'numel', 'k', 'sort (ms)', 'select (ms)', 'speedup', 'match'))
+    all_match = True
+    for name, shape in LAYER_SHAPES.items():
+        for k in [0.5, 0.05, 0.005]:
+            scores = torch.randn(shape, device=device).abs()
+            # coarse copy of the scores so that we also exercise ties at the threshold
+            tied_scores = (scores * 8).round() / 8
+
+            match = True
+            for s in [scores, tied_scores]:
+                match = match and torch.equal(sort_topk_mask(s, k), get_topk_mask(s, k))
+            all_match = all_match and match
+
+            t_sort = time_fn(lambda: sort_topk_mask(scores, k), args.repeats, device)
+            t_select = time_fn(lambda: get_topk_mask(scores, k), args.repeats, device)
+            print("{:<20} {:>10} {:>6} {:>12.3f} {:>12.3f} {:>7.2f}x {:>6}".format(
+                name, scores.numel(), k, 1000 * t_sort, 1000 * t_select, t_sort / t_select, str(match)))
+
+    print("All masks match: {}".format(all_match))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Pre-materialized evaluation splits (--eval-store).
+
+The val / test loaders decode and normalize every image again on every validate(), and
+main.py validates many times per run. With --eval-store each evaluation split is run
+through its transform once into one contiguous (N, C, H, W) float tensor plus a label
+tensor, and the loader is replaced by an EvalTensorLoader that yields slices of it
+(views, no copy) of --eval-store-batch-size images.
+
+- memory: the tensors are built at startup and kept in (pinned) host memory
+- mmap: the tensors are written once to <--data>/eval_store/ as .npy files and memory
+  mapped on later runs. The file name holds a hash of the dataset and its transform,
+  normalization constants included, so changing them builds a new file (and removes
+  the stale one)
+
+Loaders with random transforms or over a random_split subset are left as they are.
+"""
+import glob
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+
+EVAL_STORE_MODES = ['memory', 'mmap']
+EVAL_LOADERS = ['val_loader', 'actual_val_loader']
+
+
+class EvalTensorLoader(object):
+    # iterates (images, target) slices of the materialized split. `dataset` is the
+    # original dataset, so loader_key() in utils/eval_cache.py sees the same key
+    def __init__(self, dataset, images, targets, batch_size):
+        self.dataset = dataset
+        self.images = images
+        self.targets = targets
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return (self.images.size(0) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, self.images.size(0), self.batch_size):
+            end = start + self.batch_size
+            yield self.images[start:end], self.targets[start:end]
+
+
+def can_store(loader):
+    dataset = loader.dataset
+    if not hasattr(dataset, 'transform'):
+        # random_split subsets, the indices change with the seed
+        return False
+    return 'Random' not in repr(dataset.transform)
+
+
+def store_key(dataset, split):
+    desc = repr((type(dataset).__name__, str(getattr(dataset, 'root', None)), split, len(dataset),
+                 repr(dataset.transform), repr(getattr(dataset, 'target_transform', None))))
+    return hashlib.sha1(desc.encode()).hexdigest()[:16]
+
+
+# runs the split through its transform once, into out_images / out_targets
+def fill(loader, out_images, out_targets, workers):
+    reader = torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size or 256,
+                                         shuffle=False, num_workers=workers)
+    start = 0
+    for images, target in reader:
+        end = start + images.size(0)
+        out_images[start:end] = images
+        out_targets[start:end] = target
+        start = end
+
+
+def materialize(loader, workers):
+    dataset = loader.dataset
+    first, _ = dataset[0]
+    images = torch.empty((len(dataset),) + tuple(first.shape), dtype=first.dtype)
+    targets = torch.empty(len(dataset), dtype=torch.int64)
+    fill(loader, images, targets, workers)
+    if torch.cuda.is_available():
+        images = images.pin_memory()
+        targets = targets.pin_memory()
+    return images, targets
+
+
+def materialize_mmap(loader, store_dir, name, workers):
+    key = store_key(loader.dataset, name)
+    image_path = os.path.join(store_dir, "{}_{}.images.npy".format(name, key))
+    target_path = os.path.join(store_dir, "{}_{}.targets.npy".format(name, key))
+    if not (os.path.exists(image_path) and os.path.exists(target_path)):
+        os.makedirs(store_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(store_dir, "{}_*.npy".format(name))):
+            os.remove(stale)
+        print("=> Building eval store {}".format(image_path))
+        dataset = loader.dataset
+        first, _ = dataset[0]
+        tmp_images, tmp_targets = image_path + ".tmp", target_path + ".tmp"
+        images = np.lib.format.open_memmap(tmp_images, mode='w+', dtype=np.float32,
+                                           shape=(len(dataset),) + tuple(first.shape))
+        targets = np.lib.format.open_memmap(tmp_targets, mode='w+', dtype=np.int64, shape=(len(dataset),))
+        fill(loader, torch.from_numpy(images), torch.from_numpy(targets), workers)
+        images.flush()
+        targets.flush()
+        del images, targets
+        # only complete files get the final name
+        os.replace(tmp_images, image_path)
+        os.replace(tmp_targets, target_path)
+    # copy-on-write maps, so torch gets writable arrays and the files are never touched
+    images = torch.from_numpy(np.load(image_path, mmap_mode='c'))
+    targets = torch.from_numpy(np.load(target_path, mmap_mode='c'))
+    return images, targets
+
+
+def check_eval_store(args):
+    if args.eval_store is not None and args.eval_store not in EVAL_STORE_MODES:
+        raise ValueError("{} is not an eval store mode |memory|mmap|".format(args.eval_store))
+
+
+# replaces the evaluation loaders of a dataset object from data/ by EvalTensorLoaders
+def use_eval_store(dataset, args):
+    batch_size = args.eval_store_batch_size or args.batch_size
+    store_dir = os.path.join(args.data, "eval_store", args.dataset)
+    for name in EVAL_LOADERS:
+        loader = getattr(dataset, name, None)
+        if loader is None or not can_store(loader):
+            continue
+        if args.eval_store == 'mmap':
+            images, targets = materialize_mmap(loader, store_dir, name, args.workers)
+        else:
+            images, targets = materialize(loader, args.workers)
+        print("=> Eval store {}: {} images of {}, {:.1f} MB".format(
+            name, images.size(0), tuple(images.shape[1:]), images.numel() * images.element_size() / 2 ** 20))
+        setattr(dataset, name, EvalTensorLoader(loader.dataset, images, targets, batch_size))
+    return dataset
@@ -20,6 +20,7 @@ import models
 from main import *
 from utils.conv_type import GetSubnet
 from utils.net_utils import get_model_sparsity, get_layer_sparsity, prune
+from utils.subnet_strategies import rebind_strategies
 
 import re
 import yaml
@@ -61,6 +62,9 @@ for ckpt in [ckpt1, ckpt2, ckpt3, ckpt4]:
 # test global ep
 parser_args.algo = 'global_ep'
 parser_args.prune_rate = 0.992
+# the layers bind their forward to the algo they were built with
+rebind_strategies(model)
+set_model_prune_rate(model, parser_args.prune_rate)
 
 # update parser_args.ep_threshold
 prune(model, update_thresholds_only=True)
@@ -0,0 +1,117 @@
+"""
+Evaluates a glob of checkpoints (e.g. the save_checkpoint_at_prune outputs of a run)
+in one process, with one model and one data pipeline.
+
+The model is built once from the usual flags / config. Checkpoints are taken
+--eval-ckpts-per-batch at a time: each one is loaded into the model, rounded (hc:
+--round) or thresholded (global_ep), its sparsity table is taken and its tensors are
+kept on the GPU. Then one pass over the test set swaps the tensors of every checkpoint
+of the group into the model on each batch, so the batch is loaded (and transformed)
+once for the whole group.
+
+Writes one row per checkpoint (top-1 / top-5, loss, sparsity and the density of every
+layer) to --results-filename (default: eval_checkpoints.csv) and reports the throughput
+in checkpoints per minute. Needs a GPU (like main.py).
+
+Usage:
+    python eval_checkpoints.py --config configs/hypercube/resnet20/resnet20_quantized_iter_hc_target_sparsity_0_5_highreg.yml --eval-ckpts "model_checkpoints/ckpts_*/hc_ckpt_at_sparsity_*.pt"
+"""
+import glob
+import time
+
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from args_helper import parser_args
+from main_utils import get_model, get_dataset, set_gpu
+from utils.eval_utils import accuracy
+from utils.eval_worker import load_tensors, model_tensors
+from utils.net_utils import get_model_sparsity, prune, round_scores_, sparsity_table
+
+
+def load_checkpoint(path):
+    ckpt = torch.load(path, map_location='cpu')
+    # save_checkpoint() keeps the state dict under 'state_dict'
+    if 'state_dict' in ckpt:
+        ckpt = ckpt['state_dict']
+    return {k[len('module.'):] if k.startswith('module.') else k: v for k, v in ckpt.items()}
+
+
+# puts a checkpoint in the model the way it is evaluated, returns its tensors and its row
+def prepare(model, path):
+    model.load_state_dict(load_checkpoint(path))
+    if parser_args.algo in ['hc', 'hc_iter']:
+        round_scores_(model, parser_args.round, noise=parser_args.noise, ratio=parser_args.noise_ratio)
+    elif parser_args.algo in ['global_ep', 'global_ep_iter']:
+        prune(model, update_thresholds_only=True)
+    row = {'checkpoint': path}
+    if not parser_args.weight_training:
+        row['sparsity'] = get_model_sparsity(model)
+        for layer in sparsity_table(model):
+            row['density ' + layer['name']] = layer['density']
+    tensors = {name: t.detach().clone() for name, t in model_tensors(model).items()}
+    return tensors, row
+
+
+# (top-1, top-5) and mean loss of every state, the sums stay on the GPU until the end
+def evaluate_group(model, states, data_loader, criterion):
+    sums = None
+    total = 0
+    model.eval()
+    with torch.no_grad():
+        for images, target in data_loader:
+            images = images.cuda(parser_args.gpu, non_blocking=True)
+            target = target.cuda(parser_args.gpu, non_blocking=True)
+            if sums is None:
+                sums = torch.zeros(len(states), 3, dtype=torch.float64, device=target.device)
+            for k, state in enumerate(states):
+                load_tensors(model, state)
+                output = model(images)
+                acc1, acc5 = accuracy(output, target, topk=(1, 5))
+                sums[k, :2] += torch.cat([acc1, acc5]).double() * target.size(0) / 100
+                sums[k, 2] += criterion(output, target).double()
+            total += target.size(0)
+    sums = sums.cpu() / max(total, 1)
+    return 100 * sums[:, :2], sums[:, 2]
+
+
+def main():
+    paths = sorted(glob.glob(parser_args.eval_ckpts or ''))
+    if len(paths) == 0:
+        print("No checkpoint matches --eval-ckpts {}".format(parser_args.eval_ckpts))
+        return
+
+    model = set_gpu(parser_args, get_model(parser_args))
+    data = get_dataset(parser_args)
+    criterion = nn.CrossEntropyLoss(reduction='sum').cuda()
+
+    start = time.time()
+    rows = []
+    group_size = max(1, parser_args.eval_ckpts_per_batch)
+    for i in range(0, len(paths), group_size):
+        states = []
+        for path in paths[i:i + group_size]:
+            print("=> Loading {}".format(path))
+            tensors, row = prepare(model, path)
+            states.append(tensors)
+            rows.append(row)
+        acc, loss = evaluate_group(model, states, data.val_loader, criterion)
+        for k, row in enumerate(rows[i:i + group_size]):
+            row['acc1'], row['acc5'] = acc[k].tolist()
+            row['loss'] = loss[k].item()
+    minutes = (time.time() - start) / 60
+
+    results_df = pd.DataFrame(rows)
+    columns = ['checkpoint', 'acc1', 'acc5', 'loss']
+    results_df = results_df[columns + [c for c in results_df.columns if c not in columns]]
+    results_filename = parser_args.results_filename or 'eval_checkpoints.csv'
+    print(results_df[[c for c in ['checkpoint', 'acc1', 'acc5', 'loss', 'sparsity'] if c in results_df.columns]].to_string(index=False))
+    print("Writing results into: {}".format(results_filename))
+    results_df.to_csv(results_filename, index=False)
+    print("{} checkpoints in {:.2f} min ({:.1f} checkpoints/min), {} per data pass".format(
+        len(paths), minutes, len(paths) / max(minutes, 1e-9), group_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Bit-packed storage for the {0, 1} pruning flags of SubnetConv / SubnetLinear
+(same as utils/bitmask.py, this directory is run on its own).
+
+flag / bias_flag are kept as uint8 buffers (flag_bits / bias_flag_bits) holding
+8 entries per byte, bit i of byte j being entry 8*j + i of the flattened flag.
+`layer.flag` unpacks to a float mask and `layer.flag = mask` packs it, so the
+prune / redraw code that updates flags should assign through the property (or
+use the packed helpers below) instead of writing to `layer.flag.data`.
+"""
+import torch
+
+
+_BIT_WEIGHTS = [1, 2, 4, 8, 16, 32, 64, 128]
+_POPCOUNT = [bin(i).count('1') for i in range(256)]
+
+
+def num_bytes(numel):
+    return (numel + 7) // 8
+
+
+# any tensor of {0, 1} (or bool) -> uint8 tensor of num_bytes(numel) entries
+def pack_bits(mask):
+    flat = mask.detach().reshape(-1).ne(0)
+    pad = num_bytes(flat.numel()) * 8 - flat.numel()
+    if pad > 0:
+        flat = torch.cat([flat, flat.new_zeros(pad)])
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=flat.device)
+    return torch.sum(flat.view(-1, 8).to(torch.uint8) * weights, dim=1, dtype=torch.uint8)
+
+
+def unpack_bits(bits, shape, dtype=torch.float):
+    numel = 1
+    for s in shape:
+        numel *= s
+    weights = torch.tensor(_BIT_WEIGHTS, dtype=torch.uint8, device=bits.device)
+    mask = bits.unsqueeze(-1).bitwise_and(weights).ne(0).view(-1)[:numel]
+    return mask.view(shape).to(dtype)
+
+
+# number of ones in the packed flag
+def count_bits(bits):
+    table = torch.tensor(_POPCOUNT, dtype=torch.uint8, device=bits.device)
+    return table[bits.long()].sum().item()
+
+
+def and_bits(bits, mask):
+    return torch.bitwise_and(bits, pack_bits(mask))
+
+
+# 1 - flag, keeping the padding bits of the last byte at 0
+def invert_bits(bits, numel):
+    out = torch.bitwise_not(bits)
+    pad = num_bytes(numel) * 8 - numel
+    if pad > 0:
+        out[-1] = out[-1].item() & (0xFF >> pad)
+    return out
+
+
+def permute_bits(bits, numel, idx):
+    return pack_bits(unpack_bits(bits, (numel,), torch.bool)[idx])
+
+
+class PackedFlags(object):
+    # mixin for the subnet layers: registers the packed buffers and exposes them as
+    # float `flag` / `bias_flag` tensors of the original shape
+    def init_flags(self, flag_shape, bias_flag_shape):
+        self.flag_shape = tuple(flag_shape)
+        self.bias_flag_shape = tuple(bias_flag_shape)
+        self.register_buffer('flag_bits', pack_bits(torch.ones(self.flag_shape)))
+        self.register_buffer('bias_flag_bits', pack_bits(torch.ones(self.bias_flag_shape)))
+
+    @property
+    def flag(self):
+        return unpack_bits(self.flag_bits, self.flag_shape)
+
+    @flag.setter
+    def flag(self, mask):
+        self.flag_bits = pack_bits(mask).to(self.flag_bits.device)
+
+    @property
+    def bias_flag(self):
+        return unpack_bits(self.bias_flag_bits, self.bias_flag_shape)
+
+    @bias_flag.setter
+    def bias_flag(self, mask):
+        self.bias_flag_bits = pack_bits(mask).to(self.bias_flag_bits.device)
+
+    # checkpoints from before the flags were packed store them as float parameters
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for name in ['flag', 'bias_flag']:
+            if prefix + name in state_dict:
+                state_dict[prefix + name + '_bits'] = pack_bits(state_dict.pop(prefix + name))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
@@ -28,6 +28,7 @@ import torch.autograd as autograd
 import torch.nn.functional as F
 import torchvision.models as torchvision_models
 import models
+from bitmask import and_bits, count_bits
 
 model_names = sorted(name for name in torchvision_models.__dict__
     if name.islower() and not name.startswith("__")
@@ -825,11 +826,11 @@ def prune(model, args, update_thresholds_only=False, update_scores=False):
     active_bias_scores_list = []
 
     for layer in (conv_layers + linear_layers):
-        num_active_weights += layer.flag.data.sum().item()
+        num_active_weights += count_bits(layer.flag_bits)
         active_scores = (layer.scores.data[layer.flag.data == 1]).clone()
         active_scores_list.append(active_scores)
         if args.bias:
-            num_active_biases += layer.bias_flag.data.sum().item()
+            num_active_biases += count_bits(layer.bias_flag_bits)
             active_biases = (
                 layer.bias_scores.data[layer.bias_flag.data == 1]).clone()
             active_bias_scores_list.append(active_biases)
@@ -862,20 +863,20 @@ def prune(model, args, update_thresholds_only=False, update_scores=False):
     else:
         for layer in (conv_layers + linear_layers):
             if args.invert_sanity_check:
-                layer.flag.data = (layer.flag.data + torch.lt(layer.scores.abs(),  # TODO
-                                   torch.ones_like(layer.scores)*scores_threshold).int() == 2).int()
+                layer.flag_bits = and_bits(layer.flag_bits, torch.lt(layer.scores.abs(),  # TODO
+                                           torch.ones_like(layer.scores)*scores_threshold))
             else:
-                layer.flag.data = (layer.flag.data + torch.gt(layer.scores.abs(),  # TODO
-                                   torch.ones_like(layer.scores)*scores_threshold).int() == 2).int()
+                layer.flag_bits = and_bits(layer.flag_bits, torch.gt(layer.scores.abs(),  # TODO
+                                           torch.ones_like(layer.scores)*scores_threshold))
             if update_scores:
                 layer.scores.data = layer.scores.data * layer.flag.data
             if args.bias:
                 if args.invert_sanity_check:
-                    layer.bias_flag.data = (layer.bias_flag.data + torch.lt(layer.bias_scores, torch.ones_like(
-                        layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                    layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.lt(layer.bias_scores, torch.ones_like(
+                        layer.bias_scores)*bias_scores_threshold))
                 else:
-                    layer.bias_flag.data = (layer.bias_flag.data + torch.gt(layer.bias_scores, torch.ones_like(
-                        layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                    layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.gt(layer.bias_scores, torch.ones_like(
+                        layer.bias_scores)*bias_scores_threshold))
                 if update_scores:
                     layer.bias_scores.data = layer.bias_scores.data * layer.bias_flag.data
 
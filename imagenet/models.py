@@ -6,6 +6,8 @@ import numpy as np
 
 import math
 
+from bitmask import PackedFlags
+
 LEARN_THRESHOLD_FLAG = False
 
 # BasicBlock {{{
@@ -438,7 +440,7 @@ class GetSubnet(autograd.Function):
 
 
 # Not learning weights, finding subnet
-class SubnetConv(nn.Conv2d):
+class SubnetConv(PackedFlags, nn.Conv2d):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.args_bias = False
@@ -452,13 +454,12 @@ class SubnetConv(nn.Conv2d):
         if not LEARN_THRESHOLD_FLAG:
             self.quantize_threshold.requires_grad = False
 
-        # initialize flag (representing the pruned weights)
-        self.flag = nn.Parameter(torch.ones(self.weight.size()))
+        # initialize flag (representing the pruned weights), stored bit-packed (see bitmask.py)
         if self.args_bias:
-            self.bias_flag = nn.Parameter(torch.ones(self.bias.size()))
+            self.init_flags(self.weight.size(), self.bias.size())
         else:
-            # dummy variable just so other things don't break
-            self.bias_flag = nn.Parameter(torch.Tensor(1))
+            # dummy bias flag just so other things don't break
+            self.init_flags(self.weight.size(), (1,))
 
         # initialize the scores
         self.scores = nn.Parameter(torch.Tensor(self.weight.size()))
@@ -482,8 +483,6 @@ class SubnetConv(nn.Conv2d):
 
         # NOTE: turn the gradient on the weights off
         self.weight.requires_grad = False
-        self.flag.requires_grad = False
-        self.bias_flag.requires_grad = False
 
     def set_prune_rate(self, prune_rate):
         self.prune_rate = prune_rate
@@ -498,8 +497,8 @@ class SubnetConv(nn.Conv2d):
 
         if self.algo in ['hc', 'hc_iter', 'transformer']:
             subnet, bias_subnet = GetSubnet.apply(self.scores, self.bias_scores, self.quantize_threshold, self.prune_rate)
-            subnet = subnet * self.flag.data.float()
-            bias_subnet = subnet * self.bias_flag.data.float()
+            subnet = subnet * self.flag
+            bias_subnet = subnet * self.bias_flag
         elif self.algo in ['imp']:
             # no STE, no subnet. Mask is handled outside
             pass
@@ -507,8 +506,8 @@ class SubnetConv(nn.Conv2d):
             subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), 0.5, 0, self.scores_prune_threshold, self.bias_scores_prune_threshold)
         elif self.algo in ['pt']:
             subnet, bias_subnet = self.scores, self.bias_scores
-            subnet = subnet * self.flag.data.float()
-            bias_subnet = subnet * self.bias_flag.data.float()
+            subnet = subnet * self.flag
+            bias_subnet = subnet * self.bias_flag
         else:
             # ep, global_ep, global_ep_iter, pt etc
             subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), 0.5, self.prune_rate)
@@ -534,7 +533,7 @@ class SubnetConv(nn.Conv2d):
         return x
 
 
-class SubnetLinear(nn.Linear):
+class SubnetLinear(PackedFlags, nn.Linear):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # TODO: hacky. trying to mimic frankle in having biases but not pruning them
@@ -548,13 +547,12 @@ class SubnetLinear(nn.Linear):
         if not LEARN_THRESHOLD_FLAG:
             self.quantize_threshold.requires_grad = False
 
-        # initialize flag (representing the pruned weights)
-        self.flag = nn.Parameter(torch.ones(self.weight.size()))
+        # initialize flag (representing the pruned weights), stored bit-packed (see bitmask.py)
         if self.args_bias:
-            self.bias_flag = nn.Parameter(torch.ones(self.bias.size()))
+            self.init_flags(self.weight.size(), self.bias.size())
         else:
-            # dummy variable just so other things don't break
-            self.bias_flag = nn.Parameter(torch.Tensor(1))
+            # dummy bias flag just so other things don't break
+            self.init_flags(self.weight.size(), (1,))
 
         # initialize the scores
         self.scores = nn.Parameter(torch.Tensor(self.weight.size()))
@@ -578,8 +576,6 @@ class SubnetLinear(nn.Linear):
 
         # NOTE: turn the gradient on the weights off
         self.weight.requires_grad = False
-        self.flag.requires_grad = False
-        self.bias_flag.requires_grad = False
         # TODO: Hacky. I'm trying to mimic frankle etc in that we have biases, but we don't prune them
         self.bias.requires_grad = False
 
@@ -596,8 +592,8 @@ class SubnetLinear(nn.Linear):
 
         if self.algo in ['hc', 'hc_iter']:
             subnet, bias_subnet = GetSubnet.apply(self.scores, self.bias_scores, self.quantize_threshold, self.prune_rate)
-            subnet = subnet * self.flag.data.float()
-            bias_subnet = subnet * self.bias_flag.data.float()
+            subnet = subnet * self.flag
+            bias_subnet = subnet * self.bias_flag
         elif self.algo in ['imp']:
             # no STE, no subnet. Mask is handled outside
             pass
@@ -605,8 +601,8 @@ class SubnetLinear(nn.Linear):
             subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), 0.5, 0, self.scores_prune_threshold, self.bias_scores_prune_threshold)
         elif self.algo in ['pt']:
             subnet, bias_subnet = self.scores, self.bias_scores
-            subnet = subnet * self.flag.data.float()
-            bias_subnet = subnet * self.bias_flag.data.float()
+            subnet = subnet * self.flag
+            bias_subnet = subnet * self.bias_flag
         else:
             # ep, global_ep, global_ep_iter, pt etc
             subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), 0.5, self.prune_rate)
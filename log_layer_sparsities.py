@@ -10,7 +10,7 @@ import pandas as pd
 
 from main import *
 from utils.conv_type import GetSubnet
-from utils.net_utils import get_model_sparsity, get_layer_sparsity, prune
+from utils.net_utils import get_model_sparsity, sparsity_table, prune
 
 import re
 import yaml
@@ -38,20 +38,14 @@ for sparsity in ['50', '3_72', '1_4', '0_59']:
 	ckpt = torch.load("results/ckpt_resnet20_sp{}_results_trial_1/model_before_finetune.pth".format(sparsity))
 	model.load_state_dict(ckpt)
 	cp_model = round_model(model, 'all_ones')
-	conv_layers, lin_layers = get_layers(arch='resnet20', model=cp_model)
+	table = sparsity_table(cp_model)
 	print("\n\n\n---------------------------------------------------------------------------------------------")
 	print("Overall sparsity: {} === Target sparsity: {}".format(get_model_sparsity(cp_model), sparsity))
 	print("---------------------------------------------------------------------------------------------\n\n\n")
-	for conv_layer in conv_layers:
-	    w_numer, w_denom, b_numer, b_denom = get_layer_sparsity(conv_layer)
-	    print("Layer: {} | {}/{} weights | Sparsity = {}".format(conv_layer, w_numer, w_denom, 100.0*w_numer/w_denom))
-	    sparsity_list.append(100.0*w_numer/w_denom)
+	for row in table:
+	    print("Layer: {} | {}/{} weights | Sparsity = {}".format(row['name'], row['active'], row['total'], row['density']))
+	    sparsity_list.append(row['density'])
 
-
-	for lin_layer in lin_layers:
-	    w_numer, w_denom, b_numer, b_denom = get_layer_sparsity(lin_layer)
-	    print("Layer: {} | {}/{} weights | Sparsity = {}".format(lin_layer, w_numer, w_denom, 100.0*w_numer/w_denom))
-	    sparsity_list.append(100.0*w_numer/w_denom)
 	sparsity_dict[sparsity] = sparsity_list
 
 
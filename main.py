@@ -52,8 +52,8 @@ def main_worker(gpu, ngpus_per_node):
     print_model(model, parser_args)
 
     if parser_args.weight_training:
-        model = round_model(model, round_scheme="all_ones", noise=parser_args.noise,
-                            ratio=parser_args.noise_ratio, rank=parser_args.gpu)
+        model = round_scores_(model, round_scheme="all_ones", noise=parser_args.noise,
+                              ratio=parser_args.noise_ratio)
         model = switch_to_wt(model)
     model = set_gpu(parser_args, model)
     if parser_args.pretrained:
@@ -83,6 +83,9 @@ def main_worker(gpu, ngpus_per_node):
     # optionally resume from a checkpoint
     if parser_args.resume:
         best_acc1 = resume(parser_args, model, optimizer)
+    # low-precision score storage, after the checkpoint is in (utils/score_precision.py)
+    check_score_precision(parser_args)
+    set_score_precision(model, parser_args.score_dtype, optimizer, parser_args.score_master_copy)
     # when we only evaluate a pretrained model
     if parser_args.evaluate:
         evaluate_without_training(
@@ -107,6 +110,8 @@ def main_worker(gpu, ngpus_per_node):
         print("Setting prune_rate to {}".format(parser_args.prune_rate))
     else:
         print("Overriding prune_rate to {}".format(parser_args.prune_rate))
+    # the subnet layers keep their own copy of the prune rate
+    set_model_prune_rate(model, parser_args.prune_rate)
     #if parser_args.dataset == 'TinyImageNet':
     #    print_num_dataset(data)
     if not parser_args.weight_training:
@@ -135,6 +140,8 @@ def main_worker(gpu, ngpus_per_node):
         return
 
 
+    eval_worker = EvalWorker(model, parser_args) if parser_args.eval_worker else None
+
     # Start training
     for epoch in range(parser_args.start_epoch, parser_args.epochs):
         if parser_args.multiprocessing_distributed:
@@ -172,30 +179,12 @@ def main_worker(gpu, ngpus_per_node):
 
         # evaluate on validation set
         start_validation = time.time()
-        if parser_args.algo in ['hc', 'hc_iter']:
-            br_acc1, br_acc5, br_acc10 = validate(
-                data.val_loader, model, criterion, parser_args, writer, epoch)  # before rounding
-            print('Acc before rounding: {}'.format(br_acc1))
-            acc_avg = 0
-            for num_trial in range(parser_args.num_test):
-                cp_model = round_model(model, parser_args.round, noise=parser_args.noise,
-                                       ratio=parser_args.noise_ratio, rank=parser_args.gpu)
-                acc1, acc5, acc10 = validate(
-                    data.val_loader, cp_model, criterion, parser_args, writer, epoch)
-                acc_avg += acc1
-            acc_avg /= parser_args.num_test
-            acc1 = acc_avg
-            print('Acc after rounding: {}'.format(acc1))
-            val_acc1, val_acc5, val_acc10 = validate(
-                    data.val_loader, cp_model, criterion, parser_args, writer, epoch)
-            print('Validation Acc after rounding: {}'.format(val_acc1))
+        if eval_worker is not None:
+            # rounding + validation run in the eval worker, the results are merged in later
+            eval_worker.submit(model, epoch)
+            br_acc1 = acc1 = val_acc1 = None
         else:
-            acc1, acc5, acc10 = validate(
-                data.val_loader, model, criterion, parser_args, writer, epoch)
-            print('Acc: {}'.format(acc1))
-            val_acc1, val_acc5, val_acc10 = validate(
-                data.val_loader, model, criterion, parser_args, writer, epoch)
-            print('Validation Acc: {}'.format(val_acc1))
+            br_acc1, acc1, val_acc1 = evaluate_epoch(model, data, criterion, validate, epoch, writer)
 
         validation_time.update((time.time() - start_validation) / 60)
 
@@ -203,12 +192,15 @@ def main_worker(gpu, ngpus_per_node):
         if not parser_args.weight_training and parser_args.algo in ['hc_iter', 'global_ep_iter'] and epoch % (parser_args.iter_period) == 0 and epoch != 0:
             if parser_args.algo == 'hc_iter':
                 prune(model)
+                if parser_args.active_set_scores:
+                    refresh_active_sets(model, optimizer)
                 if parser_args.checkpoint_at_prune:
                     save_checkpoint_at_prune(model, parser_args)
             elif parser_args.algo == 'global_ep_iter':
                 # just update prune_rate because the pruning happens on forward anyway
                 p = get_prune_rate(parser_args.target_sparsity, parser_args.iter_period)
                 parser_args.prune_rate =  1 - (1-p)**np.floor((epoch+1) / parser_args.iter_period)
+                set_model_prune_rate(model, parser_args.prune_rate)
 
         # get model sparsity
         if not parser_args.weight_training:
@@ -218,9 +210,9 @@ def main_worker(gpu, ngpus_per_node):
                 avg_sparsity = get_model_sparsity(cp_model)
             elif parser_args.algo in ['hc', 'hc_iter']:
                 # Round before checking sparsity
-                cp_model = round_model(model, parser_args.round, noise=parser_args.noise,
-                                       ratio=parser_args.noise_ratio, rank=parser_args.gpu)
-                avg_sparsity = get_model_sparsity(cp_model)
+                with rounded_model(model, parser_args.round, noise=parser_args.noise,
+                                   ratio=parser_args.noise_ratio) as cp_model:
+                    avg_sparsity = get_model_sparsity(cp_model)
             else:
                 avg_sparsity = get_model_sparsity(model)
         else:
@@ -237,6 +229,7 @@ def main_worker(gpu, ngpus_per_node):
             # TODO: Hacky code. Doesn't always work. But quick and easy fix. Just prune all weights to target
             # sparsity, and then continue to finetune so that unflag can do stuff.
             parser_args.prune_rate = 1 - (parser_args.target_sparsity/100)
+            set_model_prune_rate(model, parser_args.prune_rate)
             prune(model)
             break
 
@@ -288,19 +281,17 @@ def main_worker(gpu, ngpus_per_node):
         writer.add_scalar("test/lr", cur_lr, epoch)
         end_epoch = time.time()
 
-        if parser_args.algo in ['hc', 'hc_iter']:
-            results_df = pd.DataFrame({'epoch': epoch_list, 'test_acc_before_rounding': test_acc_before_round_list,
-                                      'test_acc': test_acc_list, 'val_acc': val_acc_list, 'train_acc': train_acc_list, 'regularization_loss': reg_loss_list, 'model_sparsity': model_sparsity_list})
-        else:
-            results_df = pd.DataFrame(
-                {'epoch': epoch_list, 'test_acc': test_acc_list, 'val_acc': val_acc_list, 'train_acc': train_acc_list, 'model_sparsity': model_sparsity_list})
+        if eval_worker is not None:
+            eval_worker.merge(epoch_list, test_acc_before_round_list, test_acc_list, val_acc_list)
+        write_acc_and_sparsity(result_root, epoch_list, test_acc_before_round_list, test_acc_list,
+                               val_acc_list, train_acc_list, reg_loss_list, model_sparsity_list)
 
-        if parser_args.results_filename:
-            results_filename = parser_args.results_filename
-        else:
-            results_filename = result_root + 'acc_and_sparsity.csv'
-        print("Writing results into: {}".format(results_filename))
-        results_df.to_csv(results_filename, index=False)
+    if eval_worker is not None:
+        # wait for the evaluations still in flight
+        eval_worker.close()
+        eval_worker.merge(epoch_list, test_acc_before_round_list, test_acc_list, val_acc_list)
+        write_acc_and_sparsity(result_root, epoch_list, test_acc_before_round_list, test_acc_list,
+                               val_acc_list, train_acc_list, reg_loss_list, model_sparsity_list)
 
     # save checkpoint before fine-tuning
     #torch.save(model.state_dict(), result_root + 'model_before_finetune.pth')
@@ -322,6 +313,11 @@ def main_worker(gpu, ngpus_per_node):
     else:
         print("Skipping finetuning!!!")
 
+    if parser_args.compact_model:
+        compact_and_save(cp_model, validate, parser_args, data, criterion, result_root)
+    if parser_args.sparse_export:
+        sparse_export_and_save(cp_model, parser_args, data, result_root)
+
     if not parser_args.skip_sanity_checks:
         do_sanity_checks(model, parser_args, data, criterion, epoch_list, test_acc_before_round_list,
                          test_acc_list, val_acc_list, train_acc_list, reg_loss_list, model_sparsity_list, result_root)
@@ -330,6 +326,10 @@ def main_worker(gpu, ngpus_per_node):
         print("Skipping sanity checks!!!")
 
     print("\n\nEnd of process. Exiting")
+    if parser_args.eval_cache:
+        EVAL_CACHE.print_stats()
+    if parser_args.prefix_cache is not None:
+        PREFIX_CACHE.print_stats()
     print_time()
 
     if parser_args.multiprocessing_distributed:
@@ -23,8 +23,7 @@ from utils import data
 from utils.train_test import prune_weights, prune_activations, inference, train, simulated_annealing
 from utils.net_utils import get_sparsity, flip, zero_one_loss
 from utils.mask_layers import MaskLinear, MaskConv
-from utils.conv_type import GetSubnet as GetSubnetConv
-from utils.linear_type import GetSubnet as GetSubnetLinear
+from utils.selection import get_topk_mask
 import models.greedy as models
 
 from args import args
@@ -123,11 +122,10 @@ def main():
         ep_model = models.__dict__['TwoLayerFC_EP'](data.INPUT_SIZE, data.NUM_CLASSES, args).to(device)
         ep_model.load_state_dict(torch.load(args.pretrained))
         for name, child in model.named_children():
-            if isinstance(child, MaskLinear):
-                mask_weight, mask_bias = GetSubnetLinear.apply(getattr(ep_model, name).scores.abs(), getattr(ep_model, name).bias_scores.abs(), args.prune_rate)
-                child.set_fixed_mask(mask_weight, mask_bias)
-            elif isinstance(child, MaskConv):
-                mask_weight, mask_bias = GetSubnetConv.apply(getattr(ep_model, name).scores.abs(), getattr(ep_model, name).bias_scores.abs(), args.prune_rate)
+            if isinstance(child, (MaskLinear, MaskConv)):
+                # same top-k masks as GetSubnet's ep branch
+                mask_weight = get_topk_mask(getattr(ep_model, name).scores.abs(), args.prune_rate)
+                mask_bias = get_topk_mask(getattr(ep_model, name).bias_scores.abs(), args.prune_rate)
                 child.set_fixed_mask(mask_weight, mask_bias)
             child.weight = getattr(ep_model, name).weight
             if args.bias:
@@ -33,6 +33,8 @@ from utils.net_utils import (
     get_lr,
     LabelSmoothing,
     round_model,
+    round_scores_,
+    rounded_model,
     get_model_sparsity,
     prune,
     redraw,
@@ -40,12 +42,26 @@ from utils.net_utils import (
     get_prune_rate,
 )
 from utils.schedulers import get_scheduler
+from utils.seeded_init import check_seeded_weights, materialize_weights
+from utils.subnet_strategies import keep_classifier_channels
+from utils.compaction import compact_model, compaction_error
+from utils.sparse_inference import export_sparse, print_dispatch
+from utils.active_set import refresh_active_sets
+from utils.score_precision import check_score_precision, set_score_precision
+from utils.score_params import check_score_params, factorize_model_scores
+from utils.prob_rounding import evaluate_prob_rounding, sample_seeds
+from utils.eval_cache import EVAL_CACHE
+from utils.prefix_cache import PREFIX_CACHE, check_prefix_cache
+from utils.seq_eval import SequentialValidate
+from utils.eval_worker import EvalWorker
+from utils.score_arena import attach_score_arena, check_score_arena
 from utils.utils import set_seed, plot_histogram_scores
 from SmartRatio import SmartRatio
 
 import importlib
 
 import data
+from data.eval_store import check_eval_store, use_eval_store
 import models
 
 import copy
@@ -122,9 +138,9 @@ def save_checkpoint_at_prune(model, parser_args):
     # let's see if we can get all sparsity plots with one run
     # save checkpoints at every pruned model so that we can finetune later
     # save checkpoint for later debug
-    cp_model = round_model(model, parser_args.round, noise=parser_args.noise,
-                           ratio=parser_args.noise_ratio, rank=parser_args.gpu)
-    avg_sparsity = get_model_sparsity(cp_model)
+    with rounded_model(model, parser_args.round, noise=parser_args.noise,
+                       ratio=parser_args.noise_ratio) as cp_model:
+        avg_sparsity = get_model_sparsity(cp_model)
     idty_str = get_idty_str(parser_args)
     if not os.path.isdir('model_checkpoints/'):
         os.mkdir('model_checkpoints/')
@@ -232,6 +248,113 @@ def eval_and_print(validate, data_loader, model, criterion, parser_args, writer=
     return acc1
 
 
+# drops the dead channels of the (finetuned) subnet, checks the logits against the masked model
+# and saves the result as a plain dense module (the shapes change, so not as a state dict)
+def compact_and_save(model, validate, parser_args, data, criterion, result_root):
+    compact = compact_model(model, parser_args.arch)
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    images, _ = next(iter(data.val_loader))
+    images = images.to(next(model.parameters()).device)
+    print("Max logit difference after compaction: {}".format(compaction_error(model, compact, images)))
+    eval_and_print(validate, data.val_loader, compact, criterion, parser_args, description='compacted model')
+    torch.save(compact, result_root + 'model_compact.pth')
+    return compact
+
+
+# sparse inference copy of the model and its logits on images (dense masked path)
+def export_with_logits(model, images):
+    sparse = export_sparse(model)
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    model.eval()
+    with torch.no_grad():
+        logits = model(images.to(next(model.parameters()).device)).cpu()
+    return sparse, logits
+
+
+# exports the subnet for sparse CPU inference (utils/sparse_inference.py), checks the logits
+# against the masked model on a validation batch (which also probes the dense / sparse choice
+# of every layer) and saves it. hc scores are rounded with --round first, as evaluate_epoch does
+def sparse_export_and_save(model, parser_args, data, result_root):
+    images, _ = next(iter(data.val_loader))
+    if parser_args.algo in ['hc', 'hc_iter']:
+        with rounded_model(model, parser_args.round, noise=parser_args.noise,
+                           ratio=parser_args.noise_ratio) as cp_model:
+            sparse, logits = export_with_logits(cp_model, images)
+    else:
+        sparse, logits = export_with_logits(model, images)
+    with torch.no_grad():
+        error = (sparse(images.cpu()) - logits).abs().max().item()
+    print("Max logit difference after the sparse export: {}".format(error))
+    print_dispatch(sparse)
+    torch.save(sparse, result_root + 'model_sparse.pth')
+    return sparse
+
+
+# test acc before rounding (hc only, None otherwise), test acc and validation acc of the
+# model at the end of an epoch of score training
+def evaluate_epoch(model, data, criterion, validate, epoch, writer=None):
+    br_acc1 = None
+    if parser_args.algo in ['hc', 'hc_iter']:
+        br_acc1, br_acc5, br_acc10 = validate(
+            data.val_loader, model, criterion, parser_args, writer, epoch)  # before rounding
+        print('Acc before rounding: {}'.format(br_acc1))
+        if parser_args.round == 'prob' and not parser_args.noise:
+            # every sample in one pass over the data (utils/prob_rounding.py)
+            seeds = sample_seeds(parser_args.seed + epoch * parser_args.num_test, parser_args.num_test)
+            result = evaluate_prob_rounding(model, data.val_loader, seeds, parser_args.gpu)
+            print('Acc of each rounding: {}'.format(result['acc1']))
+            print('Mean pairwise Hamming distance: {}'.format(
+                result['hamming'].sum() / max(len(seeds) * (len(seeds) - 1), 1)))
+            acc1 = result['mean_acc1']
+            # validation acc of the last rounding
+            val_acc1 = result['acc1'][-1]
+            print('Acc after rounding: {}'.format(acc1))
+            print('Validation Acc after rounding: {}'.format(val_acc1))
+        else:
+            acc_avg = 0
+            for num_trial in range(parser_args.num_test):
+                with rounded_model(model, parser_args.round, noise=parser_args.noise,
+                                   ratio=parser_args.noise_ratio) as cp_model:
+                    acc1, acc5, acc10 = validate(
+                        data.val_loader, cp_model, criterion, parser_args, writer, epoch)
+                    acc_avg += acc1
+                    if num_trial == parser_args.num_test - 1:
+                        # validation acc of the last rounding
+                        val_acc1, val_acc5, val_acc10 = validate(
+                                data.val_loader, cp_model, criterion, parser_args, writer, epoch)
+            acc_avg /= parser_args.num_test
+            acc1 = acc_avg
+            print('Acc after rounding: {}'.format(acc1))
+            print('Validation Acc after rounding: {}'.format(val_acc1))
+    else:
+        acc1, acc5, acc10 = validate(
+            data.val_loader, model, criterion, parser_args, writer, epoch)
+        print('Acc: {}'.format(acc1))
+        val_acc1, val_acc5, val_acc10 = validate(
+            data.val_loader, model, criterion, parser_args, writer, epoch)
+        print('Validation Acc: {}'.format(val_acc1))
+
+    return br_acc1, acc1, val_acc1
+
+
+def write_acc_and_sparsity(result_root, epoch_list, test_acc_before_round_list, test_acc_list, val_acc_list, train_acc_list, reg_loss_list, model_sparsity_list):
+    if parser_args.algo in ['hc', 'hc_iter']:
+        results_df = pd.DataFrame({'epoch': epoch_list, 'test_acc_before_rounding': test_acc_before_round_list,
+                                  'test_acc': test_acc_list, 'val_acc': val_acc_list, 'train_acc': train_acc_list, 'regularization_loss': reg_loss_list, 'model_sparsity': model_sparsity_list})
+    else:
+        results_df = pd.DataFrame(
+            {'epoch': epoch_list, 'test_acc': test_acc_list, 'val_acc': val_acc_list, 'train_acc': train_acc_list, 'model_sparsity': model_sparsity_list})
+
+    if parser_args.results_filename:
+        results_filename = parser_args.results_filename
+    else:
+        results_filename = result_root + 'acc_and_sparsity.csv'
+    print("Writing results into: {}".format(results_filename))
+    results_df.to_csv(results_filename, index=False)
+
+
 def finetune(model, parser_args, data, criterion, old_epoch_list, old_test_acc_before_round_list, old_test_acc_list, old_val_acc_list, old_train_acc_list, old_reg_loss_list, old_model_sparsity_list, result_root, shuffle=False, reinit=False, invert=False, chg_mask=False, chg_weight=False):
     epoch_list = copy.deepcopy(old_epoch_list)
     test_acc_before_round_list = copy.deepcopy(old_test_acc_before_round_list)
@@ -249,14 +372,15 @@ def finetune(model, parser_args, data, criterion, old_epoch_list, old_test_acc_b
     elif parser_args.algo in ['hc', 'hc_iter']:
         if parser_args.unflag_before_finetune:
             # want to ensure that all weights are available to train, except for those that have been pruned
-            model = round_model(model, round_scheme="all_ones", noise=parser_args.noise,
-                                ratio=parser_args.noise_ratio, rank=parser_args.gpu)
+            # (model is already a copy, it is rounded in place)
+            model = round_scores_(model, round_scheme="all_ones", noise=parser_args.noise,
+                                  ratio=parser_args.noise_ratio)
             # check sparsity
             post_round_sparsity = get_model_sparsity(model)
         else:
             # round the score (in the model itself)
-            model = round_model(model, round_scheme=parser_args.round, noise=parser_args.noise,
-                                ratio=parser_args.noise_ratio, rank=parser_args.gpu)
+            model = round_scores_(model, round_scheme=parser_args.round, noise=parser_args.noise,
+                                  ratio=parser_args.noise_ratio)
             post_round_sparsity = get_model_sparsity(model)
     elif parser_args.algo in ['ep', 'global_ep', 'global_ep_iter']:
         post_round_sparsity = get_model_sparsity(model)
@@ -428,44 +552,34 @@ def get_settings(parser_args):
 
 def compare_rounding(validate, data_loader, model, criterion, parser_args, result_root):
 
-    # generate supermask from naive rounding
-    naive_model = round_model(model, 'naive')
-    naive_mask, _ = get_mask(naive_model)
-
-    idx_list, test_acc_list, dist_list, mask_list = [], [], [], []
+    # 10 probabilistic roundings in one pass over the data, and the Hamming distances / IoUs
+    # between them and to the naive rounding (the last row / column, utils/mask_distance.py)
     n_rand = 10
-    for i in range(n_rand):
-        # generate supermask from probabilistic rounding
-        prob_model = round_model(model, 'prob')
-        # prob_model = round_model(model, 'naive_prob')
-
-        # evaluate and check the hamming distance btw naive_model & prob_model
-        acc1 = eval_and_print(validate, data_loader, prob_model, criterion,
-                              parser_args, description='probabilistic model {}'.format(i))
-        idx_list.append(i)
-        test_acc_list.append(acc1)
+    seeds = sample_seeds(parser_args.seed, n_rand)
+    result = evaluate_prob_rounding(model, data_loader, seeds, parser_args.gpu,
+                                    threshold=parser_args.quantize_threshold)
+    for i, acc1 in enumerate(result['acc1']):
+        print('probabilistic model {} (seed {}): {}'.format(i, seeds[i], acc1))
 
-        prob_mask, _ = get_mask(prob_model)
-        hamm_dist = torch.sum(
-            torch.abs(naive_mask - prob_mask))/len(naive_mask)
-        dist_list.append(hamm_dist.data.item())
-        mask_list.append(prob_mask.data)
+    idx_list = list(range(n_rand))
+    test_acc_list = result['acc1']
+    dist_list = result['hamming'][:n_rand, n_rand].tolist()
+    iou_list = result['iou'][:n_rand, n_rand].tolist()
 
     # save the result in the dataframe
     compare_df = pd.DataFrame(
-        {'idx': idx_list, 'test_acc': test_acc_list, 'hamming dist to naive': dist_list})
+        {'idx': idx_list, 'test_acc': test_acc_list, 'hamming dist to naive': dist_list,
+         'iou with naive': iou_list})
     results_filename = result_root + 'compare_rounding.csv'
     print("Writing rounding compare results into: {}".format(results_filename))
     compare_df.to_csv(results_filename, index=False)
 
-    compare_prob = np.zeros((10, 10))
-    for i in range(n_rand):
-        for j in range(n_rand):
-            compare_prob[i, j] = torch.sum(
-                torch.abs(mask_list[i] - mask_list[j])/len(mask_list[i]))
+    compare_prob = result['hamming'][:n_rand, :n_rand]
     print(compare_prob)
     pd.DataFrame(compare_prob).to_csv(
         result_root + 'compare_probs.csv', header=None, index=False)
+    pd.DataFrame(result['iou'][:n_rand, :n_rand]).to_csv(
+        result_root + 'compare_probs_iou.csv', header=None, index=False)
 
     return
 
@@ -476,6 +590,14 @@ def switch_to_wt(model):
 
     # this is for the case considering finetune loss
     parser_args.lam_finetune_loss = 0
+    if parser_args.seeded_weights:
+        # seeded layers don't have a weight parameter to train yet. DDP has to be
+        # rebuilt so that it knows about the new parameters
+        if isinstance(model, nn.parallel.DistributedDataParallel):
+            model = nn.parallel.DistributedDataParallel(
+                materialize_weights(model.module), device_ids=[parser_args.gpu], find_unused_parameters=True)
+        else:
+            model = materialize_weights(model)
     for name, params in model.named_parameters():
         # make sure param_name ends with .weight or .bias
         if re.match('.*\.weight', name):
@@ -880,7 +1002,18 @@ def get_trainer(parser_args):
     print(f"=> Using trainer from trainers.{parser_args.trainer}")
     trainer = importlib.import_module(f"trainers.{parser_args.trainer}")
 
-    return trainer.train, trainer.validate, trainer.modifier
+    validate = trainer.validate
+    if parser_args.prefix_cache is not None:
+        check_prefix_cache(parser_args)
+        PREFIX_CACHE.configure(parser_args.prefix_cache, os.path.join(parser_args.data, "prefix_cache"))
+        validate = PREFIX_CACHE.wrap(validate)
+    if parser_args.eval_cache:
+        validate = EVAL_CACHE.wrap(validate)
+    if parser_args.seq_eval:
+        # outside the cache, so that only exact results are cached
+        validate = SequentialValidate(validate, parser_args.seq_eval_ci, parser_args.seq_eval_confidence,
+                                      seed=parser_args.seed).wrap()
+    return trainer.train, validate, trainer.modifier
 
 
 def set_gpu(parser_args, model):
@@ -962,6 +1095,9 @@ def pretrained(path, model):
 def get_dataset(parser_args):
     print(f"=> Getting {parser_args.dataset} dataset")
     dataset = getattr(data, parser_args.dataset)(parser_args)
+    if parser_args.eval_store is not None:
+        check_eval_store(parser_args)
+        use_eval_store(dataset, parser_args)
 
     return dataset
 
@@ -973,6 +1109,8 @@ def get_model(parser_args):
     print("=> Creating model '{}'".format(parser_args.arch))
     if parser_args.fixed_init:
         set_seed(parser_args.seed_fixed_init)
+    if parser_args.seeded_weights:
+        check_seeded_weights(parser_args)
     if parser_args.arch in ['Conv4', 'Conv4Normal']:
         model = models.__dict__[parser_args.arch](width=parser_args.width)
     else:
@@ -980,6 +1118,15 @@ def get_model(parser_args):
     if parser_args.fixed_init:
         set_seed(parser_args.seed)
 
+    # ChannelSubnetConv: don't prune the classes away
+    keep_classifier_channels(model)
+
+    # hashed / low-rank scores instead of one score per weight
+    if parser_args.score_param != 'dense':
+        check_score_params(parser_args)
+        factorize_model_scores(model, parser_args.score_param, parser_args.score_hash_buckets,
+                               parser_args.score_rank, parser_args.seed)
+
     if not parser_args.weight_training:
         # applying sparsity to the network
         if (
@@ -999,6 +1146,11 @@ def get_model(parser_args):
         if parser_args.freeze_weights:
             freeze_model_weights(model)
 
+    # scores / flags of all the subnet layers in one flat buffer each
+    if parser_args.score_arena:
+        check_score_arena(parser_args)
+        attach_score_arena(model)
+
     return model
 
 
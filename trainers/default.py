@@ -7,6 +7,7 @@ import pdb
 from utils.eval_utils import accuracy
 from utils.logging import AverageMeter, ProgressMeter
 from utils.net_utils import get_regularization_loss, prune, get_layers
+from utils.score_arena import get_score_arena
 
 from torch import optim
 
@@ -50,11 +51,15 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler
             prune(model, update_thresholds_only=True)
 
         if args.algo in ['hc', 'hc_iter', 'pt'] and i % args.project_freq == 0 and not args.differentiate_clamp:
-            for name, params in model.named_parameters():
-                if "score" in name:
-                    scores = params
-                    with torch.no_grad():
-                        scores.data = torch.clamp(scores.data, 0.0, 1.0)
+            arena = get_score_arena(model)
+            if arena is not None:
+                arena.clamp_(0.0, 1.0)
+            else:
+                for name, params in model.named_parameters():
+                    if "score" in name:
+                        scores = params
+                        with torch.no_grad():
+                            scores.data = torch.clamp(scores.data, 0.0, 1.0)
 
         # compute output
         if scaler is None:
@@ -111,11 +116,15 @@ def train(train_loader, model, criterion, optimizer, epoch, args, writer, scaler
     if args.algo in ['global_ep', 'global_ep_iter']:
         prune(model, update_thresholds_only=True)
     if args.algo in ['hc', 'hc_iter', 'pt'] and not args.differentiate_clamp:
-        for name, params in model.named_parameters():
-            if "score" in name:
-                scores = params
-                with torch.no_grad():
-                    scores.data = torch.clamp(scores.data, 0.0, 1.0)
+        arena = get_score_arena(model)
+        if arena is not None:
+            arena.clamp_(0.0, 1.0)
+        else:
+            for name, params in model.named_parameters():
+                if "score" in name:
+                    scores = params
+                    with torch.no_grad():
+                        scores.data = torch.clamp(scores.data, 0.0, 1.0)
     # if args.iter_ep and (epoch+1)%args.iter_period == 0:
     #   args.prune_rate *= args.prune_rate # iteratively reduce the prune rate (for checking the ablation study)
 
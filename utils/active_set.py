@@ -0,0 +1,62 @@
+"""
+Active-set score training for hc / hc_iter (--active-set-scores).
+
+With hc the flag multiplies the scores in the forward, so once prune() sets a flag to 0
+that score gets no gradient and can never matter again. After each prune,
+refresh_active_sets() gives every layer the flat indices of its live entries
+(active_idx) and a compact trainable copy of those scores (active_scores), and swaps
+it into the optimizer (moving the optimizer state along). The score gradient is only
+computed at the live entries (ActiveMaskedWeight in utils/masked_ops.py) and the
+optimizer only updates those. The full `scores` stay the reference everything else
+reads (prune, round_model, checkpoints): they are frozen and get the live values
+written back after every optimizer step.
+
+The pruned scores are no longer touched by weight decay / momentum, which changes
+their values but not the masks (their flag is 0 everywhere they are used).
+"""
+import torch
+import torch.nn as nn
+
+from utils.net_utils import swap_optimizer_param
+from utils.subnet_strategies import SubnetStrategyLayer, ChannelSubnetLayer, HCStrategy
+
+
+def active_set_layers(model):
+    return [m for m in model.modules() if isinstance(m, SubnetStrategyLayer)
+            and not isinstance(m, ChannelSubnetLayer) and isinstance(m.strategy, HCStrategy)]
+
+
+def sync_active_scores(model):
+    for m in active_set_layers(model):
+        m.sync_active_scores()
+
+
+# call after every prune() that changes the flags
+def refresh_active_sets(model, optimizer):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        raise ValueError("--active-set-scores does not support distributed training")
+
+    num_live = num_total = 0
+    for m in active_set_layers(model):
+        idx = torch.nonzero(m.flag.reshape(-1)).squeeze(1)
+        if m.active_idx is None:
+            old, pos = m.scores, idx
+        else:
+            # the live set only shrinks, so the new entries are a subset of the old ones
+            old, pos = m.active_scores, torch.searchsorted(m.active_idx, idx)
+        new = nn.Parameter(old.detach().reshape(-1)[pos].clone())
+        # the optimizer state is gathered at the live entries too
+        swap_optimizer_param(optimizer, old, new, lambda v, pos=pos: v.reshape(-1)[pos].clone())
+
+        m.scores.requires_grad = False
+        m.scores.grad = None
+        m.active_idx = idx
+        m.active_scores = new
+        m.mask_cache.clear()
+        num_live += idx.numel()
+        num_total += m.scores.numel()
+
+    if not hasattr(optimizer, 'active_set_hook'):
+        optimizer.active_set_hook = optimizer.register_step_post_hook(
+            lambda opt, args, kwargs: sync_active_scores(model))
+    print("=> Active set: training {}/{} scores".format(num_live, num_total))
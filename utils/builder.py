@@ -1,21 +1,34 @@
 from args_helper import parser_args
-import math
 
-import torch
 import torch.nn as nn
 
 import utils.conv_type
 import utils.bn_type
-from utils.linear_type import SubnetLinear
+from utils.linear_type import SubnetLinear, ChannelSubnetLinear
+from utils.seeded_init import SeededWeight, SeededWeights, init_weight, seeded_construction
+
+# linear layer that goes with a conv_type (SubnetLinear for the rest)
+LINEAR_TYPES = {
+    'ChannelSubnetConv': ChannelSubnetLinear,
+}
+
 
 class Builder(object):
-    def __init__(self, conv_layer, bn_layer, first_layer=None):
+    def __init__(self, conv_layer, bn_layer, first_layer=None, linear_layer=SubnetLinear):
         self.conv_layer = conv_layer
         self.bn_layer = bn_layer
         self.first_layer = first_layer or conv_layer
+        self.linear_layer = linear_layer
+
+    # with --seeded-weights the layers skip the default draw of their weight (see utils/seeded_init.py)
+    def _construct(self, layer_type):
+        def construct(*args, **kwargs):
+            with seeded_construction(parser_args.seeded_weights):
+                return layer_type(*args, **kwargs)
+        return construct
 
     def conv(self, kernel_size, in_planes, out_planes, stride=1, first_layer=False, groups=1):
-        conv_layer = self.first_layer if first_layer else self.conv_layer
+        conv_layer = self._construct(self.first_layer if first_layer else self.conv_layer)
 
         if first_layer:
             print(f"==> Building first layer")
@@ -71,7 +84,7 @@ class Builder(object):
         return c
 
     def linear(self, in_planes, out_planes):
-        l = SubnetLinear(in_planes, out_planes, bias=parser_args.bias)
+        l = self._construct(self.linear_layer)(in_planes, out_planes, bias=parser_args.bias)
         self._init_conv(l)
         return l
 
@@ -95,57 +108,20 @@ class Builder(object):
             raise ValueError(f"{args.nonlinearity} is not an initialization option!")
 
     def _init_conv(self, conv):
-        if parser_args.init == "signed_constant":
-
-            fan = nn.init._calculate_correct_fan(conv.weight, parser_args.mode)
-            if parser_args.scale_fan:
-                fan = fan * (1 - parser_args.prune_rate)
-            gain = nn.init.calculate_gain(parser_args.nonlinearity)
-            std = gain / math.sqrt(fan)
-            conv.weight.data = conv.weight.data.sign() * std
-
-        elif parser_args.init == "unsigned_constant":
-
-            fan = nn.init._calculate_correct_fan(conv.weight, parser_args.mode)
-            if parser_args.scale_fan:
-                fan = fan * (1 - parser_args.prune_rate)
-
-            gain = nn.init.calculate_gain(parser_args.nonlinearity)
-            std = gain / math.sqrt(fan)
-            conv.weight.data = torch.ones_like(conv.weight.data) * std
-
-        elif parser_args.init == "kaiming_normal":
-
-            if parser_args.scale_fan:
-                fan = nn.init._calculate_correct_fan(conv.weight, parser_args.mode)
-                fan = fan * (1 - parser_args.prune_rate)
-                gain = nn.init.calculate_gain(parser_args.nonlinearity)
-                std = gain / math.sqrt(fan)
-                with torch.no_grad():
-                    conv.weight.data.normal_(0, std)
-            else:
-                nn.init.kaiming_normal_(
-                    conv.weight, mode=parser_args.mode, nonlinearity=parser_args.nonlinearity
-                )
-
-        elif parser_args.init == "kaiming_uniform":
-            nn.init.kaiming_uniform_(
-                conv.weight, mode=parser_args.mode, nonlinearity=parser_args.nonlinearity
-            )
-        elif parser_args.init == "xavier_normal":
-            nn.init.xavier_normal_(conv.weight)
-        elif parser_args.init == "xavier_constant":
+        if parser_args.seeded_weights and isinstance(conv, SeededWeights):
+            self._init_seeded(conv)
+            return
 
-            fan_in, fan_out = nn.init._calculate_fan_in_and_fan_out(conv.weight)
-            std = math.sqrt(2.0 / float(fan_in + fan_out))
-            conv.weight.data = conv.weight.data.sign() * std
+        conv.weight.data = init_weight(conv.weight.data, parser_args.init, parser_args.mode, parser_args.nonlinearity,
+                                       parser_args.scale_fan, parser_args.prune_rate)
 
-        elif parser_args.init == "standard":
-
-            nn.init.kaiming_uniform_(conv.weight, a=math.sqrt(5))
-
-        else:
-            raise ValueError(f"{parser_args.init} is not an initialization option!")
+    # the weight is never stored, the layer keeps the generator state its init draws from and
+    # replays the same ops (see utils/seeded_init.py)
+    def _init_seeded(self, conv):
+        conv.seed_weight(SeededWeight.record(
+            conv.weight.shape, conv.weight.dtype, parser_args.init,
+            (parser_args.mode, parser_args.nonlinearity, parser_args.scale_fan, parser_args.prune_rate),
+            conv.reset_rng_state))
 
 
 def get_builder():
@@ -162,6 +138,8 @@ def get_builder():
     else:
         first_layer = None
 
-    builder = Builder(conv_layer=conv_layer, bn_layer=bn_layer, first_layer=first_layer)
+    linear_layer = LINEAR_TYPES.get(parser_args.conv_type, SubnetLinear)
+
+    builder = Builder(conv_layer=conv_layer, bn_layer=bn_layer, first_layer=first_layer, linear_layer=linear_layer)
 
     return builder
@@ -0,0 +1,240 @@
+"""
+Physical channel compaction of a (rounded / pruned) subnetwork into a smaller dense model.
+
+compact_model() copies the model, swaps every conv for a plain nn.Conv2d holding the
+weights the forward effectively uses (weight * subnet) and every batchnorm for a plain
+nn.BatchNorm2d, and then shrinks the channels between a conv and the next conv
+("chains", given per arch below) where it can do so exactly (in eval mode):
+
+- the consumer conv has an all-zero input slice for the channel: the channel is unused
+- the channel is spatially constant at the consumer's input (its producer filters are
+  all zero, so it is just what batchnorm / relu make of the bias): dropped if that
+  constant is 0, otherwise folded into the consumer's bias when the consumer has no
+  padding (with padding the constant doesn't reach the borders, so the channel is kept)
+
+The channels of the residual streams (resnet stages, mobilenet blocks) and the inputs /
+outputs of the model are left alone, they are shared by several layers.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+from args_helper import parser_args
+from utils.subnet_strategies import SubnetStrategyLayer
+from utils.net_utils import update_forward_thresholds
+
+
+def get_module(model, name):
+    for part in name.split('.'):
+        model = getattr(model, part)
+    return model
+
+
+def set_module(model, name, module):
+    parent_name, _, child = name.rpartition('.')
+    parent = get_module(model, parent_name) if parent_name else model
+    setattr(parent, child, module)
+
+
+def make_conv(conv, weight, bias, groups=1):
+    new = nn.Conv2d(weight.size(1) * groups, weight.size(0), conv.kernel_size, stride=conv.stride,
+                    padding=conv.padding, dilation=conv.dilation, groups=groups, bias=bias is not None,
+                    padding_mode=conv.padding_mode).to(weight.device)
+    with torch.no_grad():
+        new.weight.copy_(weight)
+        if bias is not None:
+            new.bias.copy_(bias)
+    return new
+
+
+def make_batchnorm(bn, keep=None):
+    num_features = bn.num_features if keep is None else len(keep)
+    new = nn.BatchNorm2d(num_features, eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                         track_running_stats=bn.track_running_stats)
+    state = bn.state_dict()
+    if keep is not None:
+        state = {k: (v[keep] if v.dim() > 0 else v) for k, v in state.items()}
+    if len(state) > 0:
+        new.to(next(iter(state.values())).device)
+    new.load_state_dict(state)
+    return new
+
+
+# plain nn.Conv2d / nn.BatchNorm2d with the weights the forward effectively uses
+def densify(model):
+    for name, m in list(model.named_modules()):
+        if isinstance(m, nn.Conv2d):
+            if isinstance(m, SubnetStrategyLayer):
+                w, b = m.effective_weights()
+            else:
+                w, b = m.weight, m.bias
+            w = w.detach().clone()
+            b = None if b is None else b.detach().clone()
+            set_module(model, name, make_conv(m, w, b, m.groups))
+        elif isinstance(m, nn.BatchNorm2d):
+            set_module(model, name, make_batchnorm(m))
+    return model
+
+
+def is_pointwise(conv):
+    # a spatially constant input gives a spatially constant output
+    return all(p == 0 for p in conv.padding)
+
+
+# value of each channel after bn + relu. None = depends on the input, float = constant
+def bn_relu(values, bn):
+    out = []
+    for c, v in enumerate(values):
+        if v is not None and bn is not None:
+            if bn.running_mean is not None:
+                v = (v - bn.running_mean[c].item()) / (bn.running_var[c].item() + bn.eps) ** 0.5
+            else:
+                # batch statistics: a constant channel normalizes to 0
+                v = 0.0
+            if bn.affine:
+                v = v * bn.weight[c].item() + bn.bias[c].item()
+        out.append(None if v is None else max(v, 0.0))
+    return out
+
+
+# producers: [(conv, bn)], each followed by relu. the first conv makes the channels, the
+# others are depthwise. consumer: the conv that reads them. returns the number of channels dropped
+def compact_chain(model, producers, consumer):
+    convs = [get_module(model, c) for c, _ in producers]
+    bns = [get_module(model, b) if b is not None else None for _, b in producers]
+    cons = get_module(model, consumer)
+    num_channels = convs[0].out_channels
+    if convs[0].groups != 1 or cons.groups != 1 or cons.in_channels != num_channels:
+        return 0
+    for conv in convs[1:]:
+        if not (conv.groups == conv.in_channels == conv.out_channels == num_channels):
+            return 0
+
+    def bias_of(conv, c):
+        return 0.0 if conv.bias is None else conv.bias[c].item()
+
+    with torch.no_grad():
+        dead = convs[0].weight.flatten(1).abs().sum(1) == 0
+        values = [bias_of(convs[0], c) if dead[c] else None for c in range(num_channels)]
+        values = bn_relu(values, bns[0])
+        for conv, bn in zip(convs[1:], bns[1:]):
+            dead = conv.weight.flatten(1).abs().sum(1) == 0
+            for c, v in enumerate(values):
+                if dead[c] or v == 0:
+                    values[c] = bias_of(conv, c)
+                elif v is not None and is_pointwise(conv):
+                    values[c] = v * conv.weight[c].sum().item() + bias_of(conv, c)
+                else:
+                    values[c] = None
+            values = bn_relu(values, bn)
+
+        unused = cons.weight.abs().sum((0, 2, 3)) == 0
+        folds = {}
+        for c, v in enumerate(values):
+            if unused[c] or v == 0:
+                folds[c] = None
+            elif v is not None and is_pointwise(cons):
+                folds[c] = v * cons.weight[:, c].sum((1, 2))
+        keep = [c for c in range(num_channels) if c not in folds]
+        if len(keep) == 0:
+            # keep one channel so that the layers still have a shape
+            keep = [0]
+            folds.pop(0)
+        if len(keep) == num_channels:
+            return 0
+
+        idx = torch.tensor(keep, device=cons.weight.device)
+        for (conv_name, bn_name), conv in zip(producers, convs):
+            groups = len(keep) if conv is not convs[0] else conv.groups
+            bias = None if conv.bias is None else conv.bias[idx]
+            set_module(model, conv_name, make_conv(conv, conv.weight[idx], bias, groups))
+            if bn_name is not None:
+                set_module(model, bn_name, make_batchnorm(get_module(model, bn_name), idx))
+
+        bias = cons.bias.clone() if cons.bias is not None else None
+        for c, fold in folds.items():
+            if fold is not None:
+                bias = fold.clone() if bias is None else bias + fold
+        set_module(model, consumer, make_conv(cons, cons.weight[:, idx], bias))
+
+    return num_channels - len(keep)
+
+
+def resnet_chains(model):
+    chains = []
+    for name, m in model.named_modules():
+        if not name.startswith('layer') or not hasattr(m, 'conv2'):
+            continue
+        chains.append(([(name + '.conv1', name + '.bn1' if m.bn1 is not None else None)], name + '.conv2'))
+        if hasattr(m, 'conv3'):
+            # bottleneck
+            chains.append(([(name + '.conv2', name + '.bn2' if m.bn2 is not None else None)], name + '.conv3'))
+    return chains
+
+
+def vgg_chains(model):
+    convs = ['features.{}'.format(i) for i, m in enumerate(model.features) if isinstance(m, nn.Conv2d)]
+    chains = []
+    for conv, next_conv in zip(convs, convs[1:] + ['classifier']):
+        # conv, bn, relu (, maxpool)
+        bn = 'features.{}'.format(int(conv.split('.')[1]) + 1)
+        chains.append(([(conv, bn)], next_conv))
+    return chains
+
+
+def mobilenet_chains(model):
+    chains = []
+    for i in range(len(model.layers)):
+        name = 'layers.{}'.format(i)
+        chains.append(([(name + '.conv1', name + '.bn1'), (name + '.conv2', name + '.bn2')], name + '.conv3'))
+    chains.append(([('conv2', 'bn2')], 'linear'))
+    return chains
+
+
+ARCH_CHAINS = {
+    'resnet20': resnet_chains,
+    'resnet32': resnet_chains,
+    'resnet32_double': resnet_chains,
+    'ResNet18': resnet_chains,
+    'ResNet50': resnet_chains,
+    'ResNet101': resnet_chains,
+    'WideResNet50_2': resnet_chains,
+    'WideResNet101_2': resnet_chains,
+    'vgg16': vgg_chains,
+    'tinyvgg16': vgg_chains,
+    'MobileNetV2': mobilenet_chains,
+}
+
+
+def num_weights(model):
+    return sum(m.weight.numel() for m in model.modules() if isinstance(m, nn.Conv2d))
+
+
+# returns a dense copy of the model with the dead channels removed (for inference, in eval mode)
+def compact_model(model, arch=None):
+    arch = arch or parser_args.arch
+    if arch not in ARCH_CHAINS:
+        raise ValueError("Channel compaction is not supported for {}".format(arch))
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+
+    update_forward_thresholds(model)
+
+    cp_model = densify(copy.deepcopy(model))
+    cp_model.eval()
+    num_before = num_weights(cp_model)
+    num_dropped = 0
+    for producers, consumer in ARCH_CHAINS[arch](cp_model):
+        num_dropped += compact_chain(cp_model, producers, consumer)
+    print("=> Compacted {}: dropped {} channels, {} -> {} conv weights".format(
+        arch, num_dropped, num_before, num_weights(cp_model)))
+    return cp_model
+
+
+# max |logits| difference between the masked model and its compacted copy, on a batch
+def compaction_error(model, cp_model, images):
+    model.eval()
+    cp_model.eval()
+    with torch.no_grad():
+        return (model(images) - cp_model(images)).abs().max().item()
@@ -0,0 +1,123 @@
+"""
+Cache of validate() results (--eval-cache).
+
+main.py validates the same model on the same loader several times in a row (acc1 and
+val_acc1, the last rounding again, finetune before its first epoch). With the cache,
+validate() results are keyed by
+
+- a fingerprint of the model: for the subnet layers the weights the forward effectively
+  uses (weight * mask, with the masks computed again rather than read from the layer mask
+  caches, so the fingerprint sees the scores as they are), for every other module its parameters and buffers (batchnorm
+  statistics included). Each tensor is reduced on its device to a few sums (plain,
+  squared and hash-weighted by element index), the sums are copied back once and hashed
+- the dataset behind the loader: class, root, split, size and transform, for random_split
+  subsets those of the base dataset and a hash of the indices
+
+and a repeated evaluation of an unchanged model is answered from the cache. Models with
+a random forward (pt) and loaders with random transforms are never cached.
+"""
+import hashlib
+
+import torch
+import torch.nn as nn
+
+from utils.subnet_strategies import PTStrategy, SubnetStrategyLayer
+
+
+# Knuth's multiplicative hash, weights in [0, 1) per element index
+HASH_MULTIPLIER = 2654435761
+
+
+def tensor_fingerprint(t):
+    flat = t.detach().reshape(-1).double()
+    idx = torch.arange(flat.numel(), dtype=torch.int64, device=flat.device)
+    weights = ((idx * HASH_MULTIPLIER) % 2 ** 32).double() / 2 ** 32
+    return torch.stack([flat.sum(), (flat * flat).sum(), (flat * weights).sum(),
+                        flat.new_tensor(float(flat.numel()))])
+
+
+# the tensors a module's own output depends on, None when it is random
+def fingerprint_tensors(m):
+    if isinstance(m, SubnetStrategyLayer):
+        if isinstance(m.strategy, PTStrategy):
+            # a new mask is sampled on every forward
+            return None
+        tensors = list(m.effective_weights(cached=False))
+    else:
+        tensors = list(m.parameters(recurse=False)) + list(m.buffers(recurse=False))
+    return [t for t in tensors if t is not None and t.numel() > 0]
+
+
+# None when the model output is random
+def model_fingerprint(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    parts = []
+    with torch.no_grad():
+        for m in model.modules():
+            tensors = fingerprint_tensors(m)
+            if tensors is None:
+                return None
+            parts += [tensor_fingerprint(t) for t in tensors]
+    if len(parts) == 0:
+        return None
+    # a single copy back to the host
+    parts = torch.stack([p.to(parts[0].device) for p in parts]).cpu()
+    return hashlib.sha1(parts.numpy().tobytes()).hexdigest()
+
+
+# None when the loader gives different data every time. random_split subsets are unwrapped
+# to the dataset they index, their transform is the base one and their indices go in the key
+def loader_key(loader):
+    dataset = loader.dataset
+    indices = None
+    while isinstance(dataset, torch.utils.data.Subset):
+        subset = [int(i) for i in dataset.indices]
+        indices = subset if indices is None else [subset[i] for i in indices]
+        dataset = dataset.dataset
+    transform = repr(getattr(dataset, 'transform', None))
+    if 'Random' in transform:
+        return None
+    if indices is None:
+        indices_hash = None
+    else:
+        indices_hash = hashlib.sha1(torch.tensor(indices, dtype=torch.int64).numpy().tobytes()).hexdigest()
+    return (type(dataset).__name__, str(getattr(dataset, 'root', None)), getattr(dataset, 'train', None),
+            len(loader.dataset), transform, repr(getattr(dataset, 'target_transform', None)), indices_hash)
+
+
+class EvalCache(object):
+    def __init__(self):
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, loader, model):
+        lkey = loader_key(loader)
+        if lkey is None:
+            return None
+        fingerprint = model_fingerprint(model)
+        if fingerprint is None:
+            return None
+        return lkey + (fingerprint,)
+
+    # validate with the same signature, served from the cache when it can be
+    def wrap(self, validate):
+        def cached_validate(val_loader, model, criterion, args, writer, epoch):
+            key = self.key(val_loader, model)
+            if key is not None and key in self.results:
+                self.hits += 1
+                print("=> Eval cache hit, model top1 Accuracy: {}".format(self.results[key][0]))
+                return self.results[key]
+            self.misses += 1
+            result = validate(val_loader, model, criterion, args, writer, epoch)
+            if key is not None:
+                self.results[key] = result
+            return result
+        return cached_validate
+
+    def print_stats(self):
+        print("=> Eval cache: {} hits, {} misses".format(self.hits, self.misses))
+
+
+EVAL_CACHE = EvalCache()
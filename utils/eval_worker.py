@@ -0,0 +1,191 @@
+"""
+Background evaluation of the score-training epochs (--eval-worker).
+
+main.py normally blocks on the rounding + validate() passes of an epoch before training
+the next one. With --eval-worker they run in a separate (spawned) process that builds
+its own model and dataset from the same flags:
+
+- at startup the frozen tensors of the model (the weights while the scores train) are
+  copied once into shared memory for the worker
+- every epoch, the trainable parameters and the buffers (scores, flags, batchnorm
+  statistics, prune thresholds) and the prune rates are copied into one of
+  --eval-worker-queue preallocated shared-memory slots and only (slot, epoch) is sent.
+  submit() blocks while all the slots are in flight, which caps the host memory
+- the worker loads the slot into its model, frees the slot and runs evaluate_epoch();
+  the results come back by epoch and merge() puts them into the result lists, so
+  acc_and_sparsity.csv stays in epoch order (the epochs still in flight are empty)
+"""
+import queue
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from args_helper import parser_args
+from utils.subnet_strategies import SubnetStrategyLayer
+
+
+# seconds between liveness checks of the worker while waiting for results
+POLL_INTERVAL = 10
+
+
+def check_eval_worker(args):
+    if args.multiprocessing_distributed:
+        raise ValueError("--eval-worker only supports single process training")
+    if args.score_dtype == 'uint8' or args.active_set_scores:
+        raise ValueError("--eval-worker needs the scores stored as parameters (no uint8 / --active-set-scores)")
+
+
+def unwrap(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        return model.module
+    return model
+
+
+def model_tensors(model):
+    tensors = dict(model.named_parameters())
+    tensors.update(model.named_buffers())
+    return tensors
+
+
+# the tensors that change during score training, and the prune rates of the subnet layers
+def dynamic_tensors(model):
+    tensors = {name: t for name, t in model.named_parameters() if t.requires_grad}
+    tensors.update(model.named_buffers())
+    rates = [m.prune_rate for m in model.modules() if isinstance(m, SubnetStrategyLayer)]
+    tensors['prune_rates'] = torch.tensor(rates, dtype=torch.float64)
+    # global_ep thresholds and BottomK read the rate from the flags, which the trainer anneals
+    tensors['global_prune_rate'] = torch.tensor([parser_args.prune_rate], dtype=torch.float64)
+    return tensors
+
+
+def shared_like(tensors):
+    return {name: torch.empty(t.shape, dtype=t.dtype).share_memory_() for name, t in tensors.items()}
+
+
+def load_tensors(model, tensors):
+    targets = model_tensors(model)
+    with torch.no_grad():
+        for name, t in tensors.items():
+            if name in targets:
+                targets[name].copy_(t)
+    if 'prune_rates' in tensors:
+        layers = [m for m in model.modules() if isinstance(m, SubnetStrategyLayer)]
+        for m, rate in zip(layers, tensors['prune_rates'].tolist()):
+            m.prune_rate = rate
+    if 'global_prune_rate' in tensors:
+        parser_args.prune_rate = tensors['global_prune_rate'].item()
+
+
+def eval_worker_main(frozen, slots, jobs, free_slots, results, gpu):
+    # main_utils imports this module
+    from main_utils import evaluate_epoch, get_dataset, get_model, get_trainer, set_gpu
+    from utils.net_utils import LabelSmoothing
+    from utils.score_precision import set_score_precision
+
+    parser_args.gpu = gpu
+    _, validate, _ = get_trainer(parser_args)
+    model = set_gpu(parser_args, get_model(parser_args))
+    set_score_precision(model, parser_args.score_dtype)
+    load_tensors(model, frozen)
+    data = get_dataset(parser_args)
+    if parser_args.label_smoothing is None:
+        criterion = nn.CrossEntropyLoss().cuda(gpu)
+    else:
+        criterion = LabelSmoothing(smoothing=parser_args.label_smoothing)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        slot, epoch = job
+        load_tensors(model, slots[slot])
+        free_slots.put(slot)
+        print("=> Eval worker: epoch {}".format(epoch))
+        results.put((epoch,) + evaluate_epoch(model, data, criterion, validate, epoch))
+
+
+class EvalWorker(object):
+    def __init__(self, model, args):
+        check_eval_worker(args)
+        model = unwrap(model)
+        ctx = mp.get_context('spawn')
+        dynamic = dynamic_tensors(model)
+        frozen = {name: t for name, t in model_tensors(model).items() if name not in dynamic}
+        self.shapes = {name: t.shape for name, t in dynamic.items()}
+        self.slots = [shared_like(dynamic) for _ in range(args.eval_worker_queue)]
+        shared_frozen = shared_like(frozen)
+        with torch.no_grad():
+            for name, t in frozen.items():
+                shared_frozen[name].copy_(t)
+
+        self.jobs = ctx.Queue()
+        self.free_slots = ctx.Queue()
+        self.results = ctx.Queue()
+        for slot in range(len(self.slots)):
+            self.free_slots.put(slot)
+        gpu = args.eval_worker_gpu if args.eval_worker_gpu is not None else args.gpu
+        self.process = ctx.Process(
+            target=eval_worker_main,
+            args=(shared_frozen, self.slots, self.jobs, self.free_slots, self.results, gpu),
+            daemon=True)
+        self.process.start()
+        self.pending = 0
+        # epoch -> (test acc before rounding, test acc, val acc)
+        self.done = {}
+        print("=> Eval worker on GPU {}, {} snapshot slots of {:.1f} MB".format(
+            gpu, len(self.slots), sum(t.numel() * t.element_size() for t in self.slots[0].values()) / 2 ** 20))
+
+    def submit(self, model, epoch):
+        tensors = dynamic_tensors(unwrap(model))
+        if {name: t.shape for name, t in tensors.items()} != self.shapes:
+            raise ValueError("--eval-worker: the model's tensors changed shape since the worker started")
+        # blocks while every slot is in flight
+        while True:
+            try:
+                slot = self.free_slots.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                self.poll()
+                if not self.process.is_alive():
+                    raise RuntimeError("The eval worker exited with {} evaluations pending".format(self.pending))
+        with torch.no_grad():
+            for name, t in tensors.items():
+                self.slots[slot][name].copy_(t.detach())
+        self.jobs.put((slot, epoch))
+        self.pending += 1
+        self.poll()
+
+    def _receive(self, result):
+        epoch, br_acc1, acc1, val_acc1 = result
+        self.done[epoch] = (br_acc1, acc1, val_acc1)
+        self.pending -= 1
+
+    def poll(self):
+        while True:
+            try:
+                self._receive(self.results.get_nowait())
+            except queue.Empty:
+                return
+
+    # fills the entries of the finished epochs in the result lists of main.py
+    def merge(self, epoch_list, test_acc_before_round_list, test_acc_list, val_acc_list):
+        self.poll()
+        for i, epoch in enumerate(epoch_list):
+            if epoch not in self.done:
+                continue
+            br_acc1, acc1, val_acc1 = self.done[epoch]
+            if br_acc1 is not None:
+                test_acc_before_round_list[i] = br_acc1
+            test_acc_list[i] = acc1
+            val_acc_list[i] = val_acc1
+
+    def close(self):
+        self.jobs.put(None)
+        while self.pending > 0:
+            try:
+                self._receive(self.results.get(timeout=POLL_INTERVAL))
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("The eval worker exited with {} evaluations pending".format(self.pending))
+        self.process.join()
@@ -7,6 +7,12 @@ import numpy as np
 import math
 
 from args_helper import parser_args
+from utils.masked_ops import masked_linear
+from utils.bitmask import PackedFlags
+from utils.seeded_init import SeededWeights
+from utils.score_params import FactorizedScores
+from utils.subnet_strategies import SubnetStrategyLayer, ChannelSubnetLayer
+from utils.selection import get_topk_mask
 
 
 class GetSubnet(autograd.Function):
@@ -35,25 +41,12 @@ class GetSubnet(autograd.Function):
             bias_out = torch.bernoulli(bias_scores)
 
         elif parser_args.algo == 'ep' or parser_args.algo == 'ep+greedy':
-            # Get the supermask by sorting the scores and using the top k%
-            out = scores.clone()
-            _, idx = scores.flatten().sort()
-            j = int((1 - k) * scores.numel())
-            # flat_out and out access the same memory.
-            flat_out = out.flatten()
-            flat_out[idx[:j]] = 0
-            flat_out[idx[j:]] = 1
+            # Get the supermask by keeping the top k% of the scores.
+            # the k-th score is found by selection, so there is no full sort here
+            out = get_topk_mask(scores, k)
 
             # repeat for bias
-            # Get the supermask by sorting the scores and using the top k%
-            bias_out = bias_scores.clone()
-            _, idx = bias_scores.flatten().sort()
-            j = int((1 - k) * bias_scores.numel())
-
-            # flat_out and out access the same memory.
-            bias_flat_out = bias_out.flatten()
-            bias_flat_out[idx[:j]] = 0
-            bias_flat_out[idx[j:]] = 1
+            bias_out = get_topk_mask(bias_scores, k)
 
         elif parser_args.algo in ['global_ep', 'global_ep_iter']:
             # define out, bias_out based on the layer's prune_threshold, bias_threshold
@@ -91,17 +84,16 @@ class GetSubnet(autograd.Function):
 
 
 # Not learning weights, finding subnet
-class SubnetLinear(nn.Linear):
+class SubnetLinear(PackedFlags, SeededWeights, FactorizedScores, SubnetStrategyLayer, nn.Linear):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # initialize flag (representing the pruned weights)
-        self.flag = nn.Parameter(torch.ones(self.weight.size()))
+        # initialize flag (representing the pruned weights), stored bit-packed (see utils/bitmask.py)
         if parser_args.bias:
-            self.bias_flag = nn.Parameter(torch.ones(self.bias.size()))
+            self.init_flags(self.weight.size(), self.bias.size())
         else:
-            # dummy variable just so other things don't break
-            self.bias_flag = nn.Parameter(torch.Tensor(1))
+            # dummy bias flag just so other things don't break
+            self.init_flags(self.weight.size(), (1,))
 
         # initialize the scores
         self.scores = nn.Parameter(torch.Tensor(self.weight.size()))
@@ -111,10 +103,9 @@ class SubnetLinear(nn.Linear):
             # dummy variable just so other things don't break
             self.bias_scores = nn.Parameter(torch.Tensor(1))
         
-        # prune scores below this for global EP in bottom-k
-        self.scores_prune_threshold = -np.inf
-        self.bias_scores_prune_threshold = -np.inf
-        
+        # prune_rate, global EP thresholds and the forward strategy for parser_args.algo
+        self.init_strategy(['hc', 'hc_iter'])
+
         if parser_args.algo in ['hc', 'hc_iter']:
             if parser_args.random_subnet:
                 self.scores.data = torch.bernoulli(parser_args.prune_rate * torch.ones_like(self.scores.data))
@@ -146,8 +137,6 @@ class SubnetLinear(nn.Linear):
         if parser_args.freeze_weights:
             # NOTE: turn the gradient on the weights off
             self.weight.requires_grad = False
-            self.flag.requires_grad = False
-            self.bias_flag.requires_grad = False
             if parser_args.bias:
                 self.bias.requires_grad = False
 
@@ -155,46 +144,28 @@ class SubnetLinear(nn.Linear):
         if parser_args.rewind_score:
             self.saved_scores = None
 
-    def set_prune_rate(self, prune_rate):
-        self.prune_rate = prune_rate
-
     @property
     def clamped_scores(self):
         return self.scores.abs()
 
-    def forward(self, x):
-        if parser_args.algo in ['hc', 'hc_iter']:
-            # don't need a mask here. the scores are directly multiplied with weights
-            if parser_args.differentiate_clamp:
-                self.scores.data = torch.clamp(self.scores.data, 0.0, 1.0)
-                self.bias_scores.data = torch.clamp(self.bias_scores.data, 0.0, 1.0)
-
-            if parser_args.hc_quantized:
-                subnet, bias_subnet = GetSubnet.apply(self.scores, self.bias_scores, parser_args.prune_rate)
-                subnet = subnet * self.flag.data.float()
-                bias_subnet = subnet * self.bias_flag.data.float()
-            else:
-                subnet = self.scores * self.flag.data.float()
-                bias_subnet = self.bias_scores * self.bias_flag.data.float()
-        elif parser_args.algo in ['imp']:
-            # no STE, no subnet. Mask is handled outside
-            pass
-        elif parser_args.algo in ['global_ep', 'global_ep_iter']:
-            subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), 0, self.scores_prune_threshold, self.bias_scores_prune_threshold)
-        else:
-            # ep, global_ep, global_ep_iter, pt etc
-            subnet, bias_subnet = GetSubnet.apply(self.scores.abs(), self.bias_scores.abs(), parser_args.prune_rate)
-        
-        if parser_args.algo in ['imp']:
-            # no STE, no subnet. Mask is handled outside
-            w = self.weight
-            b = self.bias
-        else:
-            w = self.weight * subnet
-            if parser_args.bias:
-                b = self.bias * bias_subnet
-            else:
-                b = self.bias
+    def dense_op(self, x, w, b):
+        return F.linear(x, w, b)
+
+    def lean_op(self, x, weight, flag, b, mask_fn, abs_grad):
+        return masked_linear(x, weight, self.scores, flag, b, mask_fn, abs_grad)
+
+
+# Not learning weights, finding a subnet of whole neurons (one score per output feature)
+class ChannelSubnetLinear(PackedFlags, SeededWeights, ChannelSubnetLayer, nn.Linear):
+    channel_dim = -1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.init_channel_subnet(['hc', 'hc_iter'])
+
+    @property
+    def clamped_scores(self):
+        return self.scores.abs()
 
-        x = F.linear(x, w, b)
-        return x
+    def dense_op(self, x, w, b):
+        return F.linear(x, w, b)
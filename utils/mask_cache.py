@@ -0,0 +1,66 @@
+"""
+Memoization of subnet masks / masked weights for SubnetConv and SubnetLinear.
+
+The masks only depend on scores, flag, bias_scores, bias_flag (and a few
+scalars like the prune rate), so we key the cache on the version counters of
+those tensors. In-place updates of the tensor itself or of a view / .detach()
+of it (optimizer.step(), `param.clamp_` or `param.copy_` under torch.no_grad(),
+`flag_bits[...] &= ...`) bump the version, and `param.data = new_tensor` swaps
+the storage, so we also key on data_ptr(). The cache keeps a reference to the
+keyed tensors, so their storage can't be freed and handed out again at the same
+address while the entry is alive.
+
+In-place writes through `.data` (`param.data.copy_(...)`, `param.data.mul_(...)`)
+do NOT bump the version: `.data` has a version counter of its own. Write the
+tensor itself under torch.no_grad() instead, or call clear_mask_caches() on the
+model after such a write, otherwise the forward keeps using the old masks.
+"""
+import torch
+import torch.autograd as autograd
+
+
+def tensor_key(t):
+    if t is None:
+        return None
+    return (t.data_ptr(), t._version)
+
+
+class MaskCache(object):
+    def __init__(self):
+        self.key = None
+        self.value = None
+        self.refs = None
+
+    def get(self, key):
+        if self.key is not None and self.key == key:
+            return self.value
+        return None
+
+    def set(self, key, value, refs=()):
+        self.key = key
+        self.value = value
+        self.refs = [t.data for t in refs if torch.is_tensor(t)]
+
+    def clear(self):
+        self.key = None
+        self.value = None
+        self.refs = None
+
+
+class StraightThroughMask(autograd.Function):
+    # returns a precomputed mask, but sends the gradient straight-through to the scores
+    # (same backward as GetSubnet, so a cached mask trains exactly like a fresh one)
+    @staticmethod
+    def forward(ctx, scores, mask):
+        return mask.view_as(mask)
+
+    @staticmethod
+    def backward(ctx, g):
+        return g, None
+
+
+def clear_mask_caches(model):
+    for m in model.modules():
+        if hasattr(m, "mask_cache"):
+            m.mask_cache.clear()
+            m.weight_cache.clear()
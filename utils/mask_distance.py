@@ -0,0 +1,109 @@
+"""
+All-pairs distances between {0, 1} masks on bit-packed words.
+
+The K masks of a layer are packed 64 entries to an int64 word (pack_bits from
+utils/bitmask.py, the bytes reinterpreted as words) and the only pairwise quantity
+computed is the overlap popcount(a & b), with a SWAR popcount on the words. The ones of
+each mask give the rest:
+
+    hamming(a, b) = |a| + |b| - 2 |a & b|
+    iou(a, b)     = |a & b| / (|a| + |b| - |a & b|)
+
+MaskDistance accumulates the counts layer by layer, so the masks of a whole model never
+have to be concatenated (or even exist at the same time), and the rows of the pairwise
+AND are done a chunk at a time to keep the (rows, K, words) temporary bounded.
+"""
+import torch
+
+from utils.bitmask import pack_bits
+
+
+WORD_BITS = 64
+# entries of the (rows, K, words) temporary of one chunk
+CHUNK_NUMEL = 2 ** 24
+
+_M1 = 0x5555555555555555
+_M2 = 0x3333333333333333
+_M4 = 0x0f0f0f0f0f0f0f0f
+_H01 = 0x0101010101010101
+
+
+# number of set bits of each int64 word. The shifts are arithmetic, but every shifted
+# value is masked with a constant whose top bits are 0, so the sign bit never leaks in
+def popcount64(words):
+    x = words - ((words >> 1) & _M1)
+    x = (x & _M2) + ((x >> 2) & _M2)
+    x = (x + (x >> 4)) & _M4
+    # the byte sums add up in the top byte (the product wraps, which is fine)
+    return (x * _H01) >> 56
+
+
+# (K, N) masks -> (K, ceil(N / 64)) int64 words, padded with zeros
+def pack_masks(masks):
+    masks = masks.reshape(masks.size(0), -1)
+    num_masks, numel = masks.shape
+    pad = -numel % WORD_BITS
+    flat = masks.ne(0)
+    if pad > 0:
+        flat = torch.cat([flat, flat.new_zeros(num_masks, pad)], dim=1)
+    return pack_bits(flat).view(num_masks, -1).view(torch.int64)
+
+
+# (K, K) popcount(a & b) of the packed masks
+def overlap_counts(words):
+    num_masks, num_words = words.shape
+    rows = max(1, CHUNK_NUMEL // max(1, num_masks * num_words))
+    out = torch.empty((num_masks, num_masks), dtype=torch.int64, device=words.device)
+    for start in range(0, num_masks, rows):
+        chunk = words[start:start + rows].unsqueeze(1) & words.unsqueeze(0)
+        out[start:start + rows] = popcount64(chunk).sum(dim=-1)
+    return out
+
+
+class MaskDistance(object):
+    def __init__(self, num_masks):
+        self.num_masks = num_masks
+        self.overlap = None
+        self.numel = 0
+
+    # (K, ...) masks of one layer / block of entries
+    def add(self, masks):
+        words = pack_masks(masks)
+        overlap = overlap_counts(words)
+        if self.overlap is None:
+            self.overlap = overlap
+        else:
+            self.overlap += overlap.to(self.overlap.device)
+        self.numel += masks[0].numel()
+
+    # |a & b| and |a| (the diagonal), copied back once
+    def _counts(self):
+        if self.overlap is None:
+            overlap = torch.zeros((self.num_masks, self.num_masks), dtype=torch.float64)
+        else:
+            overlap = self.overlap.double().cpu()
+        return overlap, torch.diagonal(overlap)
+
+    # fraction of the entries where each pair of masks differs (counts with normalize=False)
+    def hamming(self, normalize=True):
+        overlap, ones = self._counts()
+        dist = ones[:, None] + ones[None, :] - 2 * overlap
+        if normalize:
+            dist = dist / max(self.numel, 1)
+        return dist.numpy()
+
+    def intersection(self):
+        overlap, _ = self._counts()
+        return overlap.numpy()
+
+    def iou(self):
+        overlap, ones = self._counts()
+        union = ones[:, None] + ones[None, :] - overlap
+        return (overlap / union.clamp(min=1)).numpy()
+
+
+# all-pairs distances of a list of same-sized masks
+def mask_distances(masks):
+    dist = MaskDistance(len(masks))
+    dist.add(torch.stack([m.reshape(-1) for m in masks]))
+    return dist
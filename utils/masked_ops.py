@@ -0,0 +1,189 @@
+"""
+Memory-lean masked conv / linear for SubnetConv and SubnetLinear (--lean-masked-ops).
+
+With plain autograd, `w = self.weight * subnet` is kept alive until backward
+(on top of weight, scores and flag), so every layer costs ~4x its weight size
+before any activations. The functions here only save the input and the inputs
+to the mask. The masked weight is written into a shared workspace buffer in
+forward, recomputed in backward, and the score gradient (grad_w * weight,
+times flag for hc and sign(scores) for ep / global_ep) is computed in place
+in the weight gradient buffer.
+"""
+import torch
+import torch.autograd as autograd
+import torch.nn.functional as F
+from torch.nn.grad import conv2d_input, conv2d_weight
+
+
+# one buffer per (name, shape, dtype, device), shared by all the layers. forward and
+# backward of the layers never interleave, so a layer only needs it for the duration of
+# its own forward / backward call
+_workspace = {}
+
+
+def get_workspace(name, like):
+    key = (name, tuple(like.shape), like.dtype, like.device)
+    buf = _workspace.get(key)
+    if buf is None:
+        buf = torch.empty_like(like, memory_format=torch.contiguous_format)
+        _workspace[key] = buf
+    return buf
+
+
+def clear_workspace():
+    _workspace.clear()
+
+
+# weight * mask (* flag) written into the workspace. mask_fn gives the detached mask
+# (the scores themselves for hc without quantization). weight can also be a
+# SeededWeight (utils/seeded_init.py), which is generated into the workspace
+def masked_weight_(weight, scores, flag, mask_fn):
+    w = get_workspace('weight', scores)
+    if torch.is_tensor(weight):
+        torch.mul(weight, mask_fn(), out=w)
+    else:
+        weight.generate_(w)
+        w.mul_(mask_fn())
+    if flag is not None:
+        w.mul_(flag)
+    return w
+
+
+# turns the gradient w.r.t. the masked weight into the gradient w.r.t. the scores, in place
+# (straight-through the mask, so d(subnet)/d(scores) is flag for hc and sign(scores) for ep)
+def score_grad_(grad_w, weight, scores, flag, abs_grad):
+    if torch.is_tensor(weight):
+        grad_w.mul_(weight)
+    else:
+        weight.mul_into_(grad_w)
+    if flag is not None:
+        grad_w.mul_(flag)
+    if abs_grad:
+        sign = get_workspace('weight', scores)
+        torch.sign(scores, out=sign)
+        grad_w.mul_(sign)
+    return grad_w
+
+
+def weight_grad(grad_w, flag, mask_fn):
+    grad_weight = grad_w * mask_fn()
+    if flag is not None:
+        grad_weight.mul_(flag)
+    return grad_weight
+
+
+# a SeededWeight is not a tensor, so it is kept on ctx instead of in the saved tensors
+def save_weight(ctx, x, weight, scores, flag):
+    if torch.is_tensor(weight):
+        ctx.save_for_backward(x, weight, scores, flag)
+        ctx.seeded_weight = None
+    else:
+        ctx.save_for_backward(x, None, scores, flag)
+        ctx.seeded_weight = weight
+
+
+def saved_weight(ctx):
+    x, weight, scores, flag = ctx.saved_tensors
+    if ctx.seeded_weight is not None:
+        weight = ctx.seeded_weight
+    return x, weight, scores, flag
+
+
+class MaskedConv2d(autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, scores, flag, bias, mask_fn, abs_grad, stride, padding, dilation, groups):
+        with torch.no_grad():
+            w = masked_weight_(weight, scores, flag, mask_fn)
+            out = F.conv2d(x, w, bias, stride, padding, dilation, groups)
+
+        save_weight(ctx, x, weight, scores, flag)
+        ctx.mask_fn = mask_fn
+        ctx.abs_grad = abs_grad
+        ctx.conv_args = (stride, padding, dilation, groups)
+        ctx.has_bias = bias is not None
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, scores, flag = saved_weight(ctx)
+        stride, padding, dilation, groups = ctx.conv_args
+        grad_x = grad_weight = grad_scores = grad_bias = None
+
+        if ctx.needs_input_grad[0]:
+            w = masked_weight_(weight, scores, flag, ctx.mask_fn)
+            grad_x = conv2d_input(x.shape, w, grad_out, stride, padding, dilation, groups)
+
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            grad_w = conv2d_weight(x, weight.shape, grad_out, stride, padding, dilation, groups)
+            if ctx.needs_input_grad[1]:
+                grad_weight = weight_grad(grad_w, flag, ctx.mask_fn)
+            if ctx.needs_input_grad[2]:
+                grad_scores = score_grad_(grad_w, weight, scores, flag, ctx.abs_grad)
+
+        if ctx.has_bias and ctx.needs_input_grad[4]:
+            grad_bias = grad_out.sum((0, 2, 3))
+
+        return grad_x, grad_weight, grad_scores, None, grad_bias, None, None, None, None, None, None
+
+
+class MaskedLinear(autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, scores, flag, bias, mask_fn, abs_grad):
+        with torch.no_grad():
+            w = masked_weight_(weight, scores, flag, mask_fn)
+            out = F.linear(x, w, bias)
+
+        save_weight(ctx, x, weight, scores, flag)
+        ctx.mask_fn = mask_fn
+        ctx.abs_grad = abs_grad
+        ctx.has_bias = bias is not None
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight, scores, flag = saved_weight(ctx)
+        grad_x = grad_weight = grad_scores = grad_bias = None
+        grad_out_2d = grad_out.reshape(-1, grad_out.shape[-1])
+
+        if ctx.needs_input_grad[0]:
+            w = masked_weight_(weight, scores, flag, ctx.mask_fn)
+            grad_x = grad_out.matmul(w)
+
+        if ctx.needs_input_grad[1] or ctx.needs_input_grad[2]:
+            grad_w = grad_out_2d.t().mm(x.reshape(-1, x.shape[-1]))
+            if ctx.needs_input_grad[1]:
+                grad_weight = weight_grad(grad_w, flag, ctx.mask_fn)
+            if ctx.needs_input_grad[2]:
+                grad_scores = score_grad_(grad_w, weight, scores, flag, ctx.abs_grad)
+
+        if ctx.has_bias and ctx.needs_input_grad[4]:
+            grad_bias = grad_out_2d.sum(0)
+
+        return grad_x, grad_weight, grad_scores, None, grad_bias, None, None
+
+
+# weight * subnet for active-set mode (utils/active_set.py). subnet is detached, the score
+# gradient is only computed at the live entries idx, where the flag is 1
+class ActiveMaskedWeight(autograd.Function):
+    @staticmethod
+    def forward(ctx, active_scores, weight, subnet, idx):
+        ctx.save_for_backward(weight, subnet, idx)
+        return weight * subnet
+
+    @staticmethod
+    def backward(ctx, grad_w):
+        weight, subnet, idx = ctx.saved_tensors
+        grad_active = grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_active = grad_w.reshape(-1)[idx] * weight.reshape(-1)[idx]
+        if ctx.needs_input_grad[1]:
+            grad_weight = grad_w * subnet
+        return grad_active, grad_weight, None, None
+
+
+def masked_conv2d(x, weight, scores, flag, bias, mask_fn, abs_grad, stride=1, padding=0, dilation=1, groups=1):
+    return MaskedConv2d.apply(x, weight, scores, flag, bias, mask_fn, abs_grad, stride, padding, dilation, groups)
+
+
+def masked_linear(x, weight, scores, flag, bias, mask_fn, abs_grad):
+    return MaskedLinear.apply(x, weight, scores, flag, bias, mask_fn, abs_grad)
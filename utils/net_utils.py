@@ -5,15 +5,22 @@ import pdb
 import pathlib
 import shutil
 import math
+import contextlib
 import copy
 import numpy as np
 
 import torch
 import torch.nn as nn
 
+from utils.bitmask import and_bits, count_bits, invert_bits, pack_bits, permute_bits, unpack_bits
 from utils.mask_layers import MaskLinear, MaskConv
 from utils.conv_type import GetSubnet as GetSubnetConv
-from utils.conv_type import SubnetConv
+from utils.conv_type import SubnetConv, ChannelSubnetConv
+from utils.subnet_strategies import SubnetStrategyLayer, ChannelSubnetLayer
+from utils.score_params import FactorizedScores, materialize_scores
+from utils.score_arena import get_score_arena
+from utils.seeded_init import SeededWeights
+from utils.selection import KthValueTracker, chunked_kthvalue
 
 
 # return layer objects of conv layers and linear layers so we can parse them
@@ -99,7 +106,7 @@ def get_layers(arch='Conv4', model=None):
     elif arch in ['vgg16', 'tinyvgg16']:
         conv_layers = []
         for i in range(len(model.features)):
-            if isinstance(model.features[i], SubnetConv):
+            if isinstance(model.features[i], (SubnetConv, ChannelSubnetConv)):
                 conv_layers.append(model.features[i])
         # check how to see how the model.features object works and if this is correct
         linear_layers = [model.classifier]
@@ -135,13 +142,13 @@ def redraw(model, shuffle=False, reinit=False, invert=False, chg_mask=False, chg
     for layer in (conv_layers + linear_layers):
         if shuffle:
             if chg_mask:
-                idx = torch.randperm(layer.flag.data.nelement())
-                layer.flag.data = layer.flag.data.view(
-                    -1)[idx].view(layer.flag.data.size())
+                numel = layer.scores.nelement()
+                idx = torch.randperm(numel)
+                layer.flag_bits = permute_bits(layer.flag_bits, numel, idx)
                 if parser_args.bias:
-                    idx = torch.randperm(layer.bias_flag.data.nelement())
-                    layer.bias_flag.data = layer.bias_flag.data.view(
-                        -1)[idx].view(layer.bias_flag.data.size())
+                    numel = layer.bias_scores.nelement()
+                    idx = torch.randperm(numel)
+                    layer.bias_flag_bits = permute_bits(layer.bias_flag_bits, numel, idx)
 
             if chg_weight:
                 raise NotImplementedError
@@ -164,9 +171,9 @@ def redraw(model, shuffle=False, reinit=False, invert=False, chg_mask=False, chg
 
         if invert:
             if chg_mask:
-                layer.flag.data = 1 - layer.flag.data
+                layer.flag_bits = invert_bits(layer.flag_bits, layer.scores.nelement())
                 if parser_args.bias:
-                    layer.flag_bias.data = 1 - layer.flag_bias.data
+                    layer.bias_flag_bits = invert_bits(layer.bias_flag_bits, layer.bias_scores.nelement())
             else:
                 raise NotImplementedError
 
@@ -310,43 +317,61 @@ class SubnetL1RegLoss(nn.Module):
 
 
 # rounds model by round_scheme and returns the rounded model
+# rounds one score tensor in place. name is the parameter name (naive_prob rounds one layer differently).
+# pass the parameter itself (under no_grad), not its .data, so the mask caches see the write
+def round_scores_tensor_(name, scores, round_scheme, noise=False, ratio=0.0):
+    if noise:
+        delta = torch.randn_like(scores)*ratio
+        scores += delta
+
+    if round_scheme == 'naive':
+        scores.copy_(torch.gt(scores, torch.ones_like(
+            scores)*parser_args.quantize_threshold).int().float())
+    elif round_scheme == 'prob':
+        scores.copy_(torch.bernoulli(torch.clamp(scores, 0.0, 1.0)).float())
+    elif round_scheme == 'naive_prob':
+        if name == 'linear.0.scores':
+            # print("Applying prob. rounding to {}".format(name))
+            scores.copy_(torch.bernoulli(torch.clamp(scores, 0.0, 1.0)).float())
+        else:
+            # print("Applying naive rounding to {}".format(name))
+            scores.copy_(torch.gt(scores, torch.ones_like(
+                scores)*0.5).int().float())
+    elif round_scheme == 'all_ones':
+        scores.fill_(1)
+    else:
+        print("INVALID ROUNDING")
+        print("EXITING")
+    '''
+    if noise:
+        delta = torch.bernoulli(torch.ones_like(scores)*ratio)
+        scores.copy_((scores + delta) % 2)
+    '''
+
+
+def score_parameters(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    return [(name, params) for name, params in model.named_parameters() if ".score" in name]
+
+
+# rounds the scores of the model itself, e.g. when it is already a copy
+def round_scores_(model, round_scheme, noise=False, ratio=0.0):
+    # hashed / low-rank scores are rounded per weight
+    materialize_scores(model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model)
+    with torch.no_grad():
+        for name, params in score_parameters(model):
+            round_scores_tensor_(name, params, round_scheme, noise, ratio)
+    return model
+
+
 def round_model(model, round_scheme, noise=False, ratio=0.0, rank=None):
     print("Rounding model with scheme: {}".format(round_scheme))
     if isinstance(model, nn.parallel.DistributedDataParallel):
         cp_model = copy.deepcopy(model.module)
     else:
         cp_model = copy.deepcopy(model)
-    for name, params in cp_model.named_parameters():
-        if ".score" in name:
-            if noise:
-                delta = torch.randn_like(params.data)*ratio
-                params.data += delta
-
-            if round_scheme == 'naive':
-                params.data = torch.gt(params.data, torch.ones_like(
-                    params.data)*parser_args.quantize_threshold).int().float()
-            elif round_scheme == 'prob':
-                params.data = torch.clamp(params.data, 0.0, 1.0)
-                params.data = torch.bernoulli(params.data).float()
-            elif round_scheme == 'naive_prob':
-                if name == 'linear.0.scores':
-                    # print("Applying prob. rounding to {}".format(name))
-                    params.data = torch.clamp(params.data, 0.0, 1.0)
-                    params.data = torch.bernoulli(params.data).float()
-                else:
-                    # print("Applying naive rounding to {}".format(name))
-                    params.data = torch.gt(params.data, torch.ones_like(
-                        params.data)*0.5).int().float()
-            elif round_scheme == 'all_ones':
-                params.data = torch.ones_like(params.data)
-            else:
-                print("INVALID ROUNDING")
-                print("EXITING")
-            '''    
-            if noise:
-                delta = torch.bernoulli(torch.ones_like(params.data)*ratio)
-                params.data = (params.data + delta) % 2
-            '''
+    round_scores_(cp_model, round_scheme, noise, ratio)
 
     if isinstance(model, nn.parallel.DistributedDataParallel):
         cp_model = nn.parallel.DistributedDataParallel(
@@ -355,6 +380,34 @@ def round_model(model, round_scheme, noise=False, ratio=0.0, rank=None):
     return cp_model
 
 
+# the model itself with its scores rounded, restored on exit. costs one score-sized buffer
+# instead of a copy of the model (round_model), and a DDP model stays wrapped as it is:
+#   with rounded_model(model, parser_args.round) as cp_model:
+#       validate(..., cp_model, ...)
+@contextlib.contextmanager
+def rounded_model(model, round_scheme, noise=False, ratio=0.0):
+    module = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+    if any(isinstance(m, FactorizedScores) and m.is_factorized() for m in module.modules()):
+        # hashed / low-rank scores can't be rounded in place
+        yield round_model(model, round_scheme, noise, ratio, rank=parser_args.gpu)
+        return
+
+    print("Rounding model with scheme: {}".format(round_scheme))
+    params = score_parameters(model)
+    saved = [p.data.clone() for _, p in params]
+    try:
+        with torch.no_grad():
+            for name, p in params:
+                round_scores_tensor_(name, p, round_scheme, noise, ratio)
+        yield model
+    finally:
+        # copy_ into the parameters themselves (not their .data), so the version the mask
+        # caches key on changes and no rounded masked weight outlives the context
+        with torch.no_grad():
+            for (_, p), s in zip(params, saved):
+                p.copy_(s)
+
+
 """
 def get_score_sparsity_hc(model):
     sparsity = []
@@ -374,6 +427,125 @@ def get_score_sparsity_hc(model):
 """
 
 
+def is_prunable(layer):
+    return isinstance(layer, SubnetStrategyLayer) and not getattr(layer, 'keep_all_channels', False)
+
+
+# KthValueTracker per threshold ('weights' / 'biases') for --incremental-threshold
+threshold_trackers = {}
+
+
+# the value at position k - 1 of the sorted scores (with python's wrap around for k = 0),
+# incrementally when a tracker name is given
+def sorted_scores_at(scores, k, descending, tracker=None):
+    n = scores.numel()
+    if tracker is None or n == 0:
+        return torch.sort(scores, descending=descending).values[k-1].item()
+    if tracker not in threshold_trackers:
+        threshold_trackers[tracker] = KthValueTracker(parser_args.threshold_refresh)
+    index = int(k - 1) % n
+    rank = n - index if descending else index + 1
+    return threshold_trackers[tracker].kth(scores, rank)
+
+
+# --prune-chunk-size, rounded to whole flag bytes
+def prune_chunk_size():
+    if parser_args.prune_chunk_size is None:
+        return None
+    return max(8, parser_args.prune_chunk_size // 8 * 8)
+
+
+# (flat scores, packed flag) of the weights or the biases of a layer. detach() rather than
+# .data, so in-place writes (mask_scores_) bump the version the mask caches key on
+def score_flag_pair(layer, bias=False):
+    if bias:
+        return layer.bias_scores.detach().reshape(-1), layer.bias_flag_bits
+    return layer.scores.detach().reshape(-1), layer.flag_bits
+
+
+# (start, end, scores, flag) of the layer, chunk_size entries at a time
+def score_chunks(layer, chunk_size, bias=False):
+    scores, bits = score_flag_pair(layer, bias)
+    for start in range(0, scores.numel(), chunk_size):
+        end = min(start + chunk_size, scores.numel())
+        flag = unpack_bits(bits[start // 8:(end + 7) // 8], (end - start,), torch.bool)
+        yield start, end, scores[start:end], flag
+
+
+# same as sorted_scores_at on the concatenation of the active |scores| of the layers
+# (num_active of them), by a radix select over chunks (utils/selection.py)
+def chunked_sorted_scores_at(layers, k, descending, num_active, chunk_size, bias=False):
+    def chunks():
+        for layer in layers:
+            for _, _, scores, flag in score_chunks(layer, chunk_size, bias):
+                yield scores[flag].abs()
+    index = int(k - 1) % max(num_active, 1)
+    rank = num_active - index if descending else index + 1
+    return chunked_kthvalue(chunks, rank)
+
+
+# flag &= keep(scores) chunk by chunk, in place (the flag stays the same buffer)
+def and_flags_(layer, keep, chunk_size, bias=False):
+    scores, bits = score_flag_pair(layer, bias)
+    with torch.no_grad():
+        for start in range(0, scores.numel(), chunk_size):
+            end = min(start + chunk_size, scores.numel())
+            bits[start // 8:(end + 7) // 8].bitwise_and_(pack_bits(keep(scores[start:end], start)))
+
+
+# scores *= flag chunk by chunk, in place
+def mask_scores_(layer, chunk_size, bias=False):
+    with torch.no_grad():
+        for _, _, scores, flag in score_chunks(layer, chunk_size, bias):
+            scores.mul_(flag.to(scores.dtype))
+
+
+# the flag update of the BottomK / LocalBottomK prune steps with --prune-chunk-size. With
+# num_to_prune (LocalBottomK), if more than num_to_prune weights would go (ties at the
+# threshold), a uniformly random subset of them is revived
+def prune_layer_chunked(layer, scores_threshold, bias_scores_threshold, update_scores, chunk_size,
+                        num_to_prune=None):
+    if parser_args.invert_sanity_check:
+        and_flags_(layer, lambda s, start: torch.lt(s.abs(), scores_threshold), chunk_size)
+    elif num_to_prune is None:
+        and_flags_(layer, lambda s, start: torch.gt(s.abs(), scores_threshold), chunk_size)
+    else:
+        # weights being pruned per chunk
+        counts = [(flag & torch.le(scores.abs(), scores_threshold)).sum().item()
+                  for _, _, scores, flag in score_chunks(layer, chunk_size)]
+        num_left = sum(counts)
+        num_to_revive = max(num_left - int(num_to_prune), 0)
+        # how many of the revived ones fall in each chunk (sampling without replacement)
+        revived = []
+        for count in counts:
+            drawn = 0
+            if num_to_revive > 0 and count > 0:
+                drawn = int(np.random.hypergeometric(count, num_left - count, num_to_revive))
+            revived.append(drawn)
+            num_left -= count
+            num_to_revive -= drawn
+
+        def keep(s, start):
+            keep_mask = torch.gt(s.abs(), scores_threshold)
+            j = start // chunk_size
+            if revived[j] > 0:
+                _, bits = score_flag_pair(layer)
+                flag = unpack_bits(bits[start // 8:(start + s.numel() + 7) // 8], (s.numel(),), torch.bool)
+                pruned = torch.nonzero(flag & ~keep_mask).reshape(-1)
+                keep_mask[pruned[torch.randperm(pruned.numel(), device=pruned.device)[:revived[j]]]] = True
+            return keep_mask
+        and_flags_(layer, keep, chunk_size)
+    if update_scores:
+        mask_scores_(layer, chunk_size)
+    if parser_args.bias:
+        if parser_args.invert_sanity_check:
+            and_flags_(layer, lambda s, start: torch.lt(s, bias_scores_threshold), chunk_size, bias=True)
+        else:
+            and_flags_(layer, lambda s, start: torch.gt(s, bias_scores_threshold), chunk_size, bias=True)
+        if update_scores:
+            mask_scores_(layer, chunk_size, bias=True)
+
+
 def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_half_weights=False):
     if update_thresholds_only:
         pass
@@ -386,13 +558,19 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
         print('Warning: Using prune() in {}. Are you sure?'.format(parser_args.algo))
 
     conv_layers, linear_layers = get_layers(parser_args.arch, model)
+    # with channel masks the classifier keeps all of its outputs (see keep_classifier_channels),
+    # and a compacted model (utils/compaction.py) has plain dense layers
+    conv_layers = [l for l in conv_layers if is_prunable(l)]
+    linear_layers = [l for l in linear_layers if is_prunable(l)]
+    if len(conv_layers + linear_layers) == 0:
+        return scores_threshold, bias_scores_threshold
 
     if parser_args.prune_type == 'FixThresholding':
         if parser_args.algo == 'hc_iter':  # and update_thresholds_only == False:
             # prune weights that would be rounded to 0
             for layer in (conv_layers + linear_layers):
-                layer.flag.data = (layer.flag.data + torch.gt(layer.scores,
-                                   torch.ones_like(layer.scores)*0.5).int() == 2).int()
+                layer.flag_bits = and_bits(layer.flag_bits, torch.gt(layer.scores,
+                                           torch.ones_like(layer.scores)*0.5))
         else:
             raise NotImplementedError
 
@@ -405,11 +583,12 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
         active_weights_list = []
         active_bias_list = []
         for layer in (conv_layers + linear_layers):
-            num_active_weights += layer.flag.data.sum().item()
-            active_weights = (layer.weight.data[layer.flag.data == 1]).clone()
+            num_active_weights += count_bits(layer.flag_bits)
+            # |weight| per score (per channel for the channel layers)
+            active_weights = (layer.weight_magnitude()[layer.flag.data == 1]).clone()
             active_weights_list.append(active_weights)
             if parser_args.bias:
-                num_active_biases += layer.bias_flag.data.sum().item()
+                num_active_biases += count_bits(layer.bias_flag_bits)
                 active_biases = (
                     layer.bias.data[layer.bias_flag.data == 1]).clone()
                 active_bias_list.append(active_biases)
@@ -435,11 +614,11 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
 
         for layer in (conv_layers + linear_layers):
             if parser_args.invert_sanity_check:
-                weight_mask = torch.lt(layer.weight.abs(),  # TODO
-                        torch.ones_like(layer.weight)*weight_threshold).int()
+                weight_mask = torch.lt(layer.weight_magnitude(),  # TODO
+                        torch.ones_like(layer.scores)*weight_threshold).int()
             else:
-                weight_mask = torch.gt(layer.weight.abs(),  # TODO
-                        torch.ones_like(layer.weight)*weight_threshold).int()
+                weight_mask = torch.gt(layer.weight_magnitude(),  # TODO
+                        torch.ones_like(layer.scores)*weight_threshold).int()
 
             # apply mask to scores
             layer.scores.data = torch.ones_like(layer.scores.data) * weight_mask
@@ -454,36 +633,65 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
 
     # prune the bottom k of scores.abs()
     elif parser_args.prune_type == 'BottomK':
-        num_active_weights = 0
-        num_active_biases = 0
-        active_scores_list = []
-        active_bias_scores_list = []
-        for layer in (conv_layers + linear_layers):
-            num_active_weights += layer.flag.data.sum().item()
-            active_scores = (layer.scores.data[layer.flag.data == 1]).clone()
-            active_scores_list.append(active_scores)
-            if parser_args.bias:
-                num_active_biases += layer.bias_flag.data.sum().item()
-                active_biases = (
-                    layer.bias_scores.data[layer.bias_flag.data == 1]).clone()
-                active_bias_scores_list.append(active_biases)
+        arena = get_score_arena(model)
+        # the per batch threshold updates of global_ep only move a little from batch to batch
+        incremental = update_thresholds_only and parser_args.incremental_threshold
+        # the thresholds by a selection over chunks, without the concatenation
+        chunk_size = None if incremental else prune_chunk_size()
+        if chunk_size is not None:
+            num_active_weights = sum(count_bits(layer.flag_bits) for layer in (conv_layers + linear_layers))
+            num_active_biases = sum(count_bits(layer.bias_flag_bits) for layer in (conv_layers + linear_layers)) \
+                if parser_args.bias else 0
+        elif arena is not None:
+            # one gather over the flat scores (utils/score_arena.py)
+            agg_scores, agg_bias_scores = arena.active_scores(conv_layers + linear_layers)
+            num_active_weights = agg_scores.numel()
+            num_active_biases = agg_bias_scores.numel() if parser_args.bias else 0
+            if not parser_args.bias:
+                agg_bias_scores = torch.tensor([])
+        else:
+            num_active_weights = 0
+            num_active_biases = 0
+            active_scores_list = []
+            active_bias_scores_list = []
+            for layer in (conv_layers + linear_layers):
+                num_active_weights += count_bits(layer.flag_bits)
+                active_scores = (layer.scores.data[layer.flag.data == 1]).clone()
+                active_scores_list.append(active_scores)
+                if parser_args.bias:
+                    num_active_biases += count_bits(layer.bias_flag_bits)
+                    active_biases = (
+                        layer.bias_scores.data[layer.bias_flag.data == 1]).clone()
+                    active_bias_scores_list.append(active_biases)
+
+            agg_scores = torch.cat(active_scores_list)
+            agg_bias_scores = torch.cat(
+                active_bias_scores_list) if parser_args.bias else torch.tensor([])
 
         number_of_weights_to_prune = np.ceil(
             parser_args.prune_rate * num_active_weights).astype(int)
         number_of_biases_to_prune = np.ceil(
             parser_args.prune_rate * num_active_biases).astype(int)
 
-        agg_scores = torch.cat(active_scores_list)
-        agg_bias_scores = torch.cat(
-            active_bias_scores_list) if parser_args.bias else torch.tensor([])
-
         # if invert_sanity_check, then threshold is based on sorted scores in descending order, and we prune all scores ABOVE it
-        scores_threshold = torch.sort(
-            torch.abs(agg_scores), descending=parser_args.invert_sanity_check).values[number_of_weights_to_prune-1].item()
+        if chunk_size is not None:
+            scores_threshold = chunked_sorted_scores_at(
+                conv_layers + linear_layers, number_of_weights_to_prune, parser_args.invert_sanity_check,
+                num_active_weights, chunk_size)
+        else:
+            scores_threshold = sorted_scores_at(
+                torch.abs(agg_scores), number_of_weights_to_prune, parser_args.invert_sanity_check,
+                tracker='weights' if incremental else None)
 
         if parser_args.bias:
-            bias_scores_threshold = torch.sort(
-                torch.abs(agg_bias_scores), descending=parser_args.invert_sanity_check).values[number_of_biases_to_prune-1].item()
+            if chunk_size is not None:
+                bias_scores_threshold = chunked_sorted_scores_at(
+                    conv_layers + linear_layers, number_of_biases_to_prune, parser_args.invert_sanity_check,
+                    num_active_biases, chunk_size, bias=True)
+            else:
+                bias_scores_threshold = sorted_scores_at(
+                    torch.abs(agg_bias_scores), number_of_biases_to_prune, parser_args.invert_sanity_check,
+                    tracker='biases' if incremental else None)
         else:
             bias_scores_threshold = -1
 
@@ -495,21 +703,24 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
 
         else:
             for layer in (conv_layers + linear_layers):
+                if chunk_size is not None:
+                    prune_layer_chunked(layer, scores_threshold, bias_scores_threshold, update_scores, chunk_size)
+                    continue
                 if parser_args.invert_sanity_check:
-                    layer.flag.data = (layer.flag.data + torch.lt(layer.scores.abs(),  # TODO
-                                       torch.ones_like(layer.scores)*scores_threshold).int() == 2).int()
+                    layer.flag_bits = and_bits(layer.flag_bits, torch.lt(layer.scores.abs(),  # TODO
+                                               torch.ones_like(layer.scores)*scores_threshold))
                 else:
-                    layer.flag.data = (layer.flag.data + torch.gt(layer.scores.abs(),  # TODO
-                                       torch.ones_like(layer.scores)*scores_threshold).int() == 2).int()
+                    layer.flag_bits = and_bits(layer.flag_bits, torch.gt(layer.scores.abs(),  # TODO
+                                               torch.ones_like(layer.scores)*scores_threshold))
                 if update_scores:
                     layer.scores.data = layer.scores.data * layer.flag.data
                 if parser_args.bias:
                     if parser_args.invert_sanity_check:
-                        layer.bias_flag.data = (layer.bias_flag.data + torch.lt(layer.bias_scores, torch.ones_like(
-                            layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                        layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.lt(layer.bias_scores, torch.ones_like(
+                            layer.bias_scores)*bias_scores_threshold))
                     else:
-                        layer.bias_flag.data = (layer.bias_flag.data + torch.gt(layer.bias_scores, torch.ones_like(
-                            layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                        layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.gt(layer.bias_scores, torch.ones_like(
+                            layer.bias_scores)*bias_scores_threshold))
                     if update_scores:
                         layer.bias_scores.data = layer.bias_scores.data * layer.bias_flag.data
 
@@ -528,17 +739,42 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
 
     # prune the bottom k of scores.abs()
     elif parser_args.prune_type == 'LocalBottomK':
+       chunk_size = prune_chunk_size()
        for layer in (conv_layers + linear_layers):
+            if chunk_size is not None:
+                # per layer radix select over chunks, flags updated in place
+                num_active_weights = count_bits(layer.flag_bits)
+                number_of_weights_to_prune = np.ceil(
+                    parser_args.prune_rate * num_active_weights).astype(int)
+                scores_threshold = chunked_sorted_scores_at(
+                    [layer], number_of_weights_to_prune, parser_args.invert_sanity_check,
+                    num_active_weights, chunk_size)
+                if parser_args.bias:
+                    num_active_biases = count_bits(layer.bias_flag_bits)
+                    number_of_biases_to_prune = np.ceil(
+                        parser_args.prune_rate * num_active_biases).astype(int)
+                    bias_scores_threshold = chunked_sorted_scores_at(
+                        [layer], number_of_biases_to_prune, parser_args.invert_sanity_check,
+                        num_active_biases, chunk_size, bias=True)
+                else:
+                    bias_scores_threshold = -1
+                if update_thresholds_only:
+                    layer.scores_prune_threshold = scores_threshold
+                else:
+                    prune_layer_chunked(layer, scores_threshold, bias_scores_threshold, update_scores, chunk_size,
+                                        num_to_prune=number_of_weights_to_prune)
+                continue
+
             num_active_weights = 0
             num_active_biases = 0
             active_scores_list = []
             active_bias_scores_list = []
 
-            num_active_weights += layer.flag.data.sum().item()
+            num_active_weights += count_bits(layer.flag_bits)
             active_scores = (layer.scores.data[layer.flag.data == 1]).clone()
             active_scores_list.append(active_scores)
             if parser_args.bias:
-                num_active_biases += layer.bias_flag.data.sum().item()
+                num_active_biases += count_bits(layer.bias_flag_bits)
                 active_biases = (
                     layer.bias_scores.data[layer.bias_flag.data == 1]).clone()
                 active_bias_scores_list.append(active_biases)
@@ -578,105 +814,147 @@ def prune(model, update_thresholds_only=False, update_scores=False, drop_bottom_
                     flat_flag[weights_to_revive] = 1
 
                 if parser_args.invert_sanity_check:
-                    layer.flag.data = (layer.flag.data + torch.lt(layer.scores.abs(),  # TODO
-                                       torch.ones_like(layer.scores)*scores_threshold).int() == 2).int()
+                    layer.flag_bits = and_bits(layer.flag_bits, torch.lt(layer.scores.abs(),  # TODO
+                                               torch.ones_like(layer.scores)*scores_threshold))
                 else:
-                    layer.flag.data = (layer.flag.data + new_flag == 2).int()
+                    layer.flag_bits = and_bits(layer.flag_bits, new_flag)
                 if update_scores:
                     layer.scores.data = layer.scores.data * layer.flag.data
                 if parser_args.bias:
                     if parser_args.invert_sanity_check:
-                        layer.bias_flag.data = (layer.bias_flag.data + torch.lt(layer.bias_scores, torch.ones_like(
-                            layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                        layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.lt(layer.bias_scores, torch.ones_like(
+                            layer.bias_scores)*bias_scores_threshold))
                     else:
-                        layer.bias_flag.data = (layer.bias_flag.data + torch.gt(layer.bias_scores, torch.ones_like(
-                            layer.bias_scores)*bias_scores_threshold).int() == 2).int()
+                        layer.bias_flag_bits = and_bits(layer.bias_flag_bits, torch.gt(layer.bias_scores, torch.ones_like(
+                            layer.bias_scores)*bias_scores_threshold))
                     if update_scores:
                         layer.bias_scores.data = layer.bias_scores.data * layer.bias_flag.data
 
     return scores_threshold, bias_scores_threshold
 
 
+# sets the global EP thresholds the model's forward would use, before reading the masks outside of a forward
+def update_forward_thresholds(model):
+    if parser_args.algo in ['global_ep', 'global_ep_iter'] or parser_args.bottom_k_on_forward:
+        prune(model, update_thresholds_only=True)
+
+
 # returns avg_sparsity = number of non-zero weights!
 def get_model_sparsity(model, threshold=0):
+    table = sparsity_table(model, threshold)
+    numer = sum(row['active'] for row in table)
+    denom = sum(row['total'] for row in table)
+    if parser_args.bias:
+        numer += sum(row['bias_active'] for row in table)
+        denom += sum(row['bias_total'] for row in table)
+    # print('Overall sparsity: {}/{} ({:.2f} %)'.format((int)(numer), denom, 100*numer/denom))
+    return 100*numer/denom
+
+
+# one row per conv / linear layer (in get_layers order): name, kept and total weights,
+# kept and total bias entries, fractional (non-binary) hc scores and the density in %.
+# The counts of all the layers are stacked on the device and copied back at once
+def sparsity_table(model, threshold=0):
     if isinstance(model, nn.parallel.DistributedDataParallel):
         model = model.module
     conv_layers, linear_layers = get_layers(parser_args.arch, model)
-    numer = 0
-    denom = 0
-
-    # TODO: find a nicer way to do this (skip dropout)
-    # TODO: Update: can't use .children() or .named_modules() because of the way things are wrapped in builder
-    for conv_layer in conv_layers:
-        w_numer, w_denom, b_numer, b_denom = get_layer_sparsity(
-            conv_layer, threshold)
-        numer += w_numer
-        denom += w_denom
-        if parser_args.bias:
-            numer += b_numer
-            denom += b_denom
-
-    for lin_layer in linear_layers:
-        w_numer, w_denom, b_numer, b_denom = get_layer_sparsity(
-            lin_layer, threshold)
-        numer += w_numer
-        denom += w_denom
-        if parser_args.bias:
-            numer += b_numer
-            denom += b_denom
-    # print('Overall sparsity: {}/{} ({:.2f} %)'.format((int)(numer), denom, 100*numer/denom))
-    return 100*numer/denom
+    layers = conv_layers + linear_layers
+    names = {m: name for name, m in model.named_modules()}
+    counts = [layer_sparsity_counts(layer, threshold) for layer in layers]
+    if len(counts) == 0:
+        return []
+    counts = torch.stack([c.to(counts[0].device) for c in counts]).cpu().tolist()
+
+    table = []
+    for layer, (w_numer, w_denom, b_numer, b_denom, num_middle) in zip(layers, counts):
+        table.append({
+            'name': names.get(layer, type(layer).__name__),
+            'active': w_numer,
+            'total': w_denom,
+            'bias_active': b_numer,
+            'bias_total': b_denom,
+            'fractional': int(num_middle),
+            'density': 100.0 * w_numer / w_denom if w_denom > 0 else 0.0,
+        })
+    if any(row['fractional'] > 0 for row in table):
+        print("WARNING: Model scores are not binary. Sparsity number is unreliable.")
+        raise ValueError
+    return table
 
 
 # returns num_nonzero elements, total_num_elements so that it is easier to compute
 # average sparsity in the end
 def get_layer_sparsity(layer, threshold=0):
+    w_numer, w_denom, b_numer, b_denom, num_middle = layer_sparsity_counts(layer, threshold).tolist()
+    if num_middle > 0:
+        print("WARNING: Model scores are not binary. Sparsity number is unreliable.")
+        raise ValueError
+    return w_numer, w_denom, b_numer, b_denom
+
+
+# (w_numer, w_denom, b_numer, b_denom, num_middle) as a float64 tensor on the layer's
+# device, without syncing with the host
+def layer_sparsity_counts(layer, threshold=0):
+    # a seeded weight would be generated just to read its device
+    device = layer.weight_device() if isinstance(layer, SeededWeights) else layer.weight.device
+    if getattr(layer, 'keep_all_channels', False):
+        numel = layer.weight.numel()
+        return torch.tensor([numel, numel, 0, 0, 0], dtype=torch.float64, device=device)
+
+    zero = torch.zeros((), dtype=torch.float64, device=device)
+    num_middle = zero
+    b_numer, b_denom = zero, 0
     if parser_args.algo in ['hc', 'hc_iter'] and not parser_args.bottom_k_on_forward:
         # assume the model is rounded, compute effective scores
-        eff_scores = layer.scores * layer.flag
-        if parser_args.bias:
-            eff_bias_scores = layer.bias_scores * layer.bias_flag
-        num_middle = torch.sum(torch.gt(eff_scores,
-                               torch.ones_like(eff_scores)*threshold) *
-                               torch.lt(eff_scores,
-                               torch.ones_like(eff_scores.detach()*(1-threshold)).int()))
-        if num_middle > 0:
-            print("WARNING: Model scores are not binary. Sparsity number is unreliable.")
-            raise ValueError
-        w_numer, w_denom = eff_scores.detach().sum(
-        ).item(), eff_scores.detach().flatten().numel()
-
+        eff_scores = (layer.scores * layer.flag).detach()
+        num_middle = torch.sum(torch.gt(eff_scores, threshold) & torch.lt(eff_scores, 1))
+        w_numer, w_denom = eff_scores.sum(dtype=torch.float64), eff_scores.numel()
         if parser_args.bias:
-            b_numer, b_denom = eff_bias_scores.detach().sum(
-            ).item(), eff_bias_scores.detach().flatten().numel()
-        else:
-            b_numer, b_denom = 0, 0
+            eff_bias_scores = (layer.bias_scores * layer.bias_flag).detach()
+            b_numer, b_denom = eff_bias_scores.sum(dtype=torch.float64), eff_bias_scores.numel()
 
-    elif parser_args.algo in ['global_ep', 'ep', 'global_ep_iter'] or parser_args.bottom_k_on_forward:
-        if parser_args.algo == 'ep':
-            weight_mask, bias_mask = GetSubnetConv.apply(
-                layer.scores.abs(), layer.bias_scores.abs(), parser_args.prune_rate)
-        else:
+    else:
+        if parser_args.algo != 'ep' and (parser_args.algo in ['global_ep', 'global_ep_iter'] or parser_args.bottom_k_on_forward):
             weight_mask, bias_mask = GetSubnetConv.apply(layer.scores.abs(), layer.bias_scores.abs(
             ), 0, layer.scores_prune_threshold, layer.bias_scores_prune_threshold)
-        w_numer, w_denom = weight_mask.sum().item(), weight_mask.flatten().numel()
-
-        if parser_args.bias:
-            b_numer, b_denom = bias_mask.sum().item(), bias_mask.flatten().numel()
         else:
-            b_numer, b_denom = 0, 0
-    else:
-        # traditional pruning where we just check non-zero values in mask
-        weight_mask, bias_mask = GetSubnetConv.apply(
-            layer.scores.abs(), layer.bias_scores.abs(), parser_args.prune_rate)
-        w_numer, w_denom = weight_mask.sum().item(), weight_mask.flatten().numel()
-
+            # ep, and traditional pruning where we just check non-zero values in mask
+            weight_mask, bias_mask = GetSubnetConv.apply(
+                layer.scores.abs(), layer.bias_scores.abs(), parser_args.prune_rate)
+        w_numer, w_denom = weight_mask.detach().sum(dtype=torch.float64), weight_mask.numel()
         if parser_args.bias:
-            b_numer, b_denom = bias_mask.sum().item(), bias_mask.flatten().numel()
-            # bias_sparsity = 100.0 * bias_mask.sum().item() / bias_mask.flatten().numel()
-        else:
-            b_numer, b_denom = 0, 0
-    return w_numer, w_denom, b_numer, b_denom
+            b_numer, b_denom = bias_mask.detach().sum(dtype=torch.float64), bias_mask.numel()
+
+    if isinstance(layer, ChannelSubnetLayer):
+        # one score per output channel, each one covers a whole filter / row of the weight
+        w_numer, w_denom = w_numer * layer.channel_numel(), w_denom * layer.channel_numel()
+    w_denom = zero + w_denom
+    b_denom = zero + b_denom
+    return torch.stack([w_numer, w_denom, b_numer, b_denom, num_middle.double()])
+
+
+# named_parameters, with the live scores in place of the full ones for the layers in
+# active-set mode (utils/active_set.py)
+# replaces old by new in the optimizer, its state goes along. transform maps the state
+# tensors shaped like old (e.g. to another dtype, or to a subset of the entries)
+def swap_optimizer_param(optimizer, old, new, transform=None):
+    for group in optimizer.param_groups:
+        for i, p in enumerate(group['params']):
+            if p is old:
+                group['params'][i] = new
+    state = optimizer.state.pop(old, None)
+    if state is not None:
+        optimizer.state[new] = {k: (transform(v) if transform is not None and torch.is_tensor(v) and v.shape == old.shape else v)
+                                for k, v in state.items()}
+
+
+def reg_parameters(model):
+    active = {name + '.scores': m.active_scores for name, m in model.named_modules()
+              if getattr(m, 'active_idx', None) is not None}
+    for name, params in model.named_parameters():
+        if name.endswith('.active_scores'):
+            continue
+        yield name, active.get(name, params)
 
 
 def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_prime=1):
@@ -688,8 +966,8 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
         # reg_loss =  \sum_{i} w_i^2 * p_i(1-p_i)
         # NOTE: alpha = alpha' = 1 here. Change if needed.
         reg_sum = torch.tensor(0.).cuda()
-        w_i = layer.weight
-        p_i = layer.scores
+        w_i = layer.gather_active(layer.weight)
+        p_i = layer.trainable_scores()
         reg_sum += torch.sum(torch.pow(w_i, 2) *
                              torch.pow(p_i, 1) * torch.pow(1-p_i, 1))
         if parser_args.bias:
@@ -699,11 +977,22 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
                                  torch.pow(p_i, 1) * torch.pow(1-p_i, 1))
         return reg_sum
 
+    # the elementwise regularizers in one pass over the score arena
+    arena = get_score_arena(model)
+    if arena is not None and regularizer in ['L2', 'L1', 'L1_L2', 'var_red_1']:
+        fn = {
+            'L2': lambda p: p * p,
+            'L1': lambda p: p.abs(),
+            'L1_L2': lambda p: p.abs() + p * p,
+            'var_red_1': lambda p: torch.pow(p, alpha) * torch.pow(1-p, alpha_prime),
+        }[regularizer]
+        return lmbda * arena.regularization(fn, bias=parser_args.bias)
+
     #pdb.set_trace()
     regularization_loss = torch.tensor(0.).cuda()
     if regularizer == 'L2':
         # reg_loss =  ||p||_2^2
-        for name, params in model.named_parameters():
+        for name, params in reg_parameters(model):
             if ".bias_score" in name:
                 if parser_args.bias:
                     regularization_loss += torch.norm(params, p=2)**2
@@ -714,7 +1003,7 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
 
     elif regularizer == 'L1':
         # reg_loss =  ||p||_1
-        for name, params in model.named_parameters():
+        for name, params in reg_parameters(model):
             if ".bias_score" in name:
                 if parser_args.bias:
                     regularization_loss += torch.norm(params, p=1)
@@ -725,7 +1014,7 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
 
     elif regularizer == 'L1_L2':
         # reg_loss =  ||p||_1 + ||p||_2^2
-        for name, params in model.named_parameters():
+        for name, params in reg_parameters(model):
             if ".bias_score" in name:
                 if parser_args.bias:
                     regularization_loss += torch.norm(params, p=1)
@@ -738,7 +1027,7 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
 
     elif regularizer == 'var_red_1':
         # reg_loss = lambda * p^{alpha} (1-p)^{alpha'}
-        for name, params in model.named_parameters():
+        for name, params in reg_parameters(model):
             if ".bias_score" in name:
                 if parser_args.bias:
                     regularization_loss += torch.sum(
@@ -764,7 +1053,7 @@ def get_regularization_loss(model, regularizer='L2', lmbda=1, alpha=1, alpha_pri
     elif regularizer == 'bin_entropy':
         # reg_loss = -p \log(p) - (1-p) \log(1-p)
         # NOTE: This will be nan because log(0) = inf. therefore, ignoring the end points
-        for name, params in model.named_parameters():
+        for name, params in reg_parameters(model):
             if ".bias_score" in name:
                 if parser_args.bias:
                     params_filt = params[(params > 0) & (params < 1)]
@@ -0,0 +1,273 @@
+"""
+Frozen-prefix activation cache for validate() (--prefix-cache).
+
+When only pruning, the first layers of the network (and whole early stages once their
+masks stop moving) give the same activations for the same evaluation images on every
+validate(). With the cache, the model is cut into units in definition order (its
+children, with nn.Sequential containers expanded, so a residual block is one unit) and
+every validate() fingerprints each unit: masked weights for the subnet layers,
+parameters and buffers (batchnorm statistics) otherwise, as in utils/eval_cache.py.
+
+- the frozen prefix is the longest run of leading units whose fingerprints match one of
+  the last HISTORY evaluations on the same loader (the unrounded and the rounded model
+  are both seen every epoch)
+- the first time a prefix is frozen, the output of its last unit is captured for the
+  whole split during a normal validate(): in host memory (memory) or in a .npy file
+  under <--data>/prefix_cache/ that is memory mapped (mmap)
+- after that, while the fingerprints of the prefix match the ones it was captured with,
+  the prefix units return an empty tensor and the last one returns the cached batch,
+  so the forward resumes from there. A deeper frozen prefix is captured on the way
+
+A cut is only used after a check on the first batch that the forward resumed from it
+gives the same logits as the full forward (units defined out of forward order, or later
+layers taking anything from inside the prefix, break that). Only loaders that go over
+their split in a fixed order with no random transform are cached (shuffled loaders,
+like the train loader, are not).
+"""
+import collections
+import contextlib
+import hashlib
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.eval_cache import fingerprint_tensors, loader_key, tensor_fingerprint
+
+
+PREFIX_CACHE_MODES = ['memory', 'mmap']
+# evaluations per loader whose fingerprints are remembered
+HISTORY = 4
+# captured prefixes kept per loader
+MAX_ENTRIES = 2
+
+
+def prefix_units(model):
+    units = []
+
+    def expand(module, prefix):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Sequential):
+                expand(child, prefix + name + '.')
+            else:
+                units.append((prefix + name, child))
+    expand(model, '')
+    return units
+
+
+# one digest per unit (None from the first unit with a random output on)
+def unit_digests(units):
+    parts, counts = [], []
+    with torch.no_grad():
+        for _, unit in units:
+            unit_parts = []
+            for m in unit.modules():
+                tensors = fingerprint_tensors(m)
+                if tensors is None:
+                    unit_parts = None
+                    break
+                unit_parts += [tensor_fingerprint(t) for t in tensors]
+            if unit_parts is None:
+                break
+            parts += unit_parts
+            counts.append(len(unit_parts))
+    # a single copy back to the host
+    rows = torch.stack([p.to(parts[0].device) for p in parts]).cpu().numpy() if parts else None
+    digests, start = [], 0
+    for count in counts:
+        digests.append(hashlib.sha1(rows[start:start + count].tobytes() if count else b'').hexdigest())
+        start += count
+    return digests + [None] * (len(units) - len(digests))
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x is None or x != y:
+            break
+        n += 1
+    return n
+
+
+def ordered_loader(loader):
+    if hasattr(loader, 'images'):
+        # EvalTensorLoader (data/eval_store.py)
+        return True
+    return isinstance(getattr(loader, 'sampler', None), torch.utils.data.SequentialSampler)
+
+
+class Activations(object):
+    # the captured outputs of the cut unit, batch by batch
+    def __init__(self, mode, path=None):
+        self.mode = mode
+        self.path = path
+        self.batches = []
+        self.array = None
+        self.sizes = []
+
+    def append(self, out, num_samples):
+        out = out.detach()
+        if self.mode == 'memory':
+            self.batches.append(out.cpu().pin_memory() if out.is_cuda else out.cpu())
+        else:
+            if self.array is None:
+                self.array = np.lib.format.open_memmap(
+                    self.path, mode='w+', dtype=np.float32, shape=(num_samples,) + tuple(out.shape[1:]))
+            start = sum(self.sizes)
+            self.array[start:start + out.size(0)] = out.float().cpu().numpy()
+        self.sizes.append(out.size(0))
+
+    def finish(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = np.load(self.path, mmap_mode='r')
+            self.offsets = np.cumsum([0] + self.sizes)
+
+    def get(self, idx, device):
+        if self.mode == 'memory':
+            return self.batches[idx].to(device, non_blocking=True)
+        start = self.offsets[idx]
+        return torch.from_numpy(np.array(self.array[start:start + self.sizes[idx]])).to(device, non_blocking=True)
+
+    def release(self):
+        self.batches = []
+        self.array = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+@contextlib.contextmanager
+def patched_forward(module, units, replay=None, capture=None):
+    # replay: (cut, Activations), the units up to the cut are skipped. capture: (cut,
+    # callback), called with the output of unit cut - 1 on every batch
+    state = {'batch': -1}
+    handles = [module.register_forward_pre_hook(lambda m, inputs: state.__setitem__('batch', state['batch'] + 1))]
+    patched = []
+    try:
+        if replay is not None:
+            cut, acts = replay
+            for i, (_, unit) in enumerate(units[:cut]):
+                if i < cut - 1:
+                    unit.forward = lambda *args, **kwargs: torch.empty(0)
+                else:
+                    device = next(module.parameters()).device
+                    unit.forward = lambda *args, **kwargs: acts.get(state['batch'], device)
+                patched.append(unit)
+        if capture is not None:
+            cut, callback = capture
+            handles.append(units[cut - 1][1].register_forward_hook(
+                lambda m, inputs, out: callback(state['batch'], out)))
+        yield
+    finally:
+        for unit in patched:
+            del unit.forward
+        for h in handles:
+            h.remove()
+
+
+class PrefixCache(object):
+    def __init__(self, mode='memory', root=None):
+        self.configure(mode, root)
+        # loader key -> digests of the last evaluations
+        self.history = {}
+        # loader key -> [{'cut', 'digests', 'acts'}]
+        self.entries = {}
+        # (model class, cut) -> whether resuming from the cut gives the same logits
+        self.checked = {}
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, mode, root):
+        self.mode = mode
+        self.root = root
+
+    def key(self, loader):
+        if not ordered_loader(loader):
+            return None
+        lkey = loader_key(loader)
+        if lkey is None:
+            return None
+        return lkey + (getattr(loader, 'batch_size', None),)
+
+    def new_activations(self, key, cut, digests):
+        if self.mode == 'memory':
+            return Activations('memory')
+        os.makedirs(self.root, exist_ok=True)
+        name = hashlib.sha1(repr((key, cut, digests[:cut])).encode()).hexdigest()[:16]
+        return Activations('mmap', os.path.join(self.root, name + '.npy'))
+
+    # resuming at cut gives the same logits as the full forward, on the first batch
+    def check_cut(self, module, units, cut, loader, gpu):
+        check_key = (type(module).__name__, cut)
+        if check_key not in self.checked:
+            images, _ = next(iter(loader))
+            if gpu is not None:
+                images = images.cuda(gpu, non_blocking=True)
+            acts = Activations('memory')
+            module.eval()
+            try:
+                with torch.no_grad():
+                    with patched_forward(module, units, capture=(cut, lambda i, out: acts.append(out, 0))):
+                        full = module(images)
+                    with patched_forward(module, units, replay=(cut, acts)):
+                        resumed = module(images)
+                self.checked[check_key] = torch.allclose(full, resumed, rtol=1e-4, atol=1e-5)
+            except Exception:
+                self.checked[check_key] = False
+            if not self.checked[check_key]:
+                print("=> Prefix cache: can't resume {} after {}".format(type(module).__name__, units[cut - 1][0]))
+        return self.checked[check_key]
+
+    # validate with the same signature, resuming the forward after the frozen prefix
+    def wrap(self, validate):
+        def prefix_validate(val_loader, model, criterion, args, writer, epoch):
+            key = self.key(val_loader)
+            if key is None:
+                return validate(val_loader, model, criterion, args, writer, epoch)
+            module = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+            units = prefix_units(module)
+            digests = unit_digests(units)
+            history = self.history.setdefault(key, collections.deque(maxlen=HISTORY))
+            # never the last unit, its output is the logits
+            frozen = min(max([common_prefix(digests, d) for d in history] + [0]), len(units) - 1)
+            history.append(digests)
+
+            entries = self.entries.setdefault(key, [])
+            usable = [e for e in entries if common_prefix(digests, e['digests']) >= e['cut']]
+            replay = max(usable, key=lambda e: e['cut']) if usable else None
+            capture = None
+            if frozen > (replay['cut'] if replay else 0) and self.check_cut(module, units, frozen, val_loader, args.gpu):
+                capture = {'cut': frozen, 'digests': digests[:frozen],
+                           'acts': self.new_activations(key, frozen, digests)}
+
+            num_samples = len(val_loader.dataset)
+            with patched_forward(module, units,
+                                 replay=(replay['cut'], replay['acts']) if replay else None,
+                                 capture=(capture['cut'], lambda i, out: capture['acts'].append(out, num_samples)) if capture else None):
+                result = validate(val_loader, model, criterion, args, writer, epoch)
+
+            if replay is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if capture is not None:
+                capture['acts'].finish()
+                entries.append(capture)
+                print("=> Prefix cache: captured the output of {} ({} of {} units)".format(
+                    units[frozen - 1][0], frozen, len(units)))
+                while len(entries) > MAX_ENTRIES:
+                    entries.pop(0)['acts'].release()
+            return result
+        return prefix_validate
+
+    def print_stats(self):
+        print("=> Prefix cache: {} evaluations resumed from a cached prefix, {} full".format(self.hits, self.misses))
+
+
+def check_prefix_cache(args):
+    if args.prefix_cache not in PREFIX_CACHE_MODES:
+        raise ValueError("{} is not a prefix cache mode |memory|mmap|".format(args.prefix_cache))
+
+
+PREFIX_CACHE = PrefixCache()
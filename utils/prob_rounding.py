@@ -0,0 +1,93 @@
+"""
+Batched evaluation of K probabilistic roundings (--round prob).
+
+Evaluating K sampled masks one validate() at a time reads and transforms the whole
+validation set K times. evaluate_prob_rounding() goes over the data once: on every batch
+it runs the model once per sample, with the scores rounded in place to that sample's
+mask (the scores are backed up once and restored at the end, as in rounded_model).
+The masks are written into the score parameters themselves, not their .data, so every
+swap bumps the version the layer mask / weight caches key on.
+
+The mask of sample k is a Bernoulli draw of the clamped scores with a generator seeded
+from (seed_k, layer index), so a mask is reproducible from its seed and is regenerated
+whenever it is needed instead of being stored: per batch for the evaluation, per layer
+for the pairwise distances.
+"""
+import copy
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.eval_utils import accuracy
+from utils.mask_distance import MaskDistance
+from utils.net_utils import score_parameters
+from utils.score_params import FactorizedScores, materialize_scores
+from utils.seeded_init import hash32_int, layer_seed
+
+
+def sample_seeds(base_seed, num_samples):
+    return [hash32_int(base_seed + k) for k in range(num_samples)]
+
+
+def sample_mask(scores, seed, layer_idx):
+    gen = torch.Generator(device=scores.device)
+    gen.manual_seed(layer_seed(seed, layer_idx))
+    return torch.bernoulli(torch.clamp(scores, 0.0, 1.0), generator=gen)
+
+
+# pairwise distances of the K masks (utils/mask_distance.py), accumulated layer by
+# layer. with threshold, the naive rounding (scores > threshold) is added as the last mask
+def mask_distance(model, seeds, threshold=None):
+    dist = MaskDistance(len(seeds) + (threshold is not None))
+    with torch.no_grad():
+        for j, (_, p) in enumerate(score_parameters(model)):
+            masks = [sample_mask(p.data, seed, j).reshape(-1) for seed in seeds]
+            if threshold is not None:
+                masks.append(torch.gt(p.data, threshold).to(p.dtype).reshape(-1))
+            dist.add(torch.stack(masks))
+    return dist
+
+
+# top-1 accuracy of each of the K masks and their mean, in one pass over data_loader, and
+# their pairwise Hamming distances and IoUs (see mask_distance for threshold)
+def evaluate_prob_rounding(model, data_loader, seeds, gpu=None, threshold=None):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        module = model.module
+    else:
+        module = model
+    if any(isinstance(m, FactorizedScores) and m.is_factorized() for m in module.modules()):
+        # hashed / low-rank scores are rounded per weight, on a dense copy
+        model = materialize_scores(copy.deepcopy(model))
+    params = score_parameters(model)
+    saved = [p.data.clone() for _, p in params]
+    correct = torch.zeros(len(seeds), dtype=torch.float64)
+    total = 0
+
+    model.eval()
+    try:
+        with torch.no_grad():
+            for images, target in data_loader:
+                if gpu is not None:
+                    images = images.cuda(gpu, non_blocking=True)
+                    target = target.cuda(gpu, non_blocking=True)
+                for k, seed in enumerate(seeds):
+                    for j, ((_, p), s) in enumerate(zip(params, saved)):
+                        p.copy_(sample_mask(s, seed, j))
+                    acc1, = accuracy(model(images), target, topk=(1,))
+                    correct[k] += acc1.item() * target.size(0) / 100
+                total += target.size(0)
+    finally:
+        with torch.no_grad():
+            for (_, p), s in zip(params, saved):
+                p.copy_(s)
+
+    acc1 = (100 * correct / max(total, 1)).tolist()
+    dist = mask_distance(model, seeds, threshold)
+    return {
+        'seeds': list(seeds),
+        'acc1': acc1,
+        'mean_acc1': float(np.mean(acc1)) if len(acc1) > 0 else 0.0,
+        'hamming': dist.hamming(),
+        'iou': dist.iou(),
+    }
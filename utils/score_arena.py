@@ -0,0 +1,198 @@
+"""
+Flat score / flag arena for the subnet layers (--score-arena).
+
+The scores, bias scores and packed flags of every subnet layer are moved into four flat
+buffers, and each layer's tensors become views of its slot: `layer.scores` stays the
+same nn.Parameter (its .data is the view), `layer.flag_bits` the same buffer name, so
+checkpoints, the optimizer and the per-layer code are unchanged. Slots start on a
+multiple of 8 entries, so a layer's flag bytes line up with its scores and the unpacked
+flag arena is an entry-for-entry mask of the score arena (the padding is 0 in both).
+
+The global operations then work on the whole arena at once:
+
+- clamping the hc scores to [0, 1]: one clamp_
+- the scores / flags that prune() thresholds over: one gather, no torch.cat
+- the L1 / L2 / L1_L2 / var_red_1 regularizers: one elementwise function and sum over
+  the arena, with the gradient handed back to the layer parameters as views of one flat
+  gradient
+
+Code that rebinds a layer's tensor (`layer.flag_bits = ...`, `scores.data = ...`) moves it
+out of the arena; sync(), called at the start of every arena operation, copies such
+tensors back into their slot and rebinds the view (and moves the arena with the model
+on .cuda()).
+"""
+import torch
+import torch.nn as nn
+
+from utils.bitmask import unpack_bits
+from utils.subnet_strategies import SubnetStrategyLayer
+
+
+SLOT_ALIGN = 8
+
+
+def aligned(numel):
+    return (numel + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+
+
+class ScoreArena(object):
+    def __init__(self, layers):
+        self.layers = list(layers)
+        self.offsets, self.bias_offsets = [], []
+        total = bias_total = 0
+        for m in self.layers:
+            self.offsets.append(total)
+            self.bias_offsets.append(bias_total)
+            total += aligned(m.scores.numel())
+            bias_total += aligned(m.bias_scores.numel())
+        self.numel, self.bias_numel = total, bias_total
+        self.device = None
+        self.selections = {}
+        self.sync()
+
+    def allocate(self, device, dtype):
+        self.device = device
+        self.scores = torch.zeros(self.numel, dtype=dtype, device=device)
+        self.bias_scores = torch.zeros(self.bias_numel, dtype=dtype, device=device)
+        self.flag_bits = torch.zeros(self.numel // 8, dtype=torch.uint8, device=device)
+        self.bias_flag_bits = torch.zeros(self.bias_numel // 8, dtype=torch.uint8, device=device)
+        # entries that belong to a layer (not padding)
+        self.valid = torch.zeros(self.numel, dtype=dtype, device=device)
+        self.bias_valid = torch.zeros(self.bias_numel, dtype=dtype, device=device)
+        for m, off, boff in zip(self.layers, self.offsets, self.bias_offsets):
+            self.valid[off:off + m.scores.numel()] = 1
+            self.bias_valid[boff:boff + m.bias_scores.numel()] = 1
+        self.selections = {}
+
+    # (arena, layer attribute, slot view) of every tensor of layer j
+    def slots(self, j):
+        m = self.layers[j]
+        off, boff = self.offsets[j], self.bias_offsets[j]
+        n, bn = m.scores.numel(), m.bias_scores.numel()
+        return [
+            ('scores', self.scores[off:off + n].view(m.scores.shape)),
+            ('bias_scores', self.bias_scores[boff:boff + bn].view(m.bias_scores.shape)),
+            ('flag_bits', self.flag_bits[off // 8:off // 8 + m.flag_bits.numel()]),
+            ('bias_flag_bits', self.bias_flag_bits[boff // 8:boff // 8 + m.bias_flag_bits.numel()]),
+        ]
+
+    # puts back into the arena the layer tensors that were rebound since the last call
+    def sync(self):
+        device = self.layers[0].scores.device
+        if device != self.device:
+            self.allocate(device, self.layers[0].scores.dtype)
+        with torch.no_grad():
+            for j, m in enumerate(self.layers):
+                moved = False
+                for name, view in self.slots(j):
+                    t = getattr(m, name)
+                    if t.data_ptr() == view.data_ptr():
+                        continue
+                    view.copy_(t.data)
+                    if isinstance(t, nn.Parameter):
+                        t.data = view
+                    else:
+                        setattr(m, name, view)
+                    moved = True
+                if moved:
+                    m.mask_cache.clear()
+                    m.weight_cache.clear()
+
+    # bool mask of the arena bytes that belong to the given layers
+    def selection(self, layers):
+        key = tuple(id(m) for m in layers)
+        if key not in self.selections:
+            index = {id(m): j for j, m in enumerate(self.layers)}
+            weight_bytes = torch.zeros(self.numel // 8, dtype=torch.bool, device=self.device)
+            bias_bytes = torch.zeros(self.bias_numel // 8, dtype=torch.bool, device=self.device)
+            for m in layers:
+                j = index[id(m)]
+                weight_bytes[self.offsets[j] // 8:self.offsets[j] // 8 + m.flag_bits.numel()] = True
+                bias_bytes[self.bias_offsets[j] // 8:self.bias_offsets[j] // 8 + m.bias_flag_bits.numel()] = True
+            self.selections[key] = (weight_bytes, bias_bytes)
+        return self.selections[key]
+
+    # the scores with flag 1 of the given layers, (weights, biases)
+    def active_scores(self, layers):
+        self.sync()
+        weight_bytes, bias_bytes = self.selection(layers)
+        out = []
+        for scores, bits, sel in [(self.scores, self.flag_bits, weight_bytes),
+                                  (self.bias_scores, self.bias_flag_bits, bias_bytes)]:
+            flags = unpack_bits(bits, (bits.numel() * 8,), torch.bool).view(-1, 8) & sel[:, None]
+            out.append(scores[flags.view(-1)])
+        return out
+
+    def clamp_(self, low, high):
+        self.sync()
+        with torch.no_grad():
+            self.scores.clamp_(low, high)
+            self.bias_scores.clamp_(low, high)
+        # the layer scores are parameters whose .data is a view of the arena, the clamp
+        # doesn't bump their version
+        for m in self.layers:
+            m.mask_cache.clear()
+            m.weight_cache.clear()
+
+    def parameters(self, bias=True):
+        params = [m.scores for m in self.layers]
+        if bias:
+            params += [m.bias_scores for m in self.layers]
+        return params
+
+    # the elementwise fn summed over the scores (and the bias scores with bias),
+    # differentiable w.r.t. the layer scores
+    def regularization(self, fn, bias=True):
+        self.sync()
+        return ArenaReduction.apply(self, fn, bias, *self.parameters(bias))
+
+
+class ArenaReduction(torch.autograd.Function):
+    # the layer parameters are inputs only so that autograd reaches them, the values are
+    # read from the arena their .data points to
+    @staticmethod
+    def forward(ctx, arena, fn, bias, *params):
+        ctx.arena, ctx.fn, ctx.bias = arena, fn, bias
+        with torch.no_grad():
+            out = torch.sum(fn(arena.scores) * arena.valid)
+            if bias:
+                out = out + torch.sum(fn(arena.bias_scores) * arena.bias_valid)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        arena = ctx.arena
+        grads = []
+        kinds = [(arena.scores, arena.valid, arena.offsets, 'scores')]
+        if ctx.bias:
+            kinds.append((arena.bias_scores, arena.bias_valid, arena.bias_offsets, 'bias_scores'))
+        for flat, valid, offsets, attr in kinds:
+            with torch.enable_grad():
+                x = flat.detach().requires_grad_(True)
+                g, = torch.autograd.grad(torch.sum(ctx.fn(x) * valid), x)
+            g = g * grad_out
+            for m, off in zip(arena.layers, offsets):
+                t = getattr(m, attr)
+                grads.append(g[off:off + t.numel()].view(t.shape))
+        return (None, None, None) + tuple(grads)
+
+
+def check_score_arena(args):
+    if args.score_dtype != 'float32' or args.score_param != 'dense' or args.active_set_scores:
+        raise ValueError("--score-arena needs dense fp32 score parameters (no --score-dtype, --score-param, --active-set-scores)")
+
+
+def attach_score_arena(model):
+    layers = [m for m in model.modules() if isinstance(m, SubnetStrategyLayer)]
+    if len(layers) == 0:
+        return None
+    # a plain attribute, not a submodule, so state_dict() doesn't see it
+    model.__dict__['score_arena'] = ScoreArena(layers)
+    print("=> Score arena: {} layers, {} scores".format(len(layers), model.score_arena.numel))
+    return model.score_arena
+
+
+def get_score_arena(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    return model.__dict__.get('score_arena')
@@ -0,0 +1,155 @@
+"""
+Hashed / low-rank scores for SubnetConv / SubnetLinear (--score-param).
+
+A dense score tensor costs as much as the weight. For the big layers (the VGG16
+classifier, the Conv6Wide linear layers, ...) the scores can instead be computed on
+the fly from a smaller parameter:
+
+- hashed: a table of --score-hash-buckets scores, element i of the layer reads the
+  bucket hash(i, seed) (same counter-based hash as utils/seeded_init.py)
+- lowrank: score_rows @ score_cols, rank --score-rank, over the (out, in * k * k) view
+
+`layer.scores` is then built from the factors on every access (a tile at a time for the
+hashed table) and only lives as long as the forward / prune() / rounding that asked for it,
+the masks and their straight-through gradients go through it as usual. round_model()
+works on a materialized copy. Writes to `layer.scores.data` would be lost, so the
+options that make them (--differentiate-clamp, --rewind-score, and --bottom-k-on-forward
+through prune(update_scores=True)) are rejected by check_score_params().
+"""
+import torch
+import torch.nn as nn
+
+from utils.mask_cache import tensor_key
+from utils.seeded_init import M32, TILE_SIZE, hash32, layer_seed
+
+
+# so that the buckets don't follow the other layer_seed() streams of the same layer
+SCORE_HASH_SALT = 0x9e3779b9
+
+
+# bucket of each element in [start, end)
+def hash_buckets(seed, start, end, num_buckets, device):
+    counter = torch.arange(start, end, dtype=torch.int64, device=device)
+    return hash32((hash32(counter & M32) + seed) & M32) % num_buckets
+
+
+class FactorizedScores(object):
+    # mixin for the subnet layers. once hash_scores() / low_rank_scores() is called the
+    # scores parameter is dropped and `layer.scores` is computed from the factors, until
+    # materialize_scores()
+    def is_factorized(self):
+        return self.__dict__.get('score_factorization') is not None
+
+    def hash_scores(self, num_buckets, seed):
+        scores = self.scores.detach()
+        num_buckets = min(num_buckets, scores.numel())
+        # a sample of the dense init, so the scores keep its distribution
+        pick = torch.randperm(scores.numel(), device=scores.device)[:num_buckets]
+        table = nn.Parameter(scores.reshape(-1)[pick].clone(), requires_grad=self.scores.requires_grad)
+        self.score_shape = scores.shape
+        self.score_factorization = ('hashed', seed)
+        del self.scores
+        self.score_table = table
+
+    def low_rank_scores(self, rank):
+        scores = self.scores.detach()
+        mat = scores.reshape(scores.size(0), -1)
+        rank = min(rank, *mat.shape)
+        # best rank-r fit of the dense init (randomized, the classifier layers are big)
+        u, s, v = torch.svd_lowrank(mat, q=rank)
+        root = s.sqrt()
+        requires_grad = self.scores.requires_grad
+        self.score_shape = scores.shape
+        self.score_factorization = ('lowrank', rank)
+        del self.scores
+        self.score_rows = nn.Parameter((u * root).contiguous(), requires_grad=requires_grad)
+        self.score_cols = nn.Parameter((root[:, None] * v.t()).contiguous(), requires_grad=requires_grad)
+
+    def factorized_scores(self):
+        kind, arg = self.score_factorization
+        if kind == 'lowrank':
+            return (self.score_rows @ self.score_cols).view(self.score_shape)
+        numel = self.score_shape.numel()
+        table = self.score_table
+        tiles = [table[hash_buckets(arg, start, min(start + TILE_SIZE, numel), table.numel(), table.device)]
+                 for start in range(0, numel, TILE_SIZE)]
+        return torch.cat(tiles).view(self.score_shape)
+
+    # the tensors the scores are computed from (for the mask caches)
+    def score_tensors(self):
+        if not self.is_factorized():
+            return (self.scores,)
+        if self.score_factorization[0] == 'lowrank':
+            return (self.score_rows, self.score_cols)
+        return (self.score_table,)
+
+    def scores_key(self):
+        return tuple(tensor_key(t) for t in self.score_tensors())
+
+    # puts a dense scores parameter back
+    def materialize_scores(self):
+        if not self.is_factorized():
+            return
+        factors = self.score_tensors()
+        with torch.no_grad():
+            scores = self.factorized_scores().clone()
+        for name in ['score_table', 'score_rows', 'score_cols']:
+            if name in self._parameters:
+                del self._parameters[name]
+        self.score_factorization = None
+        self.scores = nn.Parameter(scores, requires_grad=factors[0].requires_grad)
+        self.mask_cache.clear()
+        self.weight_cache.clear()
+
+    def num_score_params(self):
+        return sum(t.numel() for t in self.score_tensors())
+
+    def __getattr__(self, name):
+        if name == 'scores' and self.is_factorized():
+            return self.factorized_scores()
+        return super().__getattr__(name)
+
+    # checkpoints with dense scores override the factorization
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.is_factorized() and prefix + 'scores' in state_dict:
+            self.materialize_scores()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def check_score_params(args):
+    if args.score_param == 'dense':
+        return
+    if args.score_param not in ['hashed', 'lowrank']:
+        raise ValueError("{} is not a score parameterization |dense|hashed|lowrank|".format(args.score_param))
+    if args.score_param == 'lowrank' and args.algo not in ['ep', 'global_ep', 'global_ep_iter']:
+        # hc needs the scores themselves in [0, 1], the trainer clamps them in place
+        raise ValueError("--score-param lowrank only supports ep / global_ep / global_ep_iter (got {})".format(args.algo))
+    if args.differentiate_clamp or args.rewind_score or args.bottom_k_on_forward:
+        raise ValueError("--score-param {} can't write the scores in place (--differentiate-clamp, --rewind-score, --bottom-k-on-forward)".format(args.score_param))
+    if args.score_dtype != 'float32' or args.active_set_scores:
+        raise ValueError("--score-param {} needs plain fp32 score training".format(args.score_param))
+
+
+# factorizes the scores of every layer where that takes fewer parameters than dense scores
+def factorize_model_scores(model, kind, num_buckets=65536, rank=8, base_seed=0):
+    num_dense = num_factorized = 0
+    layers = [m for m in model.modules() if isinstance(m, FactorizedScores)]
+    for idx, m in enumerate(layers):
+        numel = m.scores.numel()
+        num_dense += numel
+        if kind == 'hashed' and num_buckets < numel:
+            m.hash_scores(num_buckets, layer_seed(base_seed ^ SCORE_HASH_SALT, idx))
+        elif kind == 'lowrank' and rank * (m.scores.size(0) + numel // m.scores.size(0)) < numel:
+            m.low_rank_scores(rank)
+        num_factorized += m.num_score_params()
+        m.mask_cache.clear()
+        m.weight_cache.clear()
+    print("=> {} scores: {} score parameters instead of {}".format(kind, num_factorized, num_dense))
+    return model
+
+
+def materialize_scores(model):
+    for m in model.modules():
+        if isinstance(m, FactorizedScores):
+            m.materialize_scores()
+    return model
@@ -0,0 +1,158 @@
+"""
+Reduced-precision score storage (--score-dtype, --score-master-copy).
+
+bfloat16 / float16: the scores and bias_scores of the subnet layers are stored in the
+low-precision dtype and the forward thresholds them directly. With --score-master-copy
+the optimizer trains an fp32 copy instead: the low-precision gradient is moved into the
+master as soon as it is accumulated, and the rounded master is written back into the
+working scores after every optimizer step. Anything else that writes the working scores
+(the hc clamp, rewinds) is picked up by the master before the next step.
+
+uint8 (global_ep / global_ep_iter only): the layers hold 8-bit fixed-point magnitudes
+|s| / scale, with one scale for all the scores of the model (and one for the bias
+scores), so the global magnitude ranking prune() does works on the codes as they are.
+The fp32 master is always kept in the optimizer here, updates smaller than a code step
+would be rounded away otherwise. The masks get their straight-through gradient from the
+master (GlobalEPStrategy.subnet), and the codes and scale are recomputed after every step.
+"""
+import torch
+import torch.nn as nn
+
+from utils.net_utils import swap_optimizer_param
+from utils.subnet_strategies import SubnetStrategyLayer
+
+
+SCORE_DTYPES = {
+    'float32': torch.float32,
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'uint8': torch.uint8,
+}
+
+UINT8_MAX = 255
+
+
+def score_layers(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    return [m for m in model.modules() if isinstance(m, SubnetStrategyLayer)]
+
+
+def bytes_per_score(model):
+    numel = size = 0
+    for m in score_layers(model):
+        numel += m.scores.numel()
+        size += m.scores.numel() * m.scores.element_size()
+    return size / max(numel, 1)
+
+
+class ScoreMasters(object):
+    # fp32 master copies of the working scores of a model, (working, master) pairs
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.pairs = []
+        # uint8: value of one code step, for the scores and for the bias scores
+        self.scales = [1.0, 1.0]
+
+    def add(self, param, master, kind):
+        self.pairs.append((param, master, kind))
+
+    def quantize(self, master, kind):
+        if self.dtype == torch.uint8:
+            return (master.abs() / self.scales[kind]).round_().clamp_(max=UINT8_MAX).to(self.dtype)
+        return master.to(self.dtype)
+
+    def update_scales(self):
+        for kind in range(2):
+            masters = [m for _, m, k in self.pairs if k == kind]
+            if len(masters) > 0:
+                max_abs = max(m.detach().abs().max().item() for m in masters)
+                self.scales[kind] = max_abs / UINT8_MAX if max_abs > 0 else 1.0
+
+    # before the step: take over whatever was written into the working scores from outside
+    def pull(self):
+        if self.dtype == torch.uint8:
+            return
+        with torch.no_grad():
+            for param, master, kind in self.pairs:
+                changed = param.data != self.quantize(master, kind)
+                master[changed] = param.data[changed].float()
+
+    # after the step: write the (rounded) masters back into the working scores. into the
+    # parameter itself, not its .data, so the version the mask caches key on changes
+    def push(self):
+        with torch.no_grad():
+            if self.dtype == torch.uint8:
+                self.update_scales()
+            for param, master, kind in self.pairs:
+                param.copy_(self.quantize(master, kind))
+
+
+def move_grad_to(master):
+    def hook(param):
+        grad = param.grad.float()
+        master.grad = grad if master.grad is None else master.grad + grad
+        param.grad = None
+    return hook
+
+
+def check_score_precision(args):
+    if args.score_dtype == 'float32':
+        return
+    if args.multiprocessing_distributed:
+        # the scores are converted (uint8: replaced by new parameters) after set_gpu() wrapped
+        # the model in DDP, which would keep reducing the old fp32 parameters
+        raise ValueError("--score-dtype {} does not support distributed training".format(args.score_dtype))
+    if args.lean_masked_ops:
+        raise ValueError("--lean-masked-ops works on fp32 scores, it can't be used with --score-dtype {}".format(args.score_dtype))
+    if args.active_set_scores:
+        raise ValueError("--active-set-scores can't be used with --score-dtype {}".format(args.score_dtype))
+    if args.score_dtype == 'uint8':
+        if args.algo not in ['global_ep', 'global_ep_iter']:
+            raise ValueError("--score-dtype uint8 only supports global_ep / global_ep_iter (got {})".format(args.algo))
+        if args.regularization:
+            raise ValueError("--score-dtype uint8 does not support score regularization")
+
+
+# call once the model (and a checkpoint, if any) is loaded and the optimizer is built.
+# optimizer=None only converts the storage (e.g. for evaluation)
+def set_score_precision(model, dtype_name, optimizer=None, master_copy=False):
+    dtype = SCORE_DTYPES[dtype_name]
+    if dtype == torch.float32:
+        return None
+    master_copy = master_copy or dtype == torch.uint8
+    masters = ScoreMasters(dtype)
+
+    for m in score_layers(model):
+        for kind, name in enumerate(['scores', 'bias_scores']):
+            old = getattr(m, name)
+            master = old.detach().float().clone().requires_grad_(old.requires_grad)
+            if dtype == torch.uint8:
+                # integer tensors can't require grad, the master is what trains
+                param = nn.Parameter(torch.zeros_like(old, dtype=dtype), requires_grad=False)
+                setattr(m, name, param)
+            else:
+                param = old
+                param.data = param.data.to(dtype)
+                if master_copy and param.requires_grad:
+                    param.register_post_accumulate_grad_hook(move_grad_to(master))
+            if master_copy:
+                masters.add(param, master, kind)
+                if optimizer is not None:
+                    # the optimizer state goes along as fp32
+                    swap_optimizer_param(optimizer, old, master, lambda v: v.float())
+        if dtype == torch.uint8:
+            m.score_masters = (masters.pairs[-2][1], masters.pairs[-1][1])
+        m.mask_cache.clear()
+        m.weight_cache.clear()
+
+    print("=> Scores stored as {} ({:.1f} bytes per score){}".format(
+        dtype_name, bytes_per_score(model), ", fp32 master copy in the optimizer" if master_copy else ""))
+    if not master_copy:
+        return None
+    masters.push()
+    if optimizer is not None:
+        optimizer.score_master_hooks = (
+            optimizer.register_step_pre_hook(lambda opt, args, kwargs: masters.pull()),
+            optimizer.register_step_post_hook(lambda opt, args, kwargs: masters.push()))
+    return masters
@@ -0,0 +1,277 @@
+"""
+Seeded (regenerated) frozen weights for SubnetConv / SubnetLinear (--seeded-weights).
+
+When we only learn the mask, the weights never change after init, so a layer can
+keep what its init drew from instead of the weight itself. While the builder
+constructs a seeded layer, the default reset_parameters() draw of the weight is
+skipped (the generator is only advanced past it) and the weight stays a meta
+tensor. The builder then records the CPU generator state that its init draws from
+(the reset_parameters() state for the inits that reuse those values, like
+signed_constant) and advances the generator past its own draw, so every other
+random number of the run is unchanged.
+
+The weight is regenerated by setting the recorded state in a forked generator and
+running init_weight(), the same torch ops the builder runs on a stored weight, so
+the values are bit-identical to the default path. They are generated on the CPU
+(where the builder initializes them) and copied to the layer's device.
+
+The hash helpers at the top are the counter-based RNG used by the hashed scores
+(utils/score_params.py) and the rounding seeds (utils/prob_rounding.py).
+"""
+import contextlib
+import itertools
+import math
+
+import torch
+import torch.nn as nn
+
+from utils.mask_cache import tensor_key
+
+
+M32 = 0xFFFFFFFF
+
+# elements handled at once, bounds the temporaries
+TILE_SIZE = 2 ** 20
+
+
+# lowbias32 integer hash, on int64 tensors holding values in [0, 2^32)
+# (products may wrap around in int64, but the low 32 bits are still right)
+def hash32(x):
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & M32
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & M32
+    x = x ^ (x >> 16)
+    return x
+
+
+def hash32_int(x):
+    x = x & M32
+    x ^= x >> 16
+    x = (x * 0x7feb352d) & M32
+    x ^= x >> 15
+    x = (x * 0x846ca68b) & M32
+    x ^= x >> 16
+    return x
+
+
+# seed of the layer_idx-th layer built from the run's --seed
+def layer_seed(base_seed, layer_idx):
+    return hash32_int(hash32_int(base_seed) + layer_idx)
+
+
+# the inits that rescale the values left by reset_parameters() instead of drawing new ones
+RESET_INITS = ["signed_constant", "unsigned_constant", "xavier_constant"]
+# the inits that draw with uniform_, which takes one number per element on the CPU
+UNIFORM_INITS = ["kaiming_uniform", "standard"]
+
+
+# the builder's weight init (Builder._init_conv), returns the initialized weight
+def init_weight(weight, init, mode, nonlinearity, scale_fan, prune_rate):
+    if init == "signed_constant":
+
+        fan = nn.init._calculate_correct_fan(weight, mode)
+        if scale_fan:
+            fan = fan * (1 - prune_rate)
+        gain = nn.init.calculate_gain(nonlinearity)
+        std = gain / math.sqrt(fan)
+        return weight.sign() * std
+
+    elif init == "unsigned_constant":
+
+        fan = nn.init._calculate_correct_fan(weight, mode)
+        if scale_fan:
+            fan = fan * (1 - prune_rate)
+
+        gain = nn.init.calculate_gain(nonlinearity)
+        std = gain / math.sqrt(fan)
+        return torch.ones_like(weight) * std
+
+    elif init == "kaiming_normal":
+
+        if scale_fan:
+            fan = nn.init._calculate_correct_fan(weight, mode)
+            fan = fan * (1 - prune_rate)
+            gain = nn.init.calculate_gain(nonlinearity)
+            std = gain / math.sqrt(fan)
+            with torch.no_grad():
+                weight.normal_(0, std)
+        else:
+            nn.init.kaiming_normal_(weight, mode=mode, nonlinearity=nonlinearity)
+        return weight
+
+    elif init == "kaiming_uniform":
+        nn.init.kaiming_uniform_(weight, mode=mode, nonlinearity=nonlinearity)
+        return weight
+    elif init == "xavier_normal":
+        nn.init.xavier_normal_(weight)
+        return weight
+    elif init == "xavier_constant":
+
+        fan_in, fan_out = nn.init._calculate_fan_in_and_fan_out(weight)
+        std = math.sqrt(2.0 / float(fan_in + fan_out))
+        return weight.sign() * std
+
+    elif init == "standard":
+
+        nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+        return weight
+
+    else:
+        raise ValueError(f"{init} is not an initialization option!")
+
+
+# moves the CPU generator past a uniform_ draw of numel values, a tile at a time
+def advance_uniform(numel, dtype):
+    scratch = torch.empty(min(numel, TILE_SIZE), dtype=dtype)
+    with torch.no_grad():
+        for start in range(0, numel, TILE_SIZE):
+            scratch[:min(TILE_SIZE, numel - start)].uniform_()
+
+
+# set while the builder constructs the layers of a --seeded-weights model
+_seeded_construction = [False]
+
+
+@contextlib.contextmanager
+def seeded_construction(enabled=True):
+    previous = _seeded_construction[0]
+    _seeded_construction[0] = enabled
+    try:
+        yield
+    finally:
+        _seeded_construction[0] = previous
+
+
+_tokens = itertools.count()
+
+
+class SeededWeight(object):
+    # rng_state: CPU generator state the init draws from. init_args: (mode, nonlinearity,
+    # scale_fan, prune_rate) of init_weight()
+    def __init__(self, shape, dtype, init, init_args, rng_state):
+        self.shape = torch.Size(shape)
+        self.dtype = dtype
+        self.init = init
+        self.init_args = tuple(init_args)
+        self.rng_state = rng_state
+        # identifies the weight in the cache keys
+        self.token = next(_tokens)
+
+    # records the state the builder's init draws from for a layer whose reset_parameters()
+    # was skipped (reset_rng_state), and moves the generator past that init
+    @staticmethod
+    def record(shape, dtype, init, init_args, reset_rng_state):
+        if init in RESET_INITS:
+            return SeededWeight(shape, dtype, init, init_args, reset_rng_state)
+        seeded = SeededWeight(shape, dtype, init, init_args, torch.get_rng_state())
+        if init in UNIFORM_INITS:
+            advance_uniform(seeded.numel(), dtype)
+        else:
+            # normal_ doesn't take one number per element, replay the whole draw
+            init_weight(torch.empty(shape, dtype=dtype), init, *init_args)
+        return seeded
+
+    def numel(self):
+        return self.shape.numel()
+
+    def generate(self, device=None, dtype=None):
+        weight = torch.empty(self.shape, dtype=self.dtype)
+        with torch.random.fork_rng(devices=[]):
+            torch.set_rng_state(self.rng_state)
+            with torch.no_grad():
+                if self.init in RESET_INITS:
+                    # what reset_parameters() would have left in the weight
+                    nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+                weight = init_weight(weight, self.init, *self.init_args)
+        return weight.to(device=device, dtype=dtype)
+
+    # fills out (shape of the weight)
+    def generate_(self, out):
+        return out.copy_(self.generate(out.device, out.dtype))
+
+    # out *= weight
+    def mul_into_(self, out):
+        return out.mul_(self.generate(out.device, out.dtype))
+
+
+class SeededWeights(object):
+    # mixin for the subnet layers. once seed_weight() is called the weight parameter is
+    # dropped and `layer.weight` regenerates it (read-only) until materialize_weight()
+    def reset_parameters(self):
+        if not _seeded_construction[0]:
+            return super().reset_parameters()
+        # the state the default draw of the weight starts from, the draw itself is skipped
+        self.reset_rng_state = torch.get_rng_state()
+        advance_uniform(self.weight.numel(), self.weight.dtype)
+        self.weight = nn.Parameter(torch.empty(self.weight.shape, dtype=self.weight.dtype, device='meta'))
+        # the bias part of nn.Conv2d / nn.Linear reset_parameters()
+        if self.bias is not None:
+            fan_in, _ = nn.init._calculate_fan_in_and_fan_out(self.weight)
+            if fan_in != 0:
+                bound = 1 / math.sqrt(fan_in)
+                nn.init.uniform_(self.bias, -bound, bound)
+
+    def seed_weight(self, seeded_weight):
+        self.seeded_weight = seeded_weight
+        # empty stand-in that follows the layer's .to() / .cuda() / .half()
+        self.register_buffer('weight_like', torch.empty(0, dtype=seeded_weight.dtype), persistent=False)
+        self.__dict__.pop('reset_rng_state', None)
+        del self.weight
+
+    def is_seeded(self):
+        return self.__dict__.get('seeded_weight') is not None
+
+    # device / dtype of the weight, without generating a seeded one
+    def weight_device(self):
+        return self.weight_like.device if self.is_seeded() else self.weight.device
+
+    def weight_dtype(self):
+        return self.weight_like.dtype if self.is_seeded() else self.weight.dtype
+
+    # the weight to hand to the masked ops: a tensor, or the SeededWeight to generate from
+    def weight_or_seed(self):
+        if self.is_seeded():
+            return self.seeded_weight
+        return self.weight
+
+    def weight_key(self):
+        if self.is_seeded():
+            return ('seeded', self.seeded_weight.token)
+        return tensor_key(self.weight)
+
+    # puts a real weight parameter back, e.g. before finetuning the weights
+    def materialize_weight(self):
+        if not self.is_seeded():
+            return
+        weight = self.seeded_weight.generate(self.weight_device(), self.weight_dtype())
+        self.seeded_weight = None
+        self.weight = nn.Parameter(weight, requires_grad=False)
+
+    def __getattr__(self, name):
+        if name == 'weight' and self.is_seeded():
+            return self.seeded_weight.generate(self.weight_device(), self.weight_dtype())
+        return super().__getattr__(name)
+
+    # checkpoints with a stored weight override the seed
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.is_seeded() and prefix + 'weight' in state_dict:
+            self.materialize_weight()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def check_seeded_weights(args):
+    # every other forward path multiplies layer.weight, which regenerates the whole weight
+    if not args.lean_masked_ops:
+        raise ValueError("--seeded-weights needs --lean-masked-ops")
+    if args.algo not in ['hc', 'hc_iter', 'ep', 'global_ep', 'global_ep_iter']:
+        raise ValueError("--seeded-weights only supports hc, hc_iter, ep and global_ep(_iter)")
+    if args.conv_type != 'SubnetConv' or args.active_set_scores:
+        raise ValueError("--seeded-weights needs SubnetConv layers (the channel layers and --active-set-scores don't use the lean ops)")
+
+
+def materialize_weights(model):
+    for m in model.modules():
+        if isinstance(m, SeededWeights):
+            m.materialize_weight()
+    return model
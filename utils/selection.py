@@ -0,0 +1,144 @@
+"""
+Selection-based mask helpers.
+
+The masks here match what you would get by sorting the scores (with a stable
+sort) and zeroing out the first j entries, but the k-th score is found with
+torch.kthvalue (quickselect) so we never pay for a full sort.
+"""
+import struct
+
+import torch
+
+
+# returns a {0, 1} mask (same shape and dtype as scores) with the j smallest scores set to 0
+# ties at the threshold are broken the same way a stable ascending sort would break them,
+# i.e. the tied entries with the largest flat index are the ones that are kept
+def get_bottomk_mask(scores, j):
+    flat = scores.detach().reshape(-1)
+    n = flat.numel()
+    if j <= 0:
+        return torch.ones_like(scores)
+    if j >= n:
+        return torch.zeros_like(scores)
+
+    threshold = torch.kthvalue(flat, j).values
+    mask = torch.gt(flat, threshold)
+
+    # some entries may be tied with the threshold, keep the last few of them. done with
+    # tensor ops only (no .item() / nonzero), so there is no host sync and torch.compile
+    # can trace it
+    num_ties_to_keep = (n - j) - mask.sum()
+    ties = torch.eq(flat, threshold)
+    ties_from_end = ties.flip(0).cumsum(0).flip(0)
+    mask = mask | (ties & (ties_from_end <= num_ties_to_keep))
+
+    return mask.reshape(scores.shape).to(scores.dtype)
+
+
+# EP style mask: keep the top k fraction of the scores
+# j = int((1 - k) * numel) is the same rounding that the sort based GetSubnet used
+def get_topk_mask(scores, k):
+    j = int((1 - k) * scores.numel())
+    return get_bottomk_mask(scores, j)
+
+
+# k-th smallest value of a flat tensor that moves a little between calls (the per batch
+# global_ep thresholds). The previous value is kept with a bracket [t - width, t + width]
+# around it: one pass counts the entries below the bracket and gathers the ones inside,
+# and if the rank falls inside, torch.kthvalue on that band gives the exact same value as
+# on the whole tensor. Otherwise (the threshold drifted out of the bracket), and every
+# refresh_every calls, the value is recomputed on the whole tensor and the bracket is
+# reset to hold about band_fraction of the entries around the rank.
+class KthValueTracker(object):
+    def __init__(self, refresh_every=100, band_fraction=0.01):
+        self.refresh_every = refresh_every
+        self.band_fraction = band_fraction
+        self.threshold = None
+        self.width = 0.0
+        self.calls_since_refresh = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def exact(self, flat, rank):
+        n = flat.numel()
+        m = max(1, int(self.band_fraction * n))
+        threshold = torch.kthvalue(flat, rank).values.item()
+        low = torch.kthvalue(flat, max(rank - m, 1)).values.item()
+        high = torch.kthvalue(flat, min(rank + m, n)).values.item()
+        self.width = max(threshold - low, high - threshold)
+        self.threshold = threshold
+        self.calls_since_refresh = 0
+        self.refreshes += 1
+        return threshold
+
+    # the rank-th smallest (1-based) value of flat, as a float
+    def kth(self, flat, rank):
+        flat = flat.detach().reshape(-1)
+        if self.threshold is None or self.calls_since_refresh >= self.refresh_every:
+            return self.exact(flat, rank)
+        self.calls_since_refresh += 1
+
+        low, high = self.threshold - self.width, self.threshold + self.width
+        in_band = torch.ge(flat, low) & torch.le(flat, high)
+        num_below = torch.lt(flat, low).sum().item()
+        band = flat[in_band]
+        if not num_below < rank <= num_below + band.numel():
+            self.misses += 1
+            previous, width = self.threshold, self.width
+            threshold = self.exact(flat, rank)
+            # the bracket was too narrow for this drift
+            self.width = max(self.width, 2 * width, 2 * abs(threshold - previous))
+            return threshold
+
+        self.hits += 1
+        threshold = torch.kthvalue(band, rank - num_below).values.item()
+        if abs(threshold - self.threshold) > self.width / 2:
+            self.width *= 2
+        self.threshold = threshold
+        return threshold
+
+
+# digits of the radix select below: two passes over the 32 bit keys
+RADIX_BITS = 16
+
+
+# int64 keys in [0, 2**32) with the same order as the float32 values (-0.0 is +0.0)
+def ordered_keys(values):
+    bits = (values.float() + 0.0).view(torch.int32).long()
+    bits = torch.where(bits < 0, bits ^ 0x7FFFFFFF, bits)
+    return bits + 2 ** 31
+
+
+def key_value(key):
+    bits = key - 2 ** 31
+    if bits < 0:
+        bits ^= 0x7FFFFFFF
+    return struct.unpack('<f', struct.pack('<i', bits))[0]
+
+
+# rank-th smallest (1-based) value of the 1d tensors yielded by chunks() (called once per
+# pass), as a float. Radix select on per chunk histograms: the first pass finds the high
+# RADIX_BITS bits of the key, the second one the low bits among the entries with those
+# high bits, so the memory is one chunk plus the histogram and the chunks are never
+# concatenated. Gives the same value as torch.sort(...).values[rank - 1] on the concatenation
+def chunked_kthvalue(chunks, rank):
+    num_bins = 2 ** RADIX_BITS
+    prefix = None
+    for shift in [RADIX_BITS, 0]:
+        hist = None
+        for values in chunks():
+            keys = ordered_keys(values.reshape(-1))
+            if prefix is not None:
+                keys = keys[torch.eq(keys >> RADIX_BITS, prefix)]
+            digits = (keys >> shift) & (num_bins - 1)
+            counts = torch.bincount(digits, minlength=num_bins)
+            hist = counts if hist is None else hist + counts
+        if hist is None or not 1 <= rank <= hist.sum().item():
+            raise ValueError("rank {} out of range for the chunked selection".format(rank))
+        cumulative = hist.cumsum(0)
+        digit = torch.searchsorted(cumulative, torch.tensor([rank], device=cumulative.device)).item()
+        if digit > 0:
+            rank -= cumulative[digit - 1].item()
+        prefix = digit if prefix is None else (prefix << RADIX_BITS) | digit
+    return key_value(prefix)
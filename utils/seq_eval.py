@@ -0,0 +1,138 @@
+"""
+Sequential (anytime) estimate of validate() for the intermediate epochs (--seq-eval).
+
+Instead of a full pass, the loader's images are visited in a class-stratified random
+order (round robin over the shuffled images of each class, so every prefix is close to
+class balanced) and the evaluation stops as soon as the confidence interval of the
+top-1 estimate is narrower than +-(--seq-eval-ci) points at level --seq-eval-confidence.
+The interval is the normal one for a proportion with the finite population correction,
+so it shrinks to 0 on a full pass; stratification only makes it conservative.
+
+The exact validate() still runs for the epochs whose numbers are reported or saved: the
+last training epoch, the last fine-tuning epoch, --ckpt-at-fixed-epochs and the pruning
+epochs of --checkpoint-at-prune. Estimates are never put in the eval cache.
+"""
+import math
+from statistics import NormalDist
+
+import torch
+
+from utils.eval_utils import accuracy
+
+
+# below this many images the interval is not trusted
+MIN_SAMPLES = 500
+
+
+def is_exact_epoch(epoch, args):
+    if epoch is None:
+        return True
+    if epoch in [args.epochs - 1, 2 * args.epochs - 1]:
+        # last epoch of the training and of finetune()
+        return True
+    if args.ckpt_at_fixed_epochs and epoch in args.ckpt_at_fixed_epochs:
+        return True
+    if args.checkpoint_at_prune and args.algo == 'hc_iter' and epoch != 0 and epoch % args.iter_period == 0:
+        return True
+    return False
+
+
+def dataset_targets(loader):
+    if hasattr(loader, 'targets'):
+        # EvalTensorLoader (data/eval_store.py)
+        return loader.targets
+    dataset = loader.dataset
+    if isinstance(dataset, torch.utils.data.Subset) and hasattr(dataset.dataset, 'targets'):
+        return torch.as_tensor(dataset.dataset.targets)[torch.as_tensor(dataset.indices)]
+    if hasattr(dataset, 'targets'):
+        return torch.as_tensor(dataset.targets)
+    return None
+
+
+# random order of the dataset indices, classes interleaved
+def stratified_order(targets, num_samples, generator):
+    if targets is None:
+        return torch.randperm(num_samples, generator=generator)
+    targets = targets.reshape(-1).long().cpu()
+    classes = torch.unique(targets)
+    # position of each image within its (shuffled) class, spread over [0, 1) per class
+    rank = torch.empty(num_samples, dtype=torch.float64)
+    for c in classes:
+        idx = torch.nonzero(targets == c).reshape(-1)
+        perm = idx[torch.randperm(idx.numel(), generator=generator)]
+        offset = torch.rand(1, generator=generator, dtype=torch.float64)
+        rank[perm] = (torch.arange(idx.numel(), dtype=torch.float64) + offset) / idx.numel()
+    return torch.argsort(rank)
+
+
+def ordered_batches(loader, order, batch_size):
+    if hasattr(loader, 'images'):
+        for start in range(0, order.numel(), batch_size):
+            idx = order[start:start + batch_size]
+            yield loader.images[idx], loader.targets[idx]
+        return
+    reader = torch.utils.data.DataLoader(
+        loader.dataset, batch_size=batch_size, sampler=order.tolist(),
+        num_workers=getattr(loader, 'num_workers', 0), pin_memory=getattr(loader, 'pin_memory', False))
+    for batch in reader:
+        yield batch
+
+
+# half width in points of the top-1 interval after n of N images
+def interval(acc1, n, N, z):
+    p = acc1 / 100
+    fpc = math.sqrt(max(N - n, 0) / max(N - 1, 1))
+    return 100 * z * math.sqrt(p * (1 - p) / max(n, 1)) * fpc
+
+
+class SequentialValidate(object):
+    def __init__(self, validate, half_width, confidence, seed=0):
+        self.validate = validate
+        self.half_width = half_width
+        self.z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.orders = {}
+
+    def order(self, loader):
+        num_samples = len(loader.dataset)
+        key = (id(loader), num_samples)
+        if key not in self.orders:
+            self.orders[key] = stratified_order(dataset_targets(loader), num_samples, self.generator)
+        # a fresh rotation every call, so the epochs don't all look at the same images
+        start = torch.randint(num_samples, (1,), generator=self.generator).item()
+        return torch.roll(self.orders[key], -start)
+
+    def estimate(self, val_loader, model, args):
+        num_samples = len(val_loader.dataset)
+        batch_size = getattr(val_loader, 'batch_size', None) or args.batch_size
+        correct = torch.zeros(3, dtype=torch.float64)
+        n = 0
+        half_width = float('inf')
+        model.eval()
+        with torch.no_grad():
+            for images, target in ordered_batches(val_loader, self.order(val_loader), batch_size):
+                if args.gpu is not None:
+                    images = images.cuda(args.gpu, non_blocking=True)
+                target = target.cuda(args.gpu, non_blocking=True)
+                acc = accuracy(model(images), target, topk=(1, 5, 10))
+                correct += torch.cat(acc).double().cpu() * target.size(0) / 100
+                n += target.size(0)
+                half_width = interval(100 * correct[0].item() / n, n, num_samples, self.z)
+                if n >= min(MIN_SAMPLES, num_samples) and half_width <= self.half_width:
+                    break
+        top1, top5, top10 = (100 * correct / max(n, 1)).tolist()
+        print("Model top1 Accuracy (estimate on {}/{} images): {:.2f} +- {:.2f}".format(
+            n, num_samples, top1, half_width))
+        return top1, top5, top10
+
+    # validate with the same signature, estimated outside the exact epochs
+    def wrap(self):
+        def seq_validate(val_loader, model, criterion, args, writer, epoch):
+            if is_exact_epoch(epoch, args):
+                return self.validate(val_loader, model, criterion, args, writer, epoch)
+            top1, top5, top10 = self.estimate(val_loader, model, args)
+            if writer is not None:
+                writer.add_scalar("test/Acc@1_avg", top1, global_step=epoch)
+            return top1, top5, top10
+        return seq_validate
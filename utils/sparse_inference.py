@@ -0,0 +1,182 @@
+"""
+Sparse CPU inference for rounded tickets.
+
+export_sparse() copies a model and replaces every masked layer (SubnetConv,
+SubnetLinear, their channel versions, and the greedy MaskConv / MaskLinear) with a
+DispatchLayer holding:
+
+- the dense layer on the effective weight (weight * subnet, computed once)
+- a CSR (and, where the shape allows it, BSR) version: sparse @ dense for linear
+  layers, and sparse im2col-GEMM (F.unfold, then sparse @ columns) for convs
+
+On its first forward each DispatchLayer times the candidates on the real input and
+keeps the fastest one from then on, so every layer runs dense or sparse depending on
+what is actually faster at its density and shape. Grouped / depthwise convs stay dense.
+The exported model is for inference only (eval mode, no gradients). main.py exports the
+finetuned model with --sparse-export (hc scores rounded with --round first, see
+main_utils.sparse_export_and_save).
+"""
+import copy
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils.compaction import make_conv, set_module
+from utils.mask_layers import MaskConv, MaskLinear
+from utils.net_utils import update_forward_thresholds
+from utils.subnet_strategies import SubnetStrategyLayer
+
+
+# above this density the sparse kernels never win, don't bother probing them
+MAX_SPARSE_DENSITY = 0.5
+PROBE_REPEATS = 5
+BSR_BLOCKSIZE = 4
+
+
+def effective_weights(layer):
+    with torch.no_grad():
+        if isinstance(layer, SubnetStrategyLayer):
+            w, b = layer.effective_weights()
+        elif isinstance(layer, (MaskConv, MaskLinear)):
+            w = layer.weight * layer.mask_weight * layer.fixed_weight
+            b = None if layer.bias is None else layer.bias * layer.mask_bias * layer.fixed_bias
+        else:
+            w, b = layer.weight, layer.bias
+    return w.detach().clone(), (None if b is None else b.detach().clone())
+
+
+def is_masked_layer(m):
+    return isinstance(m, (SubnetStrategyLayer, MaskConv, MaskLinear)) and isinstance(m, (nn.Conv2d, nn.Linear))
+
+
+def to_sparse(weight_2d, layout):
+    if layout == 'csr':
+        return weight_2d.to_sparse_csr()
+    elif layout == 'bsr':
+        return weight_2d.to_sparse_bsr((BSR_BLOCKSIZE, BSR_BLOCKSIZE))
+    raise ValueError("{} is not a sparse layout".format(layout))
+
+
+class SparseLinear(nn.Module):
+    def __init__(self, weight, bias, layout='csr'):
+        super().__init__()
+        self.layout = layout
+        self.out_features = weight.size(0)
+        self.weight = to_sparse(weight, layout)
+        self.bias = bias
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        out = self.weight.matmul(x.t()).t()
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(shape[:-1] + (self.out_features,))
+
+
+class SparseConv2d(nn.Module):
+    def __init__(self, conv, weight, bias, layout='csr'):
+        super().__init__()
+        self.layout = layout
+        self.out_channels = weight.size(0)
+        self.kernel_size = conv.kernel_size
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        # a 1x1 conv with stride 1 and no padding doesn't need the unfold
+        self.pointwise = (self.kernel_size == (1, 1) and self.stride == (1, 1) and self.padding == (0, 0))
+        self.weight = to_sparse(weight.reshape(weight.size(0), -1), layout)
+        self.bias = bias
+
+    def out_size(self, size, i):
+        return (size + 2 * self.padding[i] - self.dilation[i] * (self.kernel_size[i] - 1) - 1) // self.stride[i] + 1
+
+    def forward(self, x):
+        n, c, h, w = x.shape
+        if self.pointwise:
+            cols = x.reshape(n, c, h * w)
+        else:
+            cols = F.unfold(x, self.kernel_size, dilation=self.dilation, padding=self.padding, stride=self.stride)
+        num_cols = cols.size(2)
+        # (C*kh*kw, N*L) so that the whole batch is a single sparse @ dense
+        cols = cols.transpose(0, 1).reshape(cols.size(1), n * num_cols)
+        out = self.weight.matmul(cols).view(self.out_channels, n, num_cols).transpose(0, 1)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1)
+        return out.reshape(n, self.out_channels, self.out_size(h, 0), self.out_size(w, 1))
+
+
+class DispatchLayer(nn.Module):
+    # runs whichever of its candidates was fastest on the first input it saw
+    def __init__(self, name, density, candidates):
+        super().__init__()
+        self.name = name
+        self.density = density
+        self.candidates = nn.ModuleDict(candidates)
+        self.choice = None
+        self.latency = {}
+
+    def probe(self, x):
+        for key, layer in self.candidates.items():
+            try:
+                layer(x)
+                start = time.perf_counter()
+                for _ in range(PROBE_REPEATS):
+                    layer(x)
+                self.latency[key] = (time.perf_counter() - start) / PROBE_REPEATS
+            except RuntimeError:
+                # e.g. no CPU kernel for this layout in the installed torch
+                continue
+        self.choice = min(self.latency, key=self.latency.get)
+
+    def forward(self, x):
+        if self.choice is None:
+            with torch.no_grad():
+                self.probe(x)
+        return self.candidates[self.choice](x)
+
+
+def make_dispatch(name, layer):
+    w, b = effective_weights(layer)
+    density = w.ne(0).float().mean().item()
+    if isinstance(layer, nn.Conv2d):
+        candidates = {'dense': make_conv(layer, w, b, layer.groups)}
+    else:
+        dense = nn.Linear(w.size(1), w.size(0), bias=b is not None).to(w.device)
+        dense.weight.data.copy_(w)
+        if b is not None:
+            dense.bias.data.copy_(b)
+        candidates = {'dense': dense}
+
+    if density <= MAX_SPARSE_DENSITY and not (isinstance(layer, nn.Conv2d) and layer.groups != 1):
+        layouts = ['csr']
+        if w.size(0) % BSR_BLOCKSIZE == 0 and w[0].numel() % BSR_BLOCKSIZE == 0:
+            layouts.append('bsr')
+        for layout in layouts:
+            if isinstance(layer, nn.Conv2d):
+                candidates[layout] = SparseConv2d(layer, w, b, layout)
+            else:
+                candidates[layout] = SparseLinear(w, b, layout)
+    return DispatchLayer(name, density, candidates)
+
+
+# inference copy of the model with every masked layer behind a dense / sparse dispatcher
+def export_sparse(model):
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+    update_forward_thresholds(model)
+    model = copy.deepcopy(model).cpu().eval()
+    for name, m in list(model.named_modules()):
+        if is_masked_layer(m):
+            set_module(model, name, make_dispatch(name, m))
+    return model
+
+
+def print_dispatch(model):
+    print("{:<30} {:>8} {:>8} {}".format('layer', 'density', 'choice', 'latency (ms)'))
+    for m in model.modules():
+        if isinstance(m, DispatchLayer):
+            latency = ', '.join('{}: {:.3f}'.format(k, 1000 * v) for k, v in m.latency.items())
+            print("{:<30} {:>8.4f} {:>8} {}".format(m.name, m.density, str(m.choice), latency))
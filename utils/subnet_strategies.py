@@ -0,0 +1,498 @@
+"""
+Forward strategies for SubnetConv / SubnetLinear (and the channel versions).
+
+The pruning algorithm (hc, ep, global_ep, imp, pt) is bound once, when the
+layer is built, to a strategy object holding plain python / tensor state. The
+forward itself never looks at parser_args, which keeps the per-step python
+overhead down and lets torch.compile trace a full score-training step.
+The layer provides dense_op(x, w, b) and lean_op(...) (utils/masked_ops.py),
+the strategy decides how the masked weight is built.
+"""
+import functools
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from args_helper import parser_args
+from utils.mask_cache import MaskCache, StraightThroughMask, tensor_key
+from utils.masked_ops import ActiveMaskedWeight
+from utils.selection import get_topk_mask
+from utils.bitmask import unpack_bits
+
+
+# pt: by default the probabilities are too small. artificially pushing them towards 1 helps!
+MULTIPLIER = 10
+
+
+# the mask / weight caches key on data_ptr and _version, which dynamo can't trace
+def is_compiling():
+    compiler = getattr(torch, 'compiler', None)
+    if compiler is not None and hasattr(compiler, 'is_compiling'):
+        return compiler.is_compiling()
+    return False
+
+
+class SubnetStrategy(object):
+    # the mask is a deterministic function of scores / flags / thresholds, so it can be cached
+    cacheable = True
+    # set by uncached_masked_weights, the masks are computed again instead of read from the cache
+    bypass_cache = False
+    # ep style: the mask is computed from scores.abs(). hc style: from the scores, times flag
+    abs_scores = True
+
+    def __init__(self, bias=False, lean=False):
+        self.bias = bias
+        self.lean = lean and self.cacheable
+
+    # detached {0, 1} masks for the weight and the bias
+    def masks(self, layer, scores, bias_scores):
+        raise NotImplementedError
+
+    def mask_inputs(self, layer):
+        return layer.scores.abs(), layer.bias_scores.abs()
+
+    def prepare(self, layer):
+        pass
+
+    # everything the mask depends on. if none of it changed, the cached mask is still valid
+    def cache_key(self, layer):
+        return (layer.scores_key(), tensor_key(layer.flag_bits),
+                tensor_key(layer.bias_scores), tensor_key(layer.bias_flag_bits),
+                tensor_key(layer.prune_thresholds), layer.prune_rate)
+
+    def detached_masks(self, layer, scores, bias_scores):
+        if self.cacheable and not self.bypass_cache and not is_compiling():
+            key = self.cache_key(layer)
+            masks = layer.mask_cache.get(key)
+            if masks is None:
+                with torch.no_grad():
+                    masks = self.masks(layer, scores, bias_scores)
+                layer.mask_cache.set(key, masks, layer.cache_refs())
+        else:
+            with torch.no_grad():
+                masks = self.masks(layer, scores, bias_scores)
+        return masks
+
+    # masks with a straight-through gradient to the scores
+    def ste_masks(self, layer, scores, bias_scores):
+        masks = self.detached_masks(layer, scores, bias_scores)
+        return StraightThroughMask.apply(scores, masks[0]), StraightThroughMask.apply(bias_scores, masks[1])
+
+    def subnet(self, layer):
+        return self.ste_masks(layer, *self.mask_inputs(layer))
+
+    def masked_weights(self, layer):
+        subnet, bias_subnet = self.subnet(layer)
+        w = layer.weight * subnet
+        if self.bias:
+            b = layer.bias * bias_subnet
+        else:
+            b = layer.bias
+        return w, b
+
+    # masked_weights from masks computed from the tensors as they are now, for fingerprints
+    # that must not trust a cache key a write through .data left unchanged
+    def uncached_masked_weights(self, layer):
+        self.bypass_cache = True
+        try:
+            return self.masked_weights(layer)
+        finally:
+            self.bypass_cache = False
+
+    # detached weight mask (before the flag) for the fused op in utils/masked_ops.py
+    def lean_mask(self, layer):
+        return self.detached_masks(layer, *self.mask_inputs(layer))[0]
+
+    # masked weights with the score gradient going to layer.active_scores (active-set mode,
+    # see utils/active_set.py). only the strategies that gate the forward with the flag have it
+    def active_masked_weights(self, layer):
+        raise NotImplementedError
+
+    def lean_flag(self, layer):
+        return None
+
+    def forward(self, layer, x):
+        self.prepare(layer)
+        if self.cacheable and not torch.is_grad_enabled() and not is_compiling():
+            # eval (validate, rounding loops, landscape sweeps): reuse the masked weight
+            # until the scores, flags or weights change
+            key = self.cache_key(layer) + (layer.weight_key(), tensor_key(layer.bias))
+            cached = layer.weight_cache.get(key)
+            if cached is None:
+                cached = self.masked_weights(layer)
+                layer.weight_cache.set(key, cached, layer.cache_refs() + (layer.weight_or_seed(), layer.bias))
+            w, b = cached
+        elif layer.active_idx is not None:
+            w, b = self.active_masked_weights(layer)
+        elif self.lean:
+            # same output and gradients, without keeping weight * subnet alive for backward
+            if self.bias:
+                # the bias is tiny, it goes through the usual autograd path
+                b = layer.bias * self.subnet(layer)[1]
+            else:
+                b = layer.bias
+            return layer.lean_op(x, layer.weight_or_seed(), self.lean_flag(layer), b,
+                                 functools.partial(self.lean_mask, layer), self.abs_scores)
+        else:
+            w, b = self.masked_weights(layer)
+
+        return layer.dense_op(x, w, b)
+
+    # channel / neuron masks (ChannelSubnetLayer): out is the dense layer output, the mask
+    # scales its output channels
+    def channel_forward(self, layer, out):
+        self.prepare(layer)
+        subnet = self.subnet(layer)[0]
+        return out * layer.channel_view(subnet, out)
+
+
+class HCStrategy(SubnetStrategy):
+    abs_scores = False
+
+    # threshold=None rounds at the layer's prune threshold (bottom_k_on_forward)
+    def __init__(self, bias=False, lean=False, quantized=False, threshold=0.5, differentiate_clamp=False):
+        super().__init__(bias, lean)
+        self.quantized = quantized
+        self.threshold = threshold
+        self.differentiate_clamp = differentiate_clamp
+
+    def prepare(self, layer):
+        if self.differentiate_clamp:
+            layer.scores.data = torch.clamp(layer.scores.data, 0.0, 1.0)
+            layer.bias_scores.data = torch.clamp(layer.bias_scores.data, 0.0, 1.0)
+            if layer.active_idx is not None:
+                layer.active_scores.data = torch.clamp(layer.active_scores.data, 0.0, 1.0)
+
+    def mask_inputs(self, layer):
+        return layer.scores, layer.bias_scores
+
+    def masks(self, layer, scores, bias_scores):
+        # round scores to {0, 1}
+        if self.threshold is None:
+            return (torch.gt(scores, layer.prune_thresholds[0]).float(),
+                    torch.gt(bias_scores, layer.prune_thresholds[1]).float())
+        return torch.gt(scores, self.threshold).float(), torch.gt(bias_scores, self.threshold).float()
+
+    def subnet(self, layer):
+        if self.quantized:
+            subnet, bias_subnet = self.ste_masks(layer, layer.scores, layer.bias_scores)
+            subnet = subnet * layer.flag
+            bias_subnet = subnet * layer.bias_flag
+        else:
+            # don't need a mask here. the scores are directly multiplied with weights
+            subnet = layer.scores * layer.flag
+            bias_subnet = layer.bias_scores * layer.bias_flag
+        return subnet, bias_subnet
+
+    def lean_mask(self, layer):
+        if not self.quantized:
+            return layer.scores
+        return super().lean_mask(layer)
+
+    def active_masked_weights(self, layer):
+        with torch.no_grad():
+            if self.quantized:
+                subnet = self.detached_masks(layer, layer.scores, layer.bias_scores)[0] * layer.flag
+            else:
+                subnet = layer.scores * layer.flag
+        w = ActiveMaskedWeight.apply(layer.active_scores, layer.weight, subnet, layer.active_idx)
+        if self.bias:
+            b = layer.bias * self.subnet(layer)[1]
+        else:
+            b = layer.bias
+        return w, b
+
+    def lean_flag(self, layer):
+        return unpack_bits(layer.flag_bits, layer.flag_shape, torch.bool)
+
+
+class EPStrategy(SubnetStrategy):
+    def masks(self, layer, scores, bias_scores):
+        # keep the top k% of the scores (by selection, see utils/selection.py)
+        return get_topk_mask(scores, layer.prune_rate), get_topk_mask(bias_scores, layer.prune_rate)
+
+
+class GlobalEPStrategy(SubnetStrategy):
+    def masks(self, layer, scores, bias_scores):
+        # the thresholds are set by prune(update_thresholds_only=True)
+        return (torch.gt(scores, layer.prune_thresholds[0]).float(),
+                torch.gt(bias_scores, layer.prune_thresholds[1]).float())
+
+    def subnet(self, layer):
+        if layer.score_masters is None:
+            return super().subnet(layer)
+        # the scores are 8-bit magnitudes, the masks come from them as they are
+        masks = self.detached_masks(layer, *self.mask_inputs(layer))
+        return (StraightThroughMask.apply(layer.score_masters[0].abs(), masks[0]),
+                StraightThroughMask.apply(layer.score_masters[1].abs(), masks[1]))
+
+
+class PTStrategy(SubnetStrategy):
+    # a new mask is sampled on every call, so there is nothing to reuse
+    cacheable = False
+
+    def __init__(self, bias=False, normalize_scores=False):
+        super().__init__(bias)
+        self.normalize_scores = normalize_scores
+
+    def masks(self, layer, scores, bias_scores):
+        if self.normalize_scores:
+            # min-max normalization so that scores are in [0, 1]
+            scores = (scores - scores.min())/(scores.max() - scores.min())
+            bias_scores = (bias_scores - bias_scores.min())/(bias_scores.max() - bias_scores.min())
+
+        # sample using scores as probability
+        scores = torch.clamp(MULTIPLIER*scores, 0, 1)
+        bias_scores = torch.clamp(MULTIPLIER*bias_scores, 0, 1)
+        return torch.bernoulli(scores), torch.bernoulli(bias_scores)
+
+
+class IMPStrategy(SubnetStrategy):
+    cacheable = False
+
+    def forward(self, layer, x):
+        # no STE, no subnet. Mask is handled outside
+        return layer.dense_op(x, layer.weight, layer.bias)
+
+    def masked_weights(self, layer):
+        return layer.weight, layer.bias
+
+    def channel_forward(self, layer, out):
+        return out
+
+
+class InvalidStrategy(SubnetStrategy):
+    cacheable = False
+
+    def __init__(self, algo):
+        super().__init__()
+        self.algo = algo
+
+    def forward(self, layer, x):
+        print("INVALID PRUNING ALGO: {}".format(self.algo))
+        print("EXITING")
+        exit()
+
+    def channel_forward(self, layer, out):
+        self.forward(layer, out)
+
+
+# reads the run config once, when the layer is built
+def get_strategy(hc_algos=('hc', 'hc_iter')):
+    algo = parser_args.algo
+    if algo in hc_algos:
+        threshold = None if parser_args.bottom_k_on_forward else parser_args.quantize_threshold
+        return HCStrategy(parser_args.bias, parser_args.lean_masked_ops, parser_args.hc_quantized,
+                          threshold, parser_args.differentiate_clamp)
+    elif algo in ['ep', 'ep+greedy']:
+        return EPStrategy(parser_args.bias, parser_args.lean_masked_ops)
+    elif algo in ['global_ep', 'global_ep_iter']:
+        return GlobalEPStrategy(parser_args.bias, parser_args.lean_masked_ops)
+    elif algo in ['pt', 'pt_hack']:
+        # pt_hack is the only one that ever normalized the scores
+        return PTStrategy(parser_args.bias, algo == 'pt_hack' and parser_args.normalize_scores)
+    elif algo == 'imp':
+        return IMPStrategy(parser_args.bias)
+    else:
+        return InvalidStrategy(algo)
+
+
+class SubnetStrategyLayer(object):
+    # mixin for the subnet layers, they only have to provide dense_op and lean_op
+    def init_strategy(self, hc_algos=('hc', 'hc_iter')):
+        self.hc_algos = tuple(hc_algos)
+        self.prune_rate = parser_args.prune_rate
+        # prune scores below this for global EP in bottom-k (weights, bias). a buffer so that
+        # updating it neither recompiles nor retraces anything
+        self.register_buffer('prune_thresholds', torch.full((2,), -np.inf), persistent=False)
+        # active-set mode (utils/active_set.py): flat indices of the live (flag == 1) scores and
+        # the trainable copy of those scores. None when the full scores are trained
+        self.register_buffer('active_idx', None, persistent=False)
+        self.register_parameter('active_scores', None)
+        # 8-bit scores (utils/score_precision.py): fp32 masters of (scores, bias_scores), the
+        # straight-through gradient of the masks goes there
+        self.score_masters = None
+
+        # masks and masked weights from the last forward (see utils/mask_cache.py)
+        self.mask_cache = MaskCache()
+        self.weight_cache = MaskCache()
+        self.strategy = get_strategy(self.hc_algos)
+
+    # e.g. after changing parser_args.algo on an existing model
+    def rebind_strategy(self):
+        self.strategy = get_strategy(self.hc_algos)
+        self.mask_cache.clear()
+        self.weight_cache.clear()
+
+    def set_prune_rate(self, prune_rate):
+        self.prune_rate = prune_rate
+
+    @property
+    def scores_prune_threshold(self):
+        return self.prune_thresholds[0]
+
+    @scores_prune_threshold.setter
+    def scores_prune_threshold(self, value):
+        self.prune_thresholds[0] = value
+
+    @property
+    def bias_scores_prune_threshold(self):
+        return self.prune_thresholds[1]
+
+    @bias_scores_prune_threshold.setter
+    def bias_scores_prune_threshold(self, value):
+        self.prune_thresholds[1] = value
+
+    # the tensors the scores are computed from (see utils/score_params.py)
+    def score_tensors(self):
+        return (self.scores,)
+
+    def scores_key(self):
+        return tensor_key(self.scores)
+
+    def cache_refs(self):
+        return self.score_tensors() + (self.flag_bits, self.bias_scores, self.bias_flag_bits, self.prune_thresholds)
+
+    def get_subnet(self):
+        return self.strategy.subnet(self)
+
+    # the scores the optimizer updates, and a weight-shaped tensor gathered to match them
+    def trainable_scores(self):
+        if self.active_idx is None:
+            return self.scores
+        return self.active_scores
+
+    def gather_active(self, t):
+        if self.active_idx is None:
+            return t
+        return t.reshape(-1)[self.active_idx]
+
+    # writes the live scores back into the full scores (after every optimizer step)
+    def sync_active_scores(self):
+        if self.active_idx is not None:
+            with torch.no_grad():
+                self.scores.view(-1).index_copy_(0, self.active_idx, self.active_scores)
+
+    # checkpoints only have the full scores, so they load with or without active-set mode
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        destination.pop(prefix + 'active_scores', None)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        if self.active_idx is not None:
+            if prefix + 'active_scores' in missing_keys:
+                missing_keys.remove(prefix + 'active_scores')
+            with torch.no_grad():
+                self.active_scores.copy_(self.scores.reshape(-1)[self.active_idx])
+
+    # |weight| with the shape of the scores (what drop_bottom_half_weights ranks)
+    def weight_magnitude(self):
+        return self.weight.data.abs()
+
+    # the (weight, bias) the forward effectively uses, e.g. for utils/compaction.py.
+    # cached=False computes the masks again instead of reading the mask cache
+    def effective_weights(self, cached=True):
+        with torch.no_grad():
+            self.strategy.prepare(self)
+            if not cached:
+                return self.strategy.uncached_masked_weights(self)
+            return self.strategy.masked_weights(self)
+
+    def forward(self, x):
+        return self.strategy.forward(self, x)
+
+
+class ChannelSubnetLayer(SubnetStrategyLayer):
+    # mixin for ChannelSubnetConv / ChannelSubnetLinear: one score per output channel (neuron),
+    # applied as a scale on the layer output, so there is no weight-sized mask or masked
+    # weight. The mask covers the bias too. The layers only have to set channel_dim.
+    channel_dim = 1
+
+    def init_channel_subnet(self, hc_algos=('hc', 'hc_iter')):
+        num_channels = self.weight.size(0)
+        # the bias goes with its channel, bias_scores / bias_flag are dummies so other things don't break
+        self.init_flags((num_channels,), (1,))
+        self.scores = nn.Parameter(torch.Tensor(num_channels))
+        self.bias_scores = nn.Parameter(torch.Tensor(1))
+        # the classifier keeps all of its outputs, see keep_classifier_channels
+        self.keep_all_channels = False
+
+        self.init_strategy(hc_algos)
+
+        if parser_args.algo in ['hc', 'hc_iter']:
+            if parser_args.random_subnet:
+                self.scores.data = torch.bernoulli(parser_args.prune_rate * torch.ones_like(self.scores.data))
+            elif parser_args.score_init in ['half']:
+                self.scores.data = 0.5 * torch.ones_like(self.scores.data)
+            elif parser_args.score_init in ['bern']:
+                self.scores.data = torch.bernoulli(0.5 * torch.ones_like(self.scores.data))
+            elif parser_args.score_init in ['unif']:
+                nn.init.uniform_(self.scores, a=0.0, b=1.0)
+            elif parser_args.score_init in ['bimodal', 'skew']:
+                alpha, beta = (0.1, 0.1) if parser_args.score_init == 'bimodal' else (1, 5)
+                m = torch.distributions.beta.Beta(torch.ones_like(self.scores.data)*alpha,
+                                                  torch.ones_like(self.scores.data)*beta)
+                self.scores.data = m.sample()
+            nn.init.uniform_(self.bias_scores, a=0.0, b=1.0)
+        else:
+            # kaiming_uniform_ needs a 2d tensor, use the bound it gives one row of the weight
+            bound = 1.0 / math.sqrt(self.weight[0].numel())
+            nn.init.uniform_(self.scores, a=-bound, b=bound)
+            nn.init.uniform_(self.bias_scores, a=-1.0, b=1.0)
+
+        if parser_args.freeze_weights:
+            self.weight.requires_grad = False
+            if self.bias is not None:
+                self.bias.requires_grad = False
+
+        if parser_args.rewind_score:
+            self.saved_scores = None
+
+    # number of weights behind one score
+    def channel_numel(self):
+        return self.weight[0].numel()
+
+    # subnet reshaped to broadcast against the layer output
+    def channel_view(self, subnet, out):
+        shape = [1] * out.dim()
+        shape[self.channel_dim] = -1
+        return subnet.view(shape)
+
+    # mean |weight| of each output channel
+    def weight_magnitude(self):
+        return self.weight.data.abs().flatten(1).mean(1)
+
+    def effective_weights(self):
+        if self.keep_all_channels or isinstance(self.strategy, IMPStrategy):
+            return self.weight, self.bias
+        with torch.no_grad():
+            self.strategy.prepare(self)
+            subnet = self.strategy.subnet(self)[0]
+            w = self.weight * subnet.view((-1,) + (1,) * (self.weight.dim() - 1))
+            b = None if self.bias is None else self.bias * subnet
+        return w, b
+
+    def forward(self, x):
+        out = self.dense_op(x, self.weight, self.bias)
+        if self.keep_all_channels:
+            return out
+        return self.strategy.channel_forward(self, out)
+
+
+# with channel masks, pruning the classifier's outputs would drop classes. the classifier is
+# the last conv / linear layer the models register, it stays dense (its scores go unused)
+def keep_classifier_channels(model):
+    layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    if len(layers) > 0 and isinstance(layers[-1], ChannelSubnetLayer):
+        layers[-1].keep_all_channels = True
+    return model
+
+
+def rebind_strategies(model):
+    for m in model.modules():
+        if isinstance(m, SubnetStrategyLayer):
+            m.rebind_strategy()
+    return model